@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from docx import Document
+
+from docx_text import DocxTextCache, iter_docx_texts, read_docx
+
+
+# 生成合成docx文件，每个文件若干段随机文本
+def make_documents(directory, count, paragraphs, seed):
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9))) for _ in range(5000)]
+    paths = []
+    for i in range(count):
+        document = Document()
+        for _ in range(paragraphs):
+            document.add_paragraph(' '.join(rng.choice(words) for _ in range(rng.randint(20, 80))))
+        path = os.path.join(directory, f"{i:05d}.docx")
+        document.save(path)
+        paths.append(path)
+    return paths
+
+
+def timed(name, paths, run):
+    start = time.perf_counter()
+    texts = run()
+    seconds = time.perf_counter() - start
+    return texts, {"run": name, "seconds": seconds, "docs_per_second": len(paths) / seconds}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较docx逐个解析、并行解析（冷缓存）和文本缓存命中（热缓存）的速度')
+    parser.add_argument('--docs', type=int, default=200, help='合成docx文件数量')
+    parser.add_argument('--paragraphs', type=int, default=200, help='每个文件的段落数')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行解析的进程数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        docx_dir = os.path.join(directory, 'docx')
+        os.makedirs(docx_dir)
+        print("生成合成docx文件...\n")
+        paths = make_documents(docx_dir, args.docs, args.paragraphs, args.seed)
+        cache = DocxTextCache(os.path.join(directory, 'cache'))
+
+        baseline, sequential = timed('sequential', paths, lambda: [read_docx(path) for path in paths])
+        cold_texts, cold = timed('parallel_cold_cache', paths,
+                                 lambda: [text for _, text in iter_docx_texts(paths, cache, args.workers)])
+        warm_texts, warm = timed('warm_cache', paths,
+                                 lambda: [text for _, text in iter_docx_texts(paths, cache, args.workers)])
+        report = {
+            "docs": args.docs,
+            "workers": args.workers,
+            "runs": [sequential, cold, warm],
+            "texts_identical": baseline == cold_texts == warm_texts,
+            "cache_stats": cache.stats,
+        }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import time
+
+from openai_stub_server import start_stub_server
+
+
+# 对本地桩服务分别运行线程池实现和异步实现，比较吞吐和新建连接数
+def run_backend(server, generate, prompts):
+    connections_before = server.stats['connections']
+    rate_limited_before = server.stats['rate_limited']
+    start = time.perf_counter()
+    results = generate(prompts)
+    seconds = time.perf_counter() - start
+    in_order = all(result['response'] in (None, f"echo: {prompt}") for result, prompt in zip(results, prompts))
+    return {
+        "requests": len(prompts),
+        "seconds": seconds,
+        "requests_per_second": len(prompts) / seconds,
+        "connections_opened": server.stats['connections'] - connections_before,
+        "rate_limited_responses": server.stats['rate_limited'] - rate_limited_before,
+        "in_order": in_order,
+        "failed": sum(1 for result in results if result['response'] is None),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='使用本地OpenAI桩服务比较gpt_api线程池实现和异步实现的吞吐')
+    parser.add_argument('--requests', type=int, default=200, help='请求数量')
+    parser.add_argument('--latency', type=float, default=0.2, help='桩服务单次请求模拟延迟（秒）')
+    parser.add_argument('--concurrency', type=int, default=32, help='异步实现的最大并发数')
+    parser.add_argument('--quota', type=int, default=0, help='桩服务允许的最大并发数，超出返回429，0表示不限制')
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency, max_in_flight=args.quota)
+    # 环境变量优先于.env文件，将客户端指向本地桩服务
+    os.environ['API_BASE_URL'] = server.base_url
+    os.environ['API_KEY'] = 'stub'
+    os.environ['GPT_MAX_CONCURRENCY'] = str(args.concurrency)
+    # 不读写响应缓存：缓存命中会虚增吞吐，桩服务的回显也不能写入正式缓存
+    os.environ['RESPONSE_CACHE_PATH'] = ''
+
+    import gpt_api
+
+    prompts = [f"prompt {i}" for i in range(args.requests)]
+    report = {
+        "threaded": run_backend(server, gpt_api.threaded_api_generation, prompts),
+        "async": run_backend(server, gpt_api.api_generation, prompts),
+    }
+    # 第二次调用复用同一客户端和连接池，不应再新建连接
+    report["async_second_batch"] = run_backend(server, gpt_api.api_generation, prompts)
+    report["speedup"] = report["async"]["requests_per_second"] / report["threaded"]["requests_per_second"]
+    gpt_api.shutdown()
+    server.shutdown()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
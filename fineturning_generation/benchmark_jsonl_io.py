@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from jsonl_io import CODECS, JsonlWriter, iter_jsonl, orjson
+
+
+# 生成合成的中文切片记录
+def make_records(count, slice_length, seed):
+    rng = random.Random(seed)
+    characters = [chr(code) for code in range(0x4e00, 0x4e00 + 3000)] + list('，。；：')
+    return [
+        {"id": i, "source": f"参考数据/文档{i // 50:04d}.docx", "offset": (i % 50) * slice_length,
+         "slice": ''.join(rng.choice(characters) for _ in range(slice_length)), "labels": ["标记A", "标记B"]}
+        for i in range(count)
+    ]
+
+
+def timed(name, count, path, run):
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    report = {"run": name, "seconds": round(seconds, 4), "records_per_second": round(count / seconds, 1)}
+    if path is not None:
+        report['file_mb'] = round(os.path.getsize(path) / 1024 / 1024, 2)
+    return result, report
+
+
+# 各脚本原来的写法：逐条json.dumps和write，每批flush一次
+def legacy_write(path, records, batch_size, ensure_ascii):
+    with open(path, 'w', encoding='utf-8') as f_:
+        for start in range(0, len(records), batch_size):
+            for record in records[start:start + batch_size]:
+                f_.write(json.dumps(record, ensure_ascii=ensure_ascii) + '\n')
+            f_.flush()
+
+
+def legacy_read(path):
+    with open(path, 'r', encoding='utf-8') as f_:
+        return [json.loads(line) for line in f_ if line.strip()]
+
+
+def writer_write(path, records, batch_size, codec, fsync):
+    with JsonlWriter(path, 'w', group_seconds=0, fsync=fsync, codec=codec) as writer:
+        for start in range(0, len(records), batch_size):
+            writer.write_many(records[start:start + batch_size])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较各脚本原来的JSONL读写方式与jsonl_io（成组提交、不同编解码器和fsync策略）的每秒读写条数')
+    parser.add_argument('--records', type=int, default=100000, help='合成记录条数')
+    parser.add_argument('--slice-length', type=int, default=200, help='每条切片的字数')
+    parser.add_argument('--batch-size', type=int, default=16, help='原来写法每批flush一次的批大小')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    records = make_records(args.records, args.slice_length, args.seed)
+    codecs = [name for name in CODECS if name != 'orjson' or orjson is not None]
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_path = os.path.join(directory, 'legacy.jsonl')
+        runs.append(timed('write_legacy_ascii', args.records, legacy_path,
+                          lambda: legacy_write(legacy_path, records, args.batch_size, True))[1])
+        runs.append(timed('write_legacy_utf8', args.records, legacy_path,
+                          lambda: legacy_write(legacy_path, records, args.batch_size, False))[1])
+        legacy_records, report = timed('read_legacy', args.records, None, lambda: legacy_read(legacy_path))
+        runs.append(report)
+        identical = legacy_records == records
+        for codec in codecs:
+            path = os.path.join(directory, f'{codec}.jsonl')
+            for fsync in ('none', 'commit'):
+                runs.append(timed(f'write_{codec}_fsync_{fsync}', args.records, path,
+                                  lambda: writer_write(path, records, args.batch_size, codec, fsync))[1])
+            read_records, report = timed(f'read_{codec}', args.records, None, lambda: list(iter_jsonl(path, codec=codec)))
+            runs.append(report)
+            identical = identical and read_records == records
+    print(json.dumps({"records": args.records, "slice_length": args.slice_length, "runs": runs,
+                      "records_identical": identical}, ensure_ascii=False, indent=2))
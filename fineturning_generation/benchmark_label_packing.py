@@ -0,0 +1,108 @@
+import argparse
+import json
+import random
+import re
+import zlib
+
+from data_label import (build_prompt_prefix, estimate_tokens, get_packing, label_batch, load_label_pool,
+                        _pack_stats)
+
+DEFAULT_LABELS = ['Emergency Response', 'Chemical Weapons', 'Biological Weapons', 'Radiological Weapons',
+                  'Nuclear Weapons', 'Decontamination', 'Medical Treatment', 'Detection']
+SENTENCES = [
+    "Decontamination of exposed personnel should start as soon as possible.",
+    "Radiological dispersal devices combine conventional explosives with radioactive material.",
+    "Nerve agents inhibit acetylcholinesterase and cause rapid respiratory failure.",
+    "Anthrax spores can survive in soil for decades.",
+    "Potassium iodide tablets protect the thyroid gland from radioactive iodine.",
+    "Shelter-in-place guidance depends on wind direction and building type.",
+]
+ITEM_PATTERN = re.compile(r'^\[(\d+)\] (.*)$', re.M)
+
+
+class FakeBackend:
+    """
+    Stands in for api_generation and counts the tokens of every prompt and answer.
+
+    Labels are derived from a hash of the item text, so an item gets the same labels whether it
+    is labeled alone or in a pack. Each item of a packed answer is left out with probability
+    drop_rate to exercise re-queuing.
+    """
+
+    def __init__(self, labels_, packed_prefix, drop_rate, seed):
+        self.labels = labels_
+        self.packed_prefix = packed_prefix
+        self.drop_rate = drop_rate
+        self.rng = random.Random(seed)
+        self.stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def labels_for(self, text):
+        digest = zlib.crc32(text.encode('utf-8'))
+        return sorted({self.labels[digest % len(self.labels)], self.labels[(digest >> 8) % len(self.labels)]})
+
+    def answer(self, prompt, prefix):
+        if prefix == self.packed_prefix:
+            answer = {number: self.labels_for(text) for number, text in ITEM_PATTERN.findall(prompt[len(prefix):])
+                      if self.rng.random() >= self.drop_rate}
+            return json.dumps(answer, ensure_ascii=False)
+        return str(self.labels_for(prompt[len(prefix) + 1:-1]))
+
+    def __call__(self, prompts, prefix=None, **options):
+        results = []
+        for prompt in prompts:
+            response = self.answer(prompt, prefix)
+            self.stats['calls'] += 1
+            self.stats['prompt_tokens'] += estimate_tokens(prompt)
+            self.stats['completion_tokens'] += estimate_tokens(response)
+            results.append({"instruction": prompt, "response": response})
+        return results
+
+
+def build_slices(count, seed):
+    rng = random.Random(seed)
+    return [{"id": i_, "source": "benchmark.docx", "offset": i_ * 512,
+             "slice": " ".join(rng.choice(SENTENCES) for _ in range(rng.randint(4, 14)))} for i_ in range(count)]
+
+
+def run(slices, labels_, pack_size, token_budget, answer_tokens, drop_rate, batch_size, seed):
+    config = {"pack_size": pack_size, "pack_token_budget": token_budget, "pack_answer_tokens": answer_tokens}
+    packing = get_packing(config, labels_)
+    backend = FakeBackend(labels_, packing['prefix'] if packing else None, drop_rate, seed)
+    for key in _pack_stats:
+        _pack_stats[key] = 0
+    records = []
+    prompt_prefix = build_prompt_prefix(labels_)
+    for i_ in range(0, len(slices), batch_size):
+        records.extend(label_batch(slices[i_:i_ + batch_size], 'slice', prompt_prefix, packing,
+                                   generation_=backend))
+    # 打包后的标记结果应与逐条标记一致
+    mismatched = sum(sorted(record['labels']) != backend.labels_for(record['slice']) for record in records)
+    tokens = backend.stats['prompt_tokens'] + backend.stats['completion_tokens']
+    return {
+        "pack_size": pack_size,
+        "calls": backend.stats['calls'],
+        "prompt_tokens": backend.stats['prompt_tokens'],
+        "completion_tokens": backend.stats['completion_tokens'],
+        "tokens_per_item": round(tokens / len(records), 1),
+        "requeued_items": _pack_stats['requeued_items'],
+        "mismatched_labels": mismatched,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='在模拟的大模型上比较逐条标记和打包标记每条数据消耗的token数')
+    parser.add_argument('--count', type=int, default=2000, help='待标记切片数量')
+    parser.add_argument('--pack-sizes', default='1,4,8,16', help='逗号分隔的打包条数，1为逐条标记')
+    parser.add_argument('--token-budget', type=int, default=4096)
+    parser.add_argument('--answer-tokens', type=int, default=32)
+    parser.add_argument('--drop-rate', type=float, default=0.02, help='打包回答中每条数据缺失的概率')
+    parser.add_argument('--batch-size', type=int, default=64, help='每次调用label_batch的数据条数')
+    parser.add_argument('--label-pool', default=None, help='标记池文件，缺省使用内置标记集合')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    labels = load_label_pool(args.label_pool) if args.label_pool else DEFAULT_LABELS
+    slices = build_slices(args.count, args.seed)
+    for pack_size in [int(value) for value in args.pack_sizes.split(',')]:
+        print(json.dumps(run(slices, labels, pack_size, args.token_budget, args.answer_tokens, args.drop_rate,
+                             args.batch_size, args.seed), ensure_ascii=False))
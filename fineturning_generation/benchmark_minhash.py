@@ -0,0 +1,100 @@
+import argparse
+import json
+import random
+import time
+
+from minhash import MinHashLSH
+
+SUBJECTS = ["sarin", "anthrax", "ricin", "mustard gas", "VX", "cesium-137", "uranium enrichment", "plutonium",
+            "chlorine", "smallpox", "botulinum toxin", "dirty bombs", "nuclear fallout", "phosgene", "iodine-131"]
+ASPECTS = ["detect", "decontaminate", "store safely", "identify exposure to", "respond to an incident involving",
+           "regulate", "monitor", "treat victims of", "train first responders for", "assess the risk of"]
+AUDIENCES = ["ordinary people", "hospitals", "city governments", "schools", "emergency services", "farmers",
+             "border agencies", "laboratories", "the military", "international inspectors"]
+TEMPLATES = [
+    "How can {audience} {aspect} {subject} when {context}?",
+    "What should {audience} know in order to {aspect} {subject} if {context}?",
+    "Which measures help {audience} {aspect} {subject}, given that {context}?",
+    "Explain how {audience} are expected to {aspect} {subject} while {context}.",
+]
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+# 生成不重复的原始指令：模板之外加入随机的情境描述，使不同指令的n-gram集合差异足够大
+def unique_instruction(rng, vocabulary):
+    return rng.choice(TEMPLATES).format(
+        audience=rng.choice(AUDIENCES), aspect=rng.choice(ASPECTS), subject=rng.choice(SUBJECTS),
+        context=' '.join(rng.sample(vocabulary, rng.randint(6, 10))))
+
+
+# 模拟大模型复述同一条指令：大小写、标点、空白和少量词语的变化
+def near_duplicate(instruction, rng):
+    words = instruction.split()
+    edit = rng.randint(0, 3)
+    if edit == 0:
+        return instruction.lower()
+    if edit == 1:
+        return instruction.rstrip('?.') + ' ?'
+    if edit == 2:
+        return 'Please tell me: ' + instruction
+    return ' '.join(words[:-1] + ['exactly', words[-1]])
+
+
+def build_corpus(size, duplicate_ratio, seed):
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+    corpus = []
+    is_duplicate = []
+    for _ in range(size):
+        if corpus and rng.random() < duplicate_ratio:
+            corpus.append(near_duplicate(rng.choice(corpus), rng))
+            is_duplicate.append(True)
+        else:
+            corpus.append(unique_instruction(rng, vocabulary))
+            is_duplicate.append(False)
+    return corpus, is_duplicate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='在合成指令集上测量MinHash/LSH字面去重能省下多少嵌入计算')
+    parser.add_argument('--size', type=int, default=100000, help='合成指令数量')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.3, help='其中字面近似重复的比例')
+    parser.add_argument('--threshold', type=float, default=0.8, help='MinHash相似度阈值')
+    parser.add_argument('--num-perm', type=int, default=128, help='签名长度')
+    parser.add_argument('--bands', type=int, default=16, help='LSH分段数')
+    parser.add_argument('--model', default=None, help='Sentence-BERT模型路径，提供时实测嵌入速度以估算省下的时间')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    corpus, is_duplicate = build_corpus(args.size, args.duplicate_ratio, args.seed)
+    index = MinHashLSH(args.threshold, args.num_perm, args.bands)
+    start = time.perf_counter()
+    forwarded = [index.check_and_add(i, text) is None for i, text in enumerate(corpus)]
+    seconds = time.perf_counter() - start
+
+    dropped = len(corpus) - sum(forwarded)
+    caught = sum(1 for kept, duplicate in zip(forwarded, is_duplicate) if duplicate and not kept)
+    false_drops = sum(1 for kept, duplicate in zip(forwarded, is_duplicate) if not duplicate and not kept)
+    report = {
+        "instructions": len(corpus),
+        "injected_near_duplicates": sum(is_duplicate),
+        "minhash_seconds": seconds,
+        "minhash_items_per_second": len(corpus) / seconds,
+        "forwarded_to_embedding": sum(forwarded),
+        "embeddings_saved": dropped,
+        "embeddings_saved_ratio": dropped / len(corpus),
+        "near_duplicates_caught": caught,
+        "unique_instructions_dropped": false_drops,
+    }
+
+    if args.model:
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(args.model)
+        sample = corpus[:1000]
+        start = time.perf_counter()
+        model.encode(sample, normalize_embeddings=True)
+        encode_per_item = (time.perf_counter() - start) / len(sample)
+        report["encode_seconds_per_item"] = encode_per_item
+        report["embedding_seconds_saved"] = encode_per_item * dropped - seconds
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,378 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import subprocess
+import tempfile
+import time
+import zlib
+from queue import Empty
+
+import numpy as np
+
+from jsonl_io import JsonlWriter, iter_jsonl
+
+DEFAULT_LABELS = ['Emergency Response', 'Chemical Weapons', 'Biological Weapons', 'Radiological Weapons',
+                  'Nuclear Weapons', 'Decontamination', 'Medical Treatment', 'Detection']
+SENTENCES = [
+    "Decontamination of exposed personnel should start as soon as possible.",
+    "Radiological dispersal devices combine conventional explosives with radioactive material.",
+    "Nerve agents inhibit acetylcholinesterase and cause rapid respiratory failure.",
+    "Anthrax spores can survive in soil for decades.",
+    "Potassium iodide tablets protect the thyroid gland from radioactive iodine.",
+    "Shelter-in-place guidance depends on wind direction and building type.",
+    "Hospitals should prepare isolation wards before an outbreak reaches the city.",
+    "Emergency services coordinate evacuation routes with local authorities.",
+]
+SUBJECTS = ["sarin", "anthrax", "ricin", "mustard gas", "VX", "cesium-137", "plutonium", "chlorine", "smallpox",
+            "phosgene", "iodine-131", "dirty bombs"]
+AUDIENCES = ["ordinary people", "hospitals", "schools", "farmers", "first responders", "laboratories"]
+ITEM_PATTERN = re.compile(r'^\[(\d+)\] ', re.M)
+STAGES = ['slice', 'instruction_dedup', 'label', 'embed', 'request', 'finetune']
+# 各阶段用到的模块，在计时开始前导入
+STAGE_MODULES = {
+    "slice": ['slice_generation'],
+    "instruction_dedup": ['instruction_generation', 'embedding_dedup', 'minhash'],
+    "label": ['data_label'],
+    "embed": ['embedding_generation', 'vector_store'],
+    "request": ['request_generation', 'vector_store'],
+    "finetune": ['fineturning_generation'],
+}
+
+
+class FakeLLM:
+    """
+    Deterministic stand-in for qwen2_api.api_generation with a simulated cost.
+
+    Every call sleeps for latency plus the prompt tokens at prompt_rate and the completion
+    tokens at completion_rate (tokens per second, 0 means free), then answers in the format
+    the calling stage parses: label lists (constrained or not), packed JSON labels, generated
+    instructions or fine-tuning answers. Answers depend only on the prompt and a seeded counter.
+    """
+
+    def __init__(self, labels_, latency, prompt_rate, completion_rate, answer_words, seed):
+        from data_label import estimate_tokens
+
+        self.estimate_tokens = estimate_tokens
+        self.labels = labels_
+        self.latency = latency
+        self.prompt_rate = prompt_rate
+        self.completion_rate = completion_rate
+        self.answer_words = answer_words
+        self.rng = random.Random(seed)
+        self.stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def pick_labels(self, text, labels_):
+        digest = zlib.crc32(text.encode('utf-8'))
+        return sorted({labels_[digest % len(labels_)], labels_[(digest >> 8) % len(labels_)]})
+
+    def answer(self, request, prefix, allowed_labels):
+        if isinstance(request, dict):
+            words = ' '.join(request.get('contexts') or []).split() or request['instruction'].split()
+            return ' '.join(words[i_ % len(words)] for i_ in range(self.answer_words))
+        if request.startswith('Please follow my example'):
+            return (f"How can {self.rng.choice(AUDIENCES)} {self.rng.choice(['detect', 'treat', 'store', 'report'])} "
+                    f"{self.rng.choice(SUBJECTS)} {' '.join(self.rng.sample(SENTENCES[self.rng.randrange(8)].split(), 4))}?")
+        body = request[len(prefix):] if prefix and request.startswith(prefix) else request
+        if ITEM_PATTERN.search(body):
+            items = re.split(r'^\[\d+\] ', body, flags=re.M)[1:]
+            return json.dumps({str(number): self.pick_labels(item.strip(), self.labels)
+                               for number, item in enumerate(items, 1)})
+        return str(self.pick_labels(body.strip('[]'), allowed_labels or self.labels))
+
+    def __call__(self, requests, prefix=None, use_cache=True, max_new_tokens=None, allowed_labels=None):
+        results = []
+        prompt_tokens = completion_tokens = 0
+        for request in requests:
+            response = self.answer(request, prefix, allowed_labels)
+            text = request if isinstance(request, str) else request['instruction'] + ''.join(request.get('contexts') or [])
+            prompt_tokens += self.estimate_tokens(text)
+            completion_tokens += self.estimate_tokens(response)
+            results.append({"prompt": request if isinstance(request, str) else request['instruction'],
+                            "response": response, "created_at": ''})
+        seconds = self.latency
+        seconds += prompt_tokens / self.prompt_rate if self.prompt_rate else 0
+        seconds += completion_tokens / self.completion_rate if self.completion_rate else 0
+        time.sleep(seconds)
+        self.stats['calls'] += 1
+        self.stats['prompt_tokens'] += prompt_tokens
+        self.stats['completion_tokens'] += completion_tokens
+        return results
+
+
+class HashEmbedder:
+    """
+    Stand-in for a SentenceTransformer: hashed word unigrams and bigrams, no model weights.
+
+    Texts sharing words get similar vectors, which is enough for deduplication and retrieval to
+    do realistic work.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r'\w+', text.lower())
+            for feature in words + [a + ' ' + b for a, b in zip(words, words[1:])]:
+                digest = zlib.crc32(feature.encode('utf-8'))
+                embeddings[row, digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+def write_jsonl(path, records):
+    with JsonlWriter(path, 'w', group_seconds=0) as writer:
+        writer.write_many(records)
+
+
+def read_jsonl(path):
+    return list(iter_jsonl(path))
+
+
+def build_documents(directory, count, paragraphs, seed):
+    # 合成docx文档，不计入任何阶段的耗时
+    from docx import Document
+
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i_ in range(count):
+        document = Document()
+        for _ in range(paragraphs):
+            document.add_paragraph(' '.join(rng.choice(SENTENCES) for _ in range(rng.randint(3, 8))))
+        document.save(os.path.join(directory, f'document_{i_:04d}.docx'))
+
+
+def stage_slice(work_dir, options, llm):
+    import glob
+
+    from slice_generation import get_slicer, iter_slice_records
+
+    slicer = get_slicer({"mode": "char", "slice_length": options['slice_length'],
+                         "slice_offset_unit": options['slice_length'] // 2})
+    docx_files = sorted(glob.glob(os.path.join(work_dir, 'documents', '*.docx')))
+    records = list(iter_slice_records(docx_files, slicer, workers_=options['workers']))
+    write_jsonl(os.path.join(work_dir, 'slices.jsonl'), records)
+    return len(records)
+
+
+def stage_instruction_dedup(work_dir, options, llm):
+    import instruction_generation
+    from embedding_dedup import EmbeddingDeduplicator
+    from minhash import MinHashLSH
+
+    instruction_generation.api_generation = llm
+    deduplicator = EmbeddingDeduplicator(HashEmbedder(options['dim']), 'hash-embedder',
+                                         os.path.join(work_dir, 'instructions.emb'), options['similarity_threshold'])
+    deduplicator.sync([])
+    lexical_index = MinHashLSH()
+    instructions = []
+    generated = 0
+    while generated < options['instructions']:
+        batch = instruction_generation.generate_instructions(
+            min(options['batch_size'], options['instructions'] - generated), instructions)
+        generated += len(batch)
+        accepted, embeddings = instruction_generation.duplicate_filter(batch, deduplicator, lexical_index)
+        if accepted:
+            instructions.extend(accepted)
+            deduplicator.append(embeddings)
+    write_jsonl(os.path.join(work_dir, 'instructions.jsonl'),
+                [{"id": i_ + 1, "instruction": text, "isLabeled": False, "labels": []}
+                 for i_, text in enumerate(instructions)])
+    return generated
+
+
+def stage_label(work_dir, options, llm):
+    import data_label
+
+    config = {"pack_size": options['pack_size'], "pack_token_budget": 4096, "pack_answer_tokens": 32,
+              "max_new_tokens": 64, "constrained_decoding": True}
+    packing = data_label.get_packing(config, DEFAULT_LABELS)
+    decoding = data_label.get_decoding(config, DEFAULT_LABELS)
+    prompt_prefix = data_label.build_prompt_prefix(DEFAULT_LABELS)
+    count = 0
+    for label_type, input_name, output_name in (('slice', 'slices.jsonl', 'labeled_slices.jsonl'),
+                                                ('instruction', 'instructions.jsonl', 'labeled_instructions.jsonl')):
+        datas = read_jsonl(os.path.join(work_dir, input_name))
+        records = []
+        for i_ in range(0, len(datas), options['batch_size']):
+            records.extend(data_label.label_batch(datas[i_:i_ + options['batch_size']], label_type, prompt_prefix,
+                                                  packing, None, decoding, generation_=llm))
+        write_jsonl(os.path.join(work_dir, output_name), records)
+        count += len(records)
+    return count
+
+
+def stage_embed(work_dir, options, llm):
+    from embedding_generation import save_embeddings
+    from vector_store import LocalStore
+
+    store = LocalStore(os.path.join(work_dir, 'store'), options['dim'], options['nlist'], 'L2', 'IVF_FLAT')
+    store.create()
+    save_embeddings(os.path.join(work_dir, 'labeled_slices.jsonl'), store, 'benchmark', HashEmbedder(options['dim']),
+                    'hash-embedder', options['batch_size'], None)
+    store.finish()
+    store.close()
+    return len(store.keys)
+
+
+def stage_request(work_dir, options, llm):
+    from request_generation import build_requests
+    from vector_store import LocalStore
+
+    store = LocalStore(os.path.join(work_dir, 'store'), options['dim'], options['nlist'], 'L2', 'IVF_FLAT')
+    store.open()
+    model = HashEmbedder(options['dim'])
+    instructions = [record['instruction'] for record in read_jsonl(os.path.join(work_dir, 'labeled_instructions.jsonl'))]
+    requests = []
+    for i_ in range(0, len(instructions), options['batch_size']):
+        requests.extend(build_requests(model, 'hash-embedder', store, instructions[i_:i_ + options['batch_size']],
+                                       options['nprobe'], options['limit'], None))
+    store.close()
+    write_jsonl(os.path.join(work_dir, 'requests.jsonl'), requests)
+    return len(requests)
+
+
+def stage_finetune(work_dir, options, llm):
+    import fineturning_generation
+
+    requests = read_jsonl(os.path.join(work_dir, 'requests.jsonl'))
+    records = []
+    for i_ in range(0, len(requests), options['batch_size']):
+        batch = requests[i_:i_ + options['batch_size']]
+        for j_, result in enumerate(llm(batch)):
+            records.append(fineturning_generation.build_finetune_record(i_ + j_, batch[j_], result.get('response')))
+    write_jsonl(os.path.join(work_dir, 'finetune.jsonl'), records)
+    return len(records)
+
+
+def peak_rss_mb():
+    # Linux的ru_maxrss在fork和exec时继承父进程的峰值，优先读取只属于当前进程的VmHWM
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as f_:
+            for line in f_:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # 没有/proc时使用ru_maxrss，Linux上单位为KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_stage(name, work_dir, options, queue):
+    """
+    Runs one stage in its own process and reports its metrics through queue.
+
+    Running each stage in a fresh process makes the peak RSS that of the stage alone; the
+    stage's modules are imported, and their shared configuration loaded, before the clock starts.
+    """
+    import contextlib
+    import importlib
+    import io
+
+    import jsonl_io
+    import metrics
+
+    for module in STAGE_MODULES[name]:
+        importlib.import_module(module)
+    # 共用的JSONL读写配置和指标记录器首次使用时读取.env，也放在计时之前
+    jsonl_io.get_shared_config()
+    metrics.get_metrics()
+    llm = FakeLLM(DEFAULT_LABELS, options['latency'], options['prompt_rate'], options['completion_rate'],
+                  options['answer_words'], options['seed'])
+    stage = globals()['stage_' + name]
+    # 阶段内部的进度输出不计入报告
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        items = stage(work_dir, options, llm)
+        seconds = time.perf_counter() - start
+    queue.put({
+        "items": items,
+        "wall_seconds": round(seconds, 3),
+        "items_per_second": round(items / seconds, 1) if seconds else None,
+        "llm_calls": llm.stats['calls'],
+        "prompt_tokens": llm.stats['prompt_tokens'],
+        "completion_tokens": llm.stats['completion_tokens'],
+        "prompt_tokens_per_second": round(llm.stats['prompt_tokens'] / seconds, 1) if seconds else None,
+        "completion_tokens_per_second": round(llm.stats['completion_tokens'] / seconds, 1) if seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='用模拟大模型和哈希嵌入在合成数据上逐阶段测量流水线性能，输出JSON报告')
+    parser.add_argument('--documents', type=int, default=20, help='合成docx文档数量')
+    parser.add_argument('--paragraphs', type=int, default=40, help='每个文档的段落数')
+    parser.add_argument('--instructions', type=int, default=500, help='生成的指令数量')
+    parser.add_argument('--stages', default=','.join(STAGES), help='逗号分隔的阶段，后面的阶段依赖前面阶段的输出')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--slice-length', type=int, default=1024)
+    parser.add_argument('--pack-size', type=int, default=1, help='标记阶段的打包条数，1为逐条标记')
+    parser.add_argument('--workers', type=int, default=1, help='切片阶段解析docx的进程数')
+    parser.add_argument('--dim', type=int, default=256, help='哈希嵌入的维度')
+    parser.add_argument('--similarity-threshold', type=float, default=0.9)
+    parser.add_argument('--nlist', type=int, default=16)
+    parser.add_argument('--nprobe', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.005, help='模拟大模型每次调用的固定延迟（秒）')
+    parser.add_argument('--prompt-rate', type=float, default=200000, help='模拟的prompt处理速度（token/秒），0表示不计')
+    parser.add_argument('--completion-rate', type=float, default=20000, help='模拟的生成速度（token/秒），0表示不计')
+    parser.add_argument('--answer-words', type=int, default=60, help='模拟微调回答的词数')
+    parser.add_argument('--work-dir', default=None, help='中间文件目录，缺省使用临时目录')
+    parser.add_argument('--output', default=None, help='报告输出文件，缺省只打印')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # 只使用显式传入的模型和文件，不读写嵌入缓存和响应缓存
+    os.environ['EMBEDDING_CACHE_DIR'] = ''
+    os.environ['RESPONSE_CACHE_PATH'] = ''
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    options = {key: value for key, value in vars(args).items() if key not in ('stages', 'work_dir', 'output')}
+    stages = [name for name in args.stages.split(',') if name]
+    for name in stages:
+        if name not in STAGES:
+            print(f"未知的阶段'{name}'，可选：{','.join(STAGES)}")
+            exit(1)
+    if 'slice' in stages:
+        build_documents(os.path.join(work_dir, 'documents'), args.documents, args.paragraphs, args.seed)
+
+    report = {"commit": current_commit(), "work_dir": work_dir, "options": options, "stages": {}}
+    context = multiprocessing.get_context('spawn')
+    for name in stages:
+        queue = context.Queue()
+        process = context.Process(target=run_stage, args=(name, work_dir, options, queue))
+        process.start()
+        result = None
+        # 子进程异常退出时不会写入结果，不能无限等待
+        while result is None and (process.is_alive() or not queue.empty()):
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                pass
+        process.join()
+        if process.exitcode != 0 or result is None:
+            print(f"阶段'{name}'运行失败，退出码{process.exitcode}")
+            exit(1)
+        report['stages'][name] = result
+        print(json.dumps({"stage": name, **result}, ensure_ascii=False))
+    report['total_wall_seconds'] = round(sum(stage['wall_seconds'] for stage in report['stages'].values()), 3)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入'{args.output}'")
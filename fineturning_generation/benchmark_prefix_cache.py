@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import torch
+
+import qwen2_api
+from data_label import build_prompt_prefix, load_label_pool
+
+
+# 构造与data_label.py相同结构的标记请求，待标记数据为随机拼接的句子
+def build_prompts(labels_, count, seed):
+    rng = random.Random(seed)
+    sentences = [
+        "Decontamination of exposed personnel should start as soon as possible.",
+        "Radiological dispersal devices combine conventional explosives with radioactive material.",
+        "Nerve agents inhibit acetylcholinesterase and cause rapid respiratory failure.",
+        "Anthrax spores can survive in soil for decades.",
+        "Potassium iodide tablets protect the thyroid gland from radioactive iodine.",
+        "Shelter-in-place guidance depends on wind direction and building type.",
+    ]
+    prefix = build_prompt_prefix(labels_)
+    prompts = []
+    for _ in range(count):
+        data = " ".join(rng.choice(sentences) for _ in range(rng.randint(2, 8)))
+        prompts.append(prefix + fr'[{data}]')
+    return prefix, prompts
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+# 只生成一个token，耗时近似为预填充耗时
+def time_prefill(config_, input_ids_, prefix_cache=None, prefix_length=0):
+    lengths = [len(ids) for ids in input_ids_]
+    buckets = qwen2_api.bucket_by_length(lengths, 1, config_['max_batch_tokens'])
+    synchronize()
+    start = time.perf_counter()
+    for bucket in buckets:
+        qwen2_api.generate_bucket([input_ids_[idx] for idx in bucket], 1, prefix_cache, prefix_length)
+    synchronize()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较使用和不使用公共前缀KV缓存时的预填充耗时')
+    parser.add_argument('--count', type=int, default=64, help='标记请求数量')
+    parser.add_argument('--repeat', type=int, default=3, help='重复测量次数，取最小值')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = qwen2_api.get_config()
+    label_pool = os.getenv('LABEL_POOL_PATH')
+    if label_pool and os.path.exists(label_pool):
+        labels = load_label_pool(label_pool)
+    else:
+        labels = ['Emergency Response', 'Chemical Weapons', 'Biological Weapons', 'Radiological Weapons',
+                  'Nuclear Weapons', 'Decontamination', 'Medical Treatment', 'Detection']
+
+    # 在当前进程内加载模型，直接调用生成函数
+    qwen2_api.init_worker(config)
+    prefix, prompts = build_prompts(labels, args.count, args.seed)
+    _, texts, input_ids = qwen2_api.encode_requests(prompts)
+    prefix_length = qwen2_api.shared_prefix_length(config, texts, input_ids, prefix)
+    if not prefix_length:
+        print('未检测到可缓存的公共前缀，请检查PREFIX_CACHE_MIN_TOKENS配置')
+        exit(1)
+
+    synchronize()
+    start = time.perf_counter()
+    prefix_cache = qwen2_api.get_prefix_cache(config, input_ids[0][:prefix_length])
+    synchronize()
+    prefix_seconds = time.perf_counter() - start
+
+    # 预热一次，避免首次调用的初始化开销计入结果
+    time_prefill(config, input_ids[:2])
+    baseline = min(time_prefill(config, input_ids) for _ in range(args.repeat))
+    cached = min(time_prefill(config, input_ids, prefix_cache, prefix_length) for _ in range(args.repeat))
+
+    total_tokens = sum(len(ids) for ids in input_ids)
+    report = {
+        "requests": len(prompts),
+        "prompt_tokens": total_tokens,
+        "prefix_tokens": prefix_length,
+        "prefix_share": prefix_length * len(prompts) / total_tokens,
+        "prefix_build_seconds": prefix_seconds,
+        "prefill_seconds_without_cache": baseline,
+        "prefill_seconds_with_cache": cached,
+        "speedup": baseline / cached if cached else None,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
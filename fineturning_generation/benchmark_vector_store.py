@@ -0,0 +1,63 @@
+import argparse
+import json
+import tempfile
+import time
+
+import numpy as np
+
+from vector_store import LocalStore
+
+
+# 生成带聚类结构的合成向量，近似真实嵌入的分布
+def make_vectors(rng, count, dim, clusters):
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    assignment = rng.randint(0, clusters, size=count)
+    return centers[assignment] + 0.5 * rng.standard_normal((count, dim)).astype(np.float32)
+
+
+def run_search(store, queries, limit, nprobe):
+    start = time.perf_counter()
+    results = store.search(queries, limit, nprobe)
+    seconds = time.perf_counter() - start
+    return [[hit['slice'] for hit in hits] for hits in results], seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='比较本地向量存储精确检索和IVF检索的召回率与延迟')
+    parser.add_argument('--rows', type=int, default=100000, help='向量数量')
+    parser.add_argument('--dim', type=int, default=256, help='向量维度')
+    parser.add_argument('--queries', type=int, default=200, help='查询数量')
+    parser.add_argument('--nlist', type=int, default=1024, help='IVF聚类数量')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 10, 32, 64], help='检索时扫描的聚类数量')
+    parser.add_argument('--limit', type=int, default=10, help='每个查询返回的结果数量')
+    parser.add_argument('--metric', default='L2', choices=['L2', 'IP'])
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    vectors = make_vectors(rng, args.rows, args.dim, 200)
+    queries = make_vectors(rng, args.queries, args.dim, 200)
+    report = {"rows": args.rows, "dim": args.dim, "queries": args.queries, "limit": args.limit}
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = LocalStore(directory, args.dim, args.nlist, args.metric, 'IVF_FLAT')
+        store.create()
+        for start in range(0, args.rows, 10000):
+            rows = list(range(start, min(start + 10000, args.rows)))
+            store.insert(vectors[start:start + 10000], [str(i) for i in rows], rows)
+        start = time.perf_counter()
+        store.finish()
+        report["index_build_seconds"] = time.perf_counter() - start
+
+        # 精确检索作为召回率的基准
+        centroids = store.centroids
+        store.centroids = None
+        exact, seconds = run_search(store, queries, args.limit, 0)
+        report["exact"] = {"ms_per_query": seconds * 1000 / args.queries}
+        store.centroids = centroids
+
+        for nprobe in args.nprobe:
+            approximate, seconds = run_search(store, queries, args.limit, nprobe)
+            recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(approximate, exact)])
+            report[f"ivf_nprobe_{nprobe}"] = {"ms_per_query": seconds * 1000 / args.queries, "recall": float(recall)}
+        store.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,131 @@
+import json
+import os
+
+# 反向读取文件末尾时每次读取的字节数
+TAIL_CHUNK_SIZE = 64 * 1024
+
+
+def checkpoint_path(output_file):
+    return output_file + '.ckpt'
+
+
+def write_checkpoint(output_file, last_record, **state):
+    """
+    Atomically records the last flushed record of an output JSONL file in a sidecar file.
+
+    The sidecar also stores the output file size, so a checkpoint that no longer matches the
+    file (e.g. the process died between the flush and the checkpoint) is detected and ignored.
+    Extra keyword arguments are stored alongside and returned by load_checkpoint.
+    """
+    payload = dict(state)
+    payload['last_record'] = last_record
+    payload['file_size'] = os.path.getsize(output_file)
+    write_json_atomic(checkpoint_path(output_file), payload)
+
+
+def write_json_atomic(path, payload):
+    # 先写临时文件并落盘，再原子替换，崩溃时不会留下写了一半的文件
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f_:
+        json.dump(payload, f_, ensure_ascii=False)
+        f_.flush()
+        os.fsync(f_.fileno())
+    os.replace(temp_path, path)
+
+
+def read_json(path):
+    # 读取write_json_atomic写入的文件，文件不存在或损坏时返回None
+    try:
+        with open(path, 'r', encoding='utf-8') as f_:
+            return json.load(f_)
+    except (ValueError, OSError):
+        return None
+
+
+def repair_tail(output_file):
+    """
+    Truncates a torn final line left behind by a crash in the middle of a write.
+
+    Returns:
+    - The number of bytes removed.
+    """
+    if not os.path.exists(output_file):
+        return 0
+    with open(output_file, 'rb+') as f_:
+        size = f_.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f_.seek(size - 1)
+        if f_.read(1) == b'\n':
+            return 0
+        # 从末尾反向查找最后一个换行符，其后的内容为不完整的记录
+        position = size
+        keep = 0
+        while position > 0:
+            read_size = min(TAIL_CHUNK_SIZE, position)
+            position -= read_size
+            f_.seek(position)
+            index = f_.read(read_size).rfind(b'\n')
+            if index >= 0:
+                keep = position + index + 1
+                break
+        f_.truncate(keep)
+    print(f"文件'{output_file}'末尾存在不完整的记录，已截断{size - keep}字节")
+    return size - keep
+
+
+def read_last_record(output_file):
+    """
+    Reads the last complete record of a JSONL file by seeking backwards from its end.
+
+    Returns:
+    - The last record, or None if the file is missing or empty.
+    """
+    if not os.path.exists(output_file):
+        return None
+    with open(output_file, 'rb') as f_:
+        position = f_.seek(0, os.SEEK_END)
+        tail = b''
+        while position > 0:
+            read_size = min(TAIL_CHUNK_SIZE, position)
+            position -= read_size
+            f_.seek(position)
+            tail = f_.read(read_size) + tail
+            lines = tail.rstrip(b'\n').split(b'\n')
+            # 已经读到一个完整的行（前面还有换行符或已到文件开头）
+            if len(lines) > 1 or position == 0:
+                last_line = lines[-1].strip()
+                if last_line:
+                    return json.loads(last_line)
+                if position == 0:
+                    return None
+    return None
+
+
+def load_checkpoint(output_file):
+    """
+    Loads the resume state of an output JSONL file.
+
+    A torn final line is truncated first. The sidecar checkpoint is used when it matches the
+    file size; otherwise the last record is read from the end of the file.
+
+    Returns:
+    - A dict with at least 'last_record' (None for an empty file), plus any extra state stored
+      by write_checkpoint when the sidecar was used.
+    """
+    repair_tail(output_file)
+    path = checkpoint_path(output_file)
+    if os.path.exists(path) and os.path.exists(output_file):
+        try:
+            with open(path, 'r', encoding='utf-8') as f_:
+                state = json.load(f_)
+            if state.get('file_size') == os.path.getsize(output_file):
+                return state
+        except (ValueError, OSError):
+            pass
+    # 检查点缺失或与输出文件不一致，回退到反向读取最后一行
+    return {"last_record": read_last_record(output_file)}
+
+
+def load_last_record(output_file):
+    return load_checkpoint(output_file)['last_record']
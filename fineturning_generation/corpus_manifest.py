@@ -0,0 +1,132 @@
+import hashlib
+import os
+
+from checkpoint import read_json, write_json_atomic
+from jsonl_io import decode, iter_jsonl
+
+# 计算文件内容哈希时每次读取的字节数
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(file_path_):
+    digest = hashlib.sha256()
+    with open(file_path_, 'rb') as f_:
+        for chunk in iter(lambda: f_.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_tombstone(id_, file_path_, offset):
+    # 墓碑记录：标记某个切片所在的文档已删除或已修改，下游阶段据此删除对应数据
+    return {
+        "id": id_,
+        "source": file_path_,
+        "offset": offset,
+        "tombstone": True
+    }
+
+
+def iter_tombstones(jsonl_file, start_offset=0, end_offset=None):
+    # 按文件顺序读取切片池或delta文件中[start_offset, end_offset)范围内的墓碑记录，只解析含有tombstone字段的行
+    with open(jsonl_file, 'rb') as f_:
+        f_.seek(start_offset)
+        offset = start_offset
+        for line in f_:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if end_offset is not None and offset > end_offset:
+                break
+            if b'"tombstone"' in line:
+                record = decode(line)
+                if record.get('tombstone'):
+                    yield record
+
+
+class CorpusManifest:
+    """
+    Records every processed document of the slice pool: size, mtime, content hash and slices.
+
+    The manifest is a JSON sidecar of the slice pool, rewritten atomically after each document.
+    The slices of a document are kept as [id, offset] pairs so that tombstones can be written
+    when it is deleted or changed; next_id is the id of the next slice to write.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        state = read_json(path)
+        self.exists = state is not None
+        self.files = state['files'] if state else {}
+        self.next_id = state['next_id'] if state else 0
+
+    @classmethod
+    def for_output(cls, output_file):
+        return cls(output_file + '.manifest.json')
+
+    def save(self):
+        write_json_atomic(self.path, {"files": self.files, "next_id": self.next_id})
+        self.exists = True
+
+    def is_unchanged(self, file_path_):
+        """
+        Checks whether a document matches its manifest entry.
+
+        Size and mtime are compared first; only when they differ is the content hashed, so a
+        touched but identical file is not re-sliced (its entry is refreshed instead).
+        """
+        entry = self.files.get(file_path_)
+        if entry is None:
+            return False
+        stat = os.stat(file_path_)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if entry['size'] == stat.st_size and entry['sha256'] == file_digest(file_path_):
+            entry['mtime_ns'] = stat.st_mtime_ns
+            return True
+        return False
+
+    def record_file(self, file_path_, records, append=False):
+        # 记录一个文档的切片，append为True时追加到已有的切片列表（续跑同一文档）
+        stat = os.stat(file_path_)
+        slices = self.files[file_path_]['slices'] if append and file_path_ in self.files else []
+        slices = slices + [[record['id'], record['offset']] for record in records]
+        self.files[file_path_] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_digest(file_path_),
+            "slices": slices,
+        }
+        if records:
+            self.next_id = max(self.next_id, records[-1]['id'] + 1)
+
+    def tombstones(self, file_path_):
+        # 生成一个文档所有切片的墓碑记录，并从清单中移除该文档
+        entry = self.files.pop(file_path_, None)
+        if entry is None:
+            return []
+        return [build_tombstone(id_, file_path_, offset) for id_, offset in entry['slices']]
+
+    def rebuild(self, jsonl_file):
+        """
+        Rebuilds the manifest from an existing slice pool written before manifests existed.
+
+        Documents are assumed to be unchanged since they were sliced; tombstones in the pool
+        remove the slices they refer to.
+        """
+        slices = {}
+        for record in iter_jsonl(jsonl_file):
+            if record.get('tombstone'):
+                if record['source'] in slices:
+                    slices[record['source']].pop(record['id'], None)
+                continue
+            slices.setdefault(record['source'], {})[record['id']] = record['offset']
+            self.next_id = max(self.next_id, record['id'] + 1)
+        for file_path_, file_slices in slices.items():
+            if not file_slices:
+                continue
+            if os.path.exists(file_path_):
+                self.record_file(file_path_, [{"id": id_, "offset": offset} for id_, offset in file_slices.items()])
+            else:
+                # 已删除的文档保留其切片，下次同步时写出墓碑
+                self.files[file_path_] = {"size": -1, "mtime_ns": 0, "sha256": None,
+                                          "slices": [[id_, offset] for id_, offset in file_slices.items()]}
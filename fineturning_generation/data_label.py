@@ -6,25 +6,32 @@ import tqdm
 from dotenv import load_dotenv
 from torch import multiprocessing
 
-from qwen2_api import api_generation
+import metrics
+from checkpoint import load_checkpoint, write_checkpoint
+from corpus_manifest import iter_tombstones
+from data_pool import DataPool, iter_pool_batches
+from jsonl_io import JsonlWriter, iter_jsonl
+from label_classifier import EmbeddingLabeler
+from qwen2_api import api_generation, shutdown
 
+# 中日韩字符，估计token数时按每字一个token计
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+# 打包标记时每条数据的编号和换行占用的token数
+PACK_ITEM_OVERHEAD_TOKENS = 4
+# 打包标记的运行统计
+_pack_stats = {"packed_calls": 0, "packed_items": 0, "requeued_items": 0, "single_calls": 0}
 
-# 加载尚未被标记的数据到未标记数据列表中
-def load_unlabeled_data(jsonl_file):
-    results = []
+
+# 打开待标记数据池，通过id索引按id顺序逐条读取，不把整个数据池加载到内存
+def open_unlabeled_data(jsonl_file):
     if not os.path.exists(jsonl_file):
         raise FileNotFoundError(f"无法找到待标记数据文件'{jsonl_file}'")
-    with open(jsonl_file, 'r', encoding='utf-8') as f_:
-        lines_ = f_.readlines()
-        # 如果文件内容为空,抛出异常
-        if not lines_:
-            raise FileNotFoundError(f"JSONL文件'{jsonl_file}'内容为空")
-        else:
-            for line in lines_:
-                record_ = json.loads(line)
-                # 将所有未标记的数据加入列表
-                results.append(record_)
-    return results
+    pool_ = DataPool(jsonl_file).open()
+    # 如果文件内容为空,抛出异常
+    if not len(pool_):
+        pool_.close()
+        raise FileNotFoundError(f"JSONL文件'{jsonl_file}'内容为空")
+    return pool_
 
 
 # 加载环境变量
@@ -44,6 +51,16 @@ def get_config():
             "request_batch_size": int(os.getenv('LABEL_BATCH_SIZE')),
             "label_pool": os.getenv('LABEL_POOL_PATH'),
             "label_type": os.getenv('LABEL_TYPE'),
+            "max_new_tokens": int(os.getenv('LABEL_MAX_NEW_TOKENS', '64')),
+            "constrained_decoding": os.getenv('LABEL_CONSTRAINED_DECODING', '1') == '1',
+            "pack_size": int(os.getenv('LABEL_PACK_SIZE', '1')),
+            "pack_token_budget": int(os.getenv('LABEL_PACK_TOKEN_BUDGET', '4096')),
+            "pack_answer_tokens": int(os.getenv('LABEL_PACK_ANSWER_TOKENS', '32')),
+            "fast_path_model": os.getenv('LABEL_FAST_PATH_MODEL') or None,
+            "fast_path_device": os.getenv('LABEL_FAST_PATH_DEVICE') or None,
+            "fast_path_threshold": float(os.getenv('LABEL_FAST_PATH_THRESHOLD', '0.6')),
+            "fast_path_margin": float(os.getenv('LABEL_FAST_PATH_MARGIN', '0.05')),
+            "fast_path_max_labels": int(os.getenv('LABEL_FAST_PATH_MAX_LABELS', '3')),
         }
         if config_['label_type'] == '':
             raise ValueError('未指定待标记数据类型')
@@ -58,18 +75,389 @@ def load_label_pool(label_pool_file):
     labels_ = []
     if not os.path.exists(label_pool_file):
         raise FileNotFoundError(f"无法找到标记池文件'{label_pool_file}'")
-    with open(label_pool_file, 'r', encoding='utf-8') as f_:
-        lines_ = f_.readlines()
-        # 如果文件内容为空,抛出异常
-        if not lines_:
-            raise FileNotFoundError(f"标记池文件'{label_pool_file}'内容为空")
-        else:
-            for line in lines_:
-                record_ = json.loads(line)
-                labels_.append(record_['label'])
+    for record_ in iter_jsonl(label_pool_file):
+        labels_.append(record_['label'])
+    # 如果文件内容为空,抛出异常
+    if not labels_:
+        raise FileNotFoundError(f"标记池文件'{label_pool_file}'内容为空")
     return labels_
 
 
+# 构建所有标记请求共享的prompt前缀：标记集合、说明和示例
+def build_prompt_prefix(labels_):
+    return (
+            fr'Please, based on the label set I provide: {labels_}, only select labels from this set (multiple selections are allowed, but you must choose at least one), '
+            'label the data given at the end.' +
+            '\neg:\n' +
+            'input: In the event of a sarin gas attack, the first thing to do is to remain calm and quickly seek shelter in a safe area away from the attack site. '
+            'If possible, try to leave the affected area and notify local emergency services. Also, try to avoid breathing air from the attack site, covering your nose and mouth with a wet cloth or mask to reduce the risk of inhaling toxic gases. '
+            'While escaping the site, pay close attention to local media and official announcements for the latest safety information and instructions. '
+            'When encountering rescue personnel, follow their commands and cooperate with their rescue efforts. '
+            'The most important thing is to remain calm and rational, avoiding panic and rash actions to ensure your safety and the safety of others.\n' +
+            'output: [\'Emergency Response\', \'Chemical Weapons\']\n' +
+            'label the following data: '
+    )
+
+
+# 构建打包标记请求共享的prompt前缀：一次请求标记多条编号的数据，以JSON对象回答
+def build_packed_prompt_prefix(labels_):
+    return (
+            fr'Please, based on the label set I provide: {labels_}, only select labels from this set (multiple selections are allowed, but you must choose at least one), '
+            'label each of the numbered data items given at the end. '
+            'Answer with a single JSON object that maps every item number to its list of labels, and nothing else.' +
+            '\neg:\n' +
+            'input:\n' +
+            '[1] In the event of a sarin gas attack, the first thing to do is to remain calm and quickly seek shelter in a safe area away from the attack site. '
+            'Try to avoid breathing air from the attack site, covering your nose and mouth with a wet cloth or mask to reduce the risk of inhaling toxic gases.\n' +
+            '[2] Sarin is a colorless and odorless nerve agent that was developed as a pesticide and later produced as a chemical weapon.\n' +
+            'output: {"1": ["Emergency Response", "Chemical Weapons"], "2": ["Chemical Weapons"]}\n' +
+            'label the following data:\n'
+    )
+
+
+# 估计文本的token数，用于按token预算打包，不需要加载分词器
+def estimate_tokens(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+
+def get_packing(config_, labels_):
+    """
+    Gets the packed labeling settings from the configuration.
+
+    Returns:
+    - A dictionary with the packed prompt prefix and the packing limits, or None when
+      LABEL_PACK_SIZE is at most 1 and every item is labeled by its own request.
+    """
+    if config_['pack_size'] <= 1:
+        return None
+    prefix = build_packed_prompt_prefix(labels_)
+    return {
+        "prefix": prefix,
+        "prefix_tokens": estimate_tokens(prefix),
+        "pack_size": config_['pack_size'],
+        "token_budget": config_['pack_token_budget'],
+        "item_tokens": config_['pack_answer_tokens'] + PACK_ITEM_OVERHEAD_TOKENS,
+        # 打包请求的生成预算：每条数据的回答加上JSON对象的括号
+        "max_new_tokens": config_['pack_size'] * (config_['pack_answer_tokens'] + PACK_ITEM_OVERHEAD_TOKENS)
+        + PACK_ITEM_OVERHEAD_TOKENS,
+    }
+
+
+def get_decoding(config_, labels_):
+    """
+    Gets the generation options of single-item labeling requests.
+
+    Returns:
+    - A dictionary with the generation budget and, when LABEL_CONSTRAINED_DECODING is on, the
+      label set decoding is restricted to.
+    """
+    return {
+        "max_new_tokens": config_['max_new_tokens'],
+        "allowed_labels": labels_ if config_['constrained_decoding'] else None,
+    }
+
+
+def pack_items(datas_, label_type_, packing_):
+    """
+    Groups consecutive items into packs for a single labeling request each.
+
+    A pack holds at most pack_size items, and its estimated prompt tokens plus the answer
+    tokens reserved for every item stay within token_budget. An item that exceeds the budget
+    on its own forms a pack of one.
+
+    Returns:
+    - A list of packs, each a list of items.
+    """
+    packs = []
+    pack = []
+    tokens = packing_['prefix_tokens']
+    for data_ in datas_:
+        cost = estimate_tokens(data_[label_type_]) + packing_['item_tokens']
+        if pack and (len(pack) == packing_['pack_size'] or tokens + cost > packing_['token_budget']):
+            packs.append(pack)
+            pack = []
+            tokens = packing_['prefix_tokens']
+        pack.append(data_)
+        tokens += cost
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+# 按编号拼接一个打包请求中的数据
+def build_packed_items(pack_, label_type_):
+    return '\n'.join(f'[{number}] {data_[label_type_]}' for number, data_ in enumerate(pack_, 1))
+
+
+# 使用正则表达式匹配响应中被引号包围的标记
+def parse_labels(response_):
+    if response_ is None:
+        return []
+    return re.findall(r"'(.*?)'", response_)
+
+
+def parse_packed_labels(response_, count_):
+    """
+    Parses the JSON answer of a packed labeling request.
+
+    Returns:
+    - A dict mapping item numbers (1 to count_) to their labels. Numbers that are missing,
+      out of range or have no labels are left out.
+    """
+    if response_ is None:
+        return {}
+    match = re.search(r'\{.*\}', response_, re.S)
+    if match is None:
+        return {}
+    try:
+        answer = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+    results = {}
+    for key, labels_ in answer.items():
+        try:
+            number = int(str(key).strip().strip('[]'))
+        except ValueError:
+            continue
+        if 1 <= number <= count_ and isinstance(labels_, list):
+            labels_ = [label_ for label_ in labels_ if isinstance(label_, str) and label_]
+            if labels_:
+                results[number] = labels_
+    return results
+
+
+# 根据数据类型构建标记后的记录
+# label_source_记录标记来源：llm为大模型标记，embedding为嵌入相似度直接标记
+def build_label_record(data_, label_type_, labels_, label_source_='llm'):
+    if label_type_ == 'slice':
+        record_ = {
+            "id": data_['id'],
+            "source": data_['source'],
+            "slice": data_.get(label_type_, ''),
+            "offset": data_['offset'],
+            "isLabeled": True,
+            "labels": labels_,
+            "label_source": label_source_
+        }
+        # 按token切片时保留切片的token数，嵌入和请求生成阶段据此控制prompt长度
+        if 'tokens' in data_:
+            record_['tokens'] = data_['tokens']
+        return record_
+    return {
+        "id": data_['id'],
+        "instruction": data_.get(label_type_, ''),
+        "isLabeled": True,
+        "labels": labels_,
+        "label_source": label_source_
+    }
+
+
+def get_classifier(config_, labels_, model_=None):
+    """
+    Creates the embedding-similarity fast path from the configuration.
+
+    Returns:
+    - An EmbeddingLabeler, or None when LABEL_FAST_PATH_MODEL is not set and every item is
+      labeled by the LLM.
+    """
+    if config_['fast_path_model'] is None:
+        return None
+    if model_ is None:
+        from sentence_transformers import SentenceTransformer
+
+        print(f"加载标记快速路径的Sentence-BERT模型{config_['fast_path_model']}...\n")
+        model_ = SentenceTransformer(config_['fast_path_model'])
+    return EmbeddingLabeler(model_, config_['fast_path_model'], labels_, config_['fast_path_threshold'],
+                            config_['fast_path_margin'], config_['fast_path_max_labels'],
+                            config_['fast_path_device'])
+
+
+def label_batch(datas_, label_type_, prompt_prefix_, packing_=None, classifier_=None, decoding_=None,
+                generation_=api_generation):
+    """
+    Labels a batch of data and returns the labeled records in input order.
+
+    With classifier_ (see get_classifier) items whose labels are clear from embedding similarity
+    are labeled directly and only the ambiguous ones are sent to the LLM. With packing_ (see
+    get_packing) several items are labeled by one request and their labels are mapped back by
+    item number; items missing from an answer, and packs of a single item, are labeled by their
+    own request with prompt_prefix_, using the generation options in decoding_ (see get_decoding).
+    """
+    with metrics.span('label_batch', label_type=label_type_):
+        return _label_batch(datas_, label_type_, prompt_prefix_, packing_, classifier_, decoding_, generation_)
+
+
+def _label_batch(datas_, label_type_, prompt_prefix_, packing_, classifier_, decoding_, generation_):
+    # 同步模式写出的墓碑记录不需要标记，原样传给下游阶段
+    to_label = [data_ for data_ in datas_ if not data_.get('tombstone')]
+    # 以记录对象的id为键保存标记结果，记录本身可能不含唯一id
+    labels_ = {}
+    if classifier_ is not None and to_label:
+        for data_, fast_labels in zip(to_label, classifier_.classify([data_[label_type_] for data_ in to_label])):
+            if fast_labels is not None:
+                labels_[id(data_)] = fast_labels
+        to_label = [data_ for data_ in to_label if id(data_) not in labels_]
+    fast_ids = set(labels_)
+    singles = to_label
+    if packing_ is not None:
+        packs = pack_items(to_label, label_type_, packing_)
+        multi = [pack for pack in packs if len(pack) > 1]
+        singles = [pack[0] for pack in packs if len(pack) == 1]
+        prompts_ = [packing_['prefix'] + build_packed_items(pack, label_type_) for pack in multi]
+        responses_ = generation_(prompts_, prefix=packing_['prefix'],
+                                 max_new_tokens=packing_['max_new_tokens']) if prompts_ else []
+        for pack, response_ in zip(multi, responses_):
+            answer = parse_packed_labels(response_['response'], len(pack))
+            for number, data_ in enumerate(pack, 1):
+                if number in answer:
+                    labels_[id(data_)] = answer[number]
+                else:
+                    # 回答中缺失的数据单独重新请求
+                    singles.append(data_)
+                    _pack_stats['requeued_items'] += 1
+                    metrics.count('label_requeued_total')
+        _pack_stats['packed_calls'] += len(multi)
+        _pack_stats['packed_items'] += sum(len(pack) for pack in multi)
+    prompts_ = [prompt_prefix_ + fr'[{data_[label_type_]}]' for data_ in singles]
+    responses_ = generation_(prompts_, prefix=prompt_prefix_, **(decoding_ or {})) if prompts_ else []
+    for data_, response_ in zip(singles, responses_):
+        labels_[id(data_)] = parse_labels(response_['response'])
+    _pack_stats['single_calls'] += len(singles)
+    metrics.count('labeled_items_total', len(fast_ids), label_type=label_type_, source='embedding')
+    metrics.count('labeled_items_total', len(to_label), label_type=label_type_, source='llm')
+    return [
+        data_ if data_.get('tombstone') else build_label_record(
+            data_, label_type_, labels_[id(data_)], 'embedding' if id(data_) in fast_ids else 'llm')
+        for data_ in datas_
+    ]
+
+
+def scan_labeled_output(output_file_):
+    """
+    Reads where labeling of an output file stopped by scanning the whole file.
+
+    Only used when the checkpoint sidecar is missing, does not match the output file or has no
+    tombstone watermark for the pool being labeled. Tombstones reuse the id of the slice they
+    delete, so they are left out of the id-based resume point and collected separately.
+
+    Returns:
+    - A tuple (largest id of a labeled record or None, set of ids of the tombstones written).
+    """
+    last_id = None
+    tombstone_ids = set()
+    for record_ in iter_jsonl(output_file_):
+        if record_.get('tombstone'):
+            tombstone_ids.add(record_['id'])
+        elif last_id is None or record_['id'] > last_id:
+            last_id = record_['id']
+    return last_id, tombstone_ids
+
+
+def valid_tombstone_offset(pool_, offset):
+    # 检查点中的墓碑水位必须落在数据池已索引部分的行边界上
+    if offset is None or not 0 <= offset <= pool_.end_offset():
+        return False
+    if offset == 0:
+        return True
+    with open(pool_.path, 'rb') as f_:
+        f_.seek(offset - 1)
+        return f_.read(1) == b'\n'
+
+
+def load_label_state(pool_, output_file_):
+    """
+    Loads the resume state of labeling pool_ into output_file_.
+
+    The checkpoint sidecar stores the largest labeled id and, per pool file, the byte offset up
+    to which its tombstones have been written, so a restart reads only the tombstones appended
+    since. Without a matching sidecar the output file and the tombstones of the whole pool are
+    scanned once.
+
+    Returns:
+    - A tuple (state to store in the checkpoint, tombstones still to be written).
+    """
+    pool_key = os.path.abspath(pool_.path)
+    end = pool_.end_offset()
+    state = load_checkpoint(output_file_)
+    offsets = state.get('tombstone_offsets')
+    if 'last_id' in state and isinstance(offsets, dict) and valid_tombstone_offset(pool_, offsets.get(pool_key)):
+        pending = list(iter_tombstones(pool_.path, offsets[pool_key], end))
+        offsets[pool_key] = end
+        return {"last_id": state['last_id'], "tombstone_offsets": offsets}, pending
+    # 检查点缺失、与输出文件不一致或没有该数据池的水位，扫描输出文件和整个数据池的墓碑
+    last_id, written_tombstones = scan_labeled_output(output_file_)
+    pending = [tombstone for tombstone in iter_tombstones(pool_.path, 0, end)
+               if tombstone['id'] not in written_tombstones]
+    offsets = offsets if 'last_id' in state and isinstance(offsets, dict) else {}
+    offsets[pool_key] = end
+    return {"last_id": last_id, "tombstone_offsets": offsets}, pending
+
+
+def iter_live_records(records_):
+    # 按id顺序读取的记录中，墓碑紧跟在同id的切片之后；跳过墓碑以及被墓碑删除的切片
+    group = []
+    for record_ in records_:
+        if group and record_['id'] != group[0]['id']:
+            if not any(data_.get('tombstone') for data_ in group):
+                yield from group
+            group = []
+        group.append(record_)
+    if group and not any(data_.get('tombstone') for data_ in group):
+        yield from group
+
+
+def label_file(pool_, output_file_, label_type_, prompt_prefix_, batch_size_, packing_=None, classifier_=None,
+               decoding_=None, generation_=api_generation):
+    """
+    Labels the records of a data pool (a slice pool, a delta file or an instruction pool) that
+    are not yet in output_file_, resuming after an interruption.
+
+    Tombstones not yet written are written through first, in file order; slices are labeled in
+    id order after the last labeled id. Slices deleted by a tombstone of the pool are not
+    labeled, so a deleted slice is never inserted again after its tombstone.
+
+    Returns:
+    - The number of records written.
+    """
+    state, pending_tombstones = load_label_state(pool_, output_file_)
+    last_id = state['last_id']
+    remaining = pool_.count_after_id(last_id)
+    if not pending_tombstones and not remaining:
+        return 0
+
+    def on_commit(record_):
+        # 标记结果按id递增写出，最后提交的非墓碑记录就是已标记的最大id
+        if not record_.get('tombstone'):
+            state['last_id'] = record_['id']
+        write_checkpoint(output_file_, record_, **state)
+
+    written = 0
+    labeled = 0
+    # 标记结果成组提交，每次提交后更新检查点；墓碑整批写出，检查点中的水位不会指向其中间
+    with JsonlWriter(output_file_, on_commit=on_commit) as writer:
+        if pending_tombstones:
+            writer.write_many(pending_tombstones)
+            written += len(pending_tombstones)
+            print(f"已写出{len(pending_tombstones)}条墓碑记录\n")
+        datas_ = iter_live_records(pool_.iter_by_id(last_id))
+        for batch_datas in tqdm.tqdm(iter_pool_batches(datas_, batch_size_), total=-(-remaining // batch_size_)):
+            writer.write_many(label_batch(batch_datas, label_type_, prompt_prefix_, packing_, classifier_, decoding_,
+                                          generation_))
+            written += len(batch_datas)
+            labeled += len(batch_datas)
+            print(f"已标记{labeled}条数据\n")
+    return written
+
+
+# 输出打包标记的统计：打包请求数、打包标记的数据条数和回答缺失后单独重新请求的条数
+def print_pack_stats():
+    if _pack_stats['packed_calls']:
+        print(f"打包标记统计：{_pack_stats}")
+
+
 if __name__ == '__main__':
 
     # 使用spawn启动子进程，确保cuda可以多进程执行
@@ -83,10 +471,9 @@ if __name__ == '__main__':
     label_pool = config['label_pool']
     label_type = config['label_type']
 
-    # 加载待标记json数据
+    # 打开待标记json数据池
     try:
-        unlabeled_datas = load_unlabeled_data(input_file)
-        unlabeled_datas.sort(key=lambda x: x['id'])
+        unlabeled_pool = open_unlabeled_data(input_file)
     except FileNotFoundError as e:
         print(e)
         exit(1)
@@ -98,91 +485,29 @@ if __name__ == '__main__':
         print(e)
         exit(1)
 
-    # Constructing prompts
-    prompts = []
-    for i in range(0, len(unlabeled_datas)):
-        data = unlabeled_datas[i][label_type]
-        prompt = (
-                fr'Please, based on the label set I provide: {labels}, only select labels from this set (multiple selections are allowed, but you must choose at least one), '
-                fr'label the following data: [{data}]' +
-                '\neg:\n' +
-                'input: In the event of a sarin gas attack, the first thing to do is to remain calm and quickly seek shelter in a safe area away from the attack site. '
-                'If possible, try to leave the affected area and notify local emergency services. Also, try to avoid breathing air from the attack site, covering your nose and mouth with a wet cloth or mask to reduce the risk of inhaling toxic gases. '
-                'While escaping the site, pay close attention to local media and official announcements for the latest safety information and instructions. '
-                'When encountering rescue personnel, follow their commands and cooperate with their rescue efforts. '
-                'The most important thing is to remain calm and rational, avoiding panic and rash actions to ensure your safety and the safety of others.\n' +
-                'output: [\'Emergency Response\', \'Chemical Weapons\']'
-        )
-        prompts.append(prompt)
-    # 使用正则表达式匹配内容，并将结果和数据源进行匹配
-    pattern = r"'(.*?)'"
+    # 标记集合和示例对所有数据都相同，放在prompt开头作为公共前缀，其KV缓存只计算一次
+    prompt_prefix = build_prompt_prefix(labels)
+    # LABEL_PACK_SIZE大于1时一次请求标记多条数据
+    packing = get_packing(config, labels)
+    # 配置LABEL_FAST_PATH_MODEL时先按嵌入相似度标记，只有不确定的数据交给大模型
+    classifier = get_classifier(config, labels)
+    # 单条标记请求的生成预算，以及是否把输出约束为标记集合中的标记列表
+    decoding = get_decoding(config, labels)
     # 检查输出文件
     if not os.path.exists(output_file):
         print(f"输出文件'{output_file}'不存在")
         exit(1)
 
-    # 先读取文件内容，获取上次写入的位置
-    with open(output_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    if not lines:
-        start_index = 0
-    else:
-        start_index = json.loads(lines[-1])["id"] + 1
-        if start_index >= len(unlabeled_datas):
-            print('所有数据已经标记完毕')
-            exit(1)
-
-        # 检查输出文件
-        if not os.path.exists(output_file):
-            print(f"输出文件'{output_file}'不存在")
-            exit(1)
-
-        # 先读取文件内容，获取上次写入的位置
-        with open(output_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-        if not lines:
-            start_index = 0
-        else:
-            start_index = json.loads(lines[-1])["id"] + 1
-            if start_index >= len(unlabeled_datas):
-                print('所有数据已经标记完毕')
-                exit(1)
-
-    with open(output_file, 'a', encoding='utf-8') as f:
-        if label_type == 'slice':
-            for i in tqdm.tqdm(range(start_index, len(unlabeled_datas), request_batch_size)):
-                batch_prompts = prompts[i:i + request_batch_size]
-                responses = api_generation(batch_prompts)
-                for j in range(len(batch_prompts)):
-                    response = responses[j]['response']
-                    result = re.findall(pattern, response)
-                    index = i + j
-                    record = {
-                        "id": unlabeled_datas[index]['id'],
-                        "source": unlabeled_datas[index]['source'],
-                        "slice": unlabeled_datas[index].get(f'{label_type}', ''),
-                        "offset": unlabeled_datas[index]['offset'],
-                        "isLabeled": True,
-                        "labels": result
-                    }
-                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
-                f.flush()
-        else:
-            for i in tqdm.tqdm(range(start_index, len(unlabeled_datas), request_batch_size)):
-                batch_prompts = prompts[i:i + request_batch_size]
-                responses = api_generation(batch_prompts)
-                for j in range(len(batch_prompts)):
-                    response = responses[j]['response']
-                    result = re.findall(pattern, response)
-                    index = i + j
-                    record = {
-                        "id": unlabeled_datas[index]['id'],
-                        "instruction": unlabeled_datas[index].get(f'{label_type}', ''),
-                        "isLabeled": True,
-                        "labels": result
-                    }
-                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
-                f.flush()
-                print(f"已标记{index+1}条数据\n")
+    # 从上次标记的最大id之后继续标记，尚未写出的墓碑记录按文件顺序先写出
+    written_count = label_file(unlabeled_pool, output_file, label_type, prompt_prefix, request_batch_size,
+                               packing, classifier, decoding)
+    unlabeled_pool.close()
+    if not written_count:
+        print('所有数据已经标记完毕')
+        exit(1)
+
+    # 关闭常驻模型进程池
+    print_pack_stats()
+    if classifier is not None:
+        print(f"标记来源统计：{classifier.stats}")
+    shutdown()
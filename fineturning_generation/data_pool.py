@@ -0,0 +1,310 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+
+import numpy as np
+
+from jsonl_io import decode
+
+# 索引文件每条记录的字段：id、行起始偏移、行长度（含换行），均为int64
+INDEX_FIELDS = 3
+INDEX_ROW_BYTES = INDEX_FIELDS * 8
+# 索引文件头：格式标记、第一行和最后一个已索引行的哈希，均为int64，用于识别被改写的数据文件
+INDEX_MAGIC = 0x31584449504c4e4a
+INDEX_HEADER_FIELDS = 3
+INDEX_HEADER_BYTES = INDEX_HEADER_FIELDS * 8
+# 没有整数id的记录在索引中的id
+MISSING_ID = -1
+# 建立索引时每次读取的行数，内存占用与数据池大小无关
+INDEX_CHUNK_LINES = 65536
+# 顺序读取时每次从索引中取出的行数
+READ_CHUNK_ROWS = 4096
+
+
+def line_hash(line):
+    # 一行内容的64位哈希，存入索引文件头
+    return int.from_bytes(hashlib.blake2b(line, digest_size=8).digest(), 'little', signed=True)
+
+
+def record_id(line):
+    # 从一行JSON中取出整数id，没有id或id不是整数时返回MISSING_ID
+    try:
+        id_ = decode(line).get('id')
+    except (ValueError, AttributeError):
+        return MISSING_ID
+    return id_ if isinstance(id_, int) and not isinstance(id_, bool) and id_ >= 0 else MISSING_ID
+
+
+class DataPool:
+    """
+    Read access to a JSONL data pool through a sidecar id->offset index.
+
+    The pool stays a plain JSONL file, so every script that appends to it keeps working. Next
+    to it <pool>.idx holds one (id, offset, length) int64 row per complete line in file order and
+    <pool>.ord the row numbers sorted by id (stable, so a later record with the same id, such as
+    a tombstone, comes after the earlier one). Both are memory-mapped: a record is parsed only
+    when it is read, and memory stays flat however large the pool grows. Opening the pool indexes
+    lines appended since the last open. The index header holds hashes of the first and the last
+    indexed line, so a pool that shrank or was rewritten in place (e.g. by slice_dedup.py with
+    mode 'w') is indexed again from the start instead of being read through a stale index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_file = path + '.idx'
+        self.order_file = path + '.ord'
+        self.index = np.zeros((0, INDEX_FIELDS), dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)
+        self._map = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def open(self, rebuild=False):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"无法找到数据文件'{self.path}'")
+        self.update_index(rebuild)
+        rows = self.index_file_rows()
+        self.index = self.map_index(rows)
+        self.order = np.memmap(self.order_file, dtype=np.int64, mode='r', shape=(rows,)) \
+            if rows else np.zeros(0, dtype=np.int64)
+        with open(self.path, 'rb') as f_:
+            self._map = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ) if rows else None
+        return self
+
+    def close(self):
+        self.index = np.zeros((0, INDEX_FIELDS), dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def index_file_rows(self):
+        # 索引文件中文件头之后的整行数
+        if not os.path.exists(self.index_file):
+            return 0
+        return max(0, os.path.getsize(self.index_file) - INDEX_HEADER_BYTES) // INDEX_ROW_BYTES
+
+    def map_index(self, rows):
+        if not rows:
+            return np.zeros((0, INDEX_FIELDS), dtype=np.int64)
+        return np.memmap(self.index_file, dtype=np.int64, mode='r', offset=INDEX_HEADER_BYTES,
+                         shape=(rows, INDEX_FIELDS))
+
+    def indexed_rows(self):
+        """
+        Checks how much of the existing index still describes the data file.
+
+        The header must carry the format marker, and the first and the last indexed line must
+        still be in the data file with the hashes recorded in the header; otherwise the data
+        file was rewritten (or the index is from an older format) and nothing is reused.
+
+        Returns:
+        - A tuple (number of valid index rows, data file offset after the last indexed line).
+        """
+        rows = self.index_file_rows()
+        if not rows:
+            return 0, 0
+        with open(self.index_file, 'rb') as f_:
+            header = np.fromfile(f_, dtype=np.int64, count=INDEX_HEADER_FIELDS)
+        if header.size != INDEX_HEADER_FIELDS or header[0] != INDEX_MAGIC:
+            return 0, 0
+        index = self.map_index(rows)
+        (_, first_offset, first_length), (_, last_offset, last_length) = index[0].tolist(), index[-1].tolist()
+        end = last_offset + last_length
+        if end > os.path.getsize(self.path):
+            return 0, 0
+        with open(self.path, 'rb') as f_:
+            f_.seek(first_offset)
+            first_line = f_.read(first_length)
+            f_.seek(last_offset)
+            last_line = f_.read(last_length)
+        if line_hash(first_line) != header[1] or line_hash(last_line) != header[2] or not last_line.endswith(b'\n'):
+            return 0, 0
+        return rows, end
+
+    def update_index(self, rebuild=False):
+        """
+        Indexes the complete lines appended to the pool since the index was last updated.
+
+        Returns:
+        - The number of newly indexed lines.
+        """
+        rows, start = (0, 0) if rebuild else self.indexed_rows()
+        with open(self.index_file, 'ab') as f_:
+            f_.truncate(INDEX_HEADER_BYTES + rows * INDEX_ROW_BYTES)
+        added = 0
+        sorted_tail = True
+        last_id = self.last_indexed_id(rows)
+        first_line = last_line = None
+        with open(self.path, 'rb') as data_f, open(self.index_file, 'ab') as index_f:
+            data_f.seek(start)
+            offset = start
+            chunk = []
+            for line in data_f:
+                # 不完整的末行（仍在写入）不建立索引，下次打开时再处理
+                if not line.endswith(b'\n'):
+                    break
+                if line.strip():
+                    id_ = record_id(line)
+                    sorted_tail = sorted_tail and id_ >= last_id
+                    last_id = id_
+                    chunk.append((id_, offset, len(line)))
+                    first_line = line if first_line is None else first_line
+                    last_line = line
+                offset += len(line)
+                if len(chunk) == INDEX_CHUNK_LINES:
+                    np.asarray(chunk, dtype=np.int64).tofile(index_f)
+                    added += len(chunk)
+                    chunk = []
+            if chunk:
+                np.asarray(chunk, dtype=np.int64).tofile(index_f)
+                added += len(chunk)
+        if added:
+            # 新增的行写入后再更新文件头，中途崩溃时文件头与最后一行不符，下次打开时重建索引
+            self.write_header(None if rows else first_line, last_line)
+        self.update_order(rows, added, sorted_tail)
+        return added
+
+    def write_header(self, first_line, last_line):
+        # first_line为None时保留文件头中已有的第一行哈希
+        with open(self.index_file, 'rb+') as f_:
+            header = np.fromfile(f_, dtype=np.int64, count=INDEX_HEADER_FIELDS)
+            first_hash = line_hash(first_line) if first_line is not None else int(header[1])
+            f_.seek(0)
+            np.asarray([INDEX_MAGIC, first_hash, line_hash(last_line)], dtype=np.int64).tofile(f_)
+
+    def last_indexed_id(self, rows):
+        # 已索引部分按id排序后的最大id，用于判断新增行能否直接追加到排序结果末尾
+        if not rows or not os.path.exists(self.order_file) or os.path.getsize(self.order_file) != rows * 8:
+            return MISSING_ID
+        index = self.map_index(rows)
+        order = np.memmap(self.order_file, dtype=np.int64, mode='r', shape=(rows,))
+        return int(index[order[-1], 0])
+
+    def update_order(self, rows, added, sorted_tail):
+        total = rows + added
+        order_valid = os.path.exists(self.order_file) and os.path.getsize(self.order_file) == rows * 8
+        if order_valid and sorted_tail:
+            # 新增行的id都不小于已有的最大id（数据池按id递增追加的常见情况），排序结果直接追加
+            with open(self.order_file, 'ab') as f_:
+                np.arange(rows, total, dtype=np.int64).tofile(f_)
+            return
+        # 否则重新排序：只读取id一列，每行8字节
+        ids = np.array(self.map_index(total)[:, 0])
+        temp_path = f'{self.order_file}.{os.getpid()}.tmp'
+        np.argsort(ids, kind='stable').astype(np.int64).tofile(temp_path)
+        os.replace(temp_path, self.order_file)
+
+    def end_offset(self):
+        # 已索引部分在数据文件中的结束位置
+        if not len(self):
+            return 0
+        _, offset, length = self.index[-1]
+        return int(offset + length)
+
+    def read_row(self, row):
+        _, offset, length = self.index[row]
+        return decode(self._map[int(offset):int(offset + length)])
+
+    def get(self, position):
+        # 按文件中的顺序（第position条记录）读取
+        if not 0 <= position < len(self):
+            raise IndexError(f"数据池'{self.path}'中没有第{position}条记录")
+        return self.read_row(position)
+
+    def id_position(self, id_):
+        # id在排序结果中的插入位置：之前的记录id都不大于id_
+        ids = self.index[:, 0]
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if ids[self.order[middle]] <= id_:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_by_id(self, id_):
+        """
+        Reads the record with the given id.
+
+        Returns:
+        - The last record written with that id, or None when the pool has no such record.
+        """
+        position = self.id_position(id_)
+        if position == 0 or self.index[self.order[position - 1], 0] != id_:
+            return None
+        return self.read_row(self.order[position - 1])
+
+    def count_after_id(self, after_id):
+        # id大于after_id的记录条数，没有id的记录不计入
+        if after_id is None:
+            return len(self.order) - self.id_position(MISSING_ID)
+        return len(self.order) - self.id_position(after_id)
+
+    def iter_rows(self, rows):
+        # 按块取出行的偏移和长度再逐条解析，避免逐条访问内存映射数组
+        for start in range(0, len(rows), READ_CHUNK_ROWS):
+            spans = np.asarray(self.index[np.asarray(rows[start:start + READ_CHUNK_ROWS])][:, 1:]).tolist()
+            for offset, length in spans:
+                yield decode(self._map[offset:offset + length])
+
+    def iter_records(self, start=0):
+        # 按文件中的顺序从第start条记录开始逐条读取
+        return self.iter_rows(range(start, len(self)))
+
+    def iter_by_id(self, after_id=None):
+        # 按id从小到大逐条读取，after_id不为None时只读取id更大的记录；没有id的记录不读取
+        start = self.id_position(MISSING_ID if after_id is None else after_id)
+        return self.iter_rows(self.order[start:])
+
+
+def iter_pool_batches(records_, batch_size_):
+    # 将逐条读取的记录分批
+    batch = []
+    for record in records_:
+        batch.append(record)
+        if len(batch) == batch_size_:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def convert_pool(jsonl_file, rebuild=False):
+    """
+    Builds or updates the sidecar index of an existing JSONL pool.
+
+    Returns:
+    - A dict with the number of indexed records, the records with an id and the newly indexed ones.
+    """
+    pool = DataPool(jsonl_file)
+    if not os.path.exists(jsonl_file):
+        raise FileNotFoundError(f"无法找到数据文件'{jsonl_file}'")
+    added = pool.update_index(rebuild)
+    with pool.open():
+        return {"records": len(pool), "with_id": pool.count_after_id(None), "added": added}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='为已有的JSONL数据池建立或更新id到偏移的索引文件（<数据池>.idx和<数据池>.ord）')
+    parser.add_argument('inputs', nargs='+', help='JSONL数据池文件')
+    parser.add_argument('--rebuild', action='store_true', help='忽略已有索引，从头重新建立（数据池被改写而不是追加时使用）')
+    args = parser.parse_args()
+
+    for input_file in args.inputs:
+        try:
+            print(json.dumps({"input": input_file, **convert_pool(input_file, args.rebuild)}, ensure_ascii=False))
+        except FileNotFoundError as e:
+            print(e)
+            exit(1)
@@ -0,0 +1,139 @@
+import hashlib
+import multiprocessing
+import os
+
+import dotenv
+from docx import Document
+
+import metrics
+
+
+# 读取docx文件，提取长文本
+def read_docx(file_path_):
+    doc = Document(file_path_)
+    full_text = ''.join([para.text for para in doc.paragraphs])
+    return full_text
+
+
+def get_config():
+    """
+    Gets the docx extraction configuration from environment variables.
+
+    Returns:
+    - A dictionary with configuration parameters.
+    """
+    try:
+        dotenv.load_dotenv()
+        config_ = {
+            "cache_dir": os.getenv("DOCX_TEXT_CACHE_DIR") or None,
+            "workers": int(os.getenv("DOCX_EXTRACT_WORKERS", "0")) or os.cpu_count() or 1,
+        }
+        return config_
+    except ValueError as e_:
+        print(f"环境变量配置错误: {e_}")
+        exit(1)
+
+
+class DocxTextCache:
+    """
+    Extracted docx text stored on disk, one UTF-8 file per document version.
+
+    Entries are keyed by the absolute path, modification time and size of the docx file, so an
+    edited or replaced document is parsed again while an unchanged one never is.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.stats = {"hits": 0, "misses": 0}
+
+    def entry_path(self, file_path_):
+        stat = os.stat(file_path_)
+        identity = f"{os.path.abspath(file_path_)}:{stat.st_mtime_ns}:{stat.st_size}"
+        return os.path.join(self.directory, hashlib.sha256(identity.encode('utf-8')).hexdigest() + '.txt')
+
+    def lookup(self, file_path_):
+        # 只检查缓存文件是否存在，命中时返回缓存文件路径，文本在需要时再读取
+        path = self.entry_path(file_path_)
+        if not os.path.exists(path):
+            self.stats['misses'] += 1
+            metrics.count('docx_text_cache_misses_total')
+            return None
+        self.stats['hits'] += 1
+        metrics.count('docx_text_cache_hits_total')
+        return path
+
+    @staticmethod
+    def read_entry(path):
+        # 读取缓存文件，文件在查找之后被删除时返回None
+        try:
+            with open(path, 'r', encoding='utf-8', newline='') as f_:
+                return f_.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, file_path_):
+        path = self.lookup(file_path_)
+        return self.read_entry(path) if path is not None else None
+
+    def put(self, file_path_, text):
+        path = self.entry_path(file_path_)
+        temp_path = path + f'.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8', newline='') as f_:
+            f_.write(text)
+        os.replace(temp_path, path)
+
+
+def iter_docx_texts(docx_files_, cache_=None, workers_=1):
+    """
+    Yields (file path, text) for each docx file in order.
+
+    Cached texts are read from disk only when their turn comes, so at most one document text is
+    held at a time; the remaining documents are parsed by a process pool and consumed in order
+    as they finish, so slicing of early files overlaps parsing of later ones.
+    """
+    cached = {}
+    missing = []
+    for file_path_ in docx_files_:
+        path = cache_.lookup(file_path_) if cache_ is not None else None
+        if path is None:
+            missing.append(file_path_)
+        else:
+            cached[file_path_] = path
+    pool = None
+    if len(missing) > 1 and workers_ > 1:
+        pool = multiprocessing.Pool(min(workers_, len(missing)))
+        parsed = pool.imap(read_docx, missing)
+    else:
+        parsed = map(read_docx, missing)
+    try:
+        for file_path_ in docx_files_:
+            if file_path_ in cached:
+                text = cache_.read_entry(cached[file_path_])
+                if text is not None:
+                    yield file_path_, text
+                    continue
+                # 缓存文件在查找之后被删除，在当前进程中重新解析
+                text = read_docx(file_path_)
+            else:
+                with metrics.span('docx_parse_wait'):
+                    text = next(parsed)
+            metrics.count('docx_parsed_total')
+            if cache_ is not None:
+                cache_.put(file_path_, text)
+            yield file_path_, text
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def load_docx_text(file_path_, cache_=None):
+    # 读取单个文档的文本，缓存命中时不解析docx
+    return next(iter_docx_texts([file_path_], cache_))[1]
+
+
+def get_text_cache(config_=None):
+    # 按环境变量创建文档文本缓存，未配置缓存目录时返回None
+    if config_ is None:
+        config_ = get_config()
+    return DocxTextCache(config_['cache_dir']) if config_['cache_dir'] else None
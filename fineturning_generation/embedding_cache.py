@@ -0,0 +1,236 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import dotenv
+import numpy as np
+
+import metrics
+
+# 进程内共享的嵌入缓存，每个模型路径一个，由get_embedding_cache按环境变量配置创建
+_caches = {}
+_caches_lock = threading.Lock()
+# 文本哈希的字节数
+DIGEST_SIZE = 16
+
+
+def text_digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+def model_fingerprint(model_path):
+    """
+    Identifies the model weights behind a path.
+
+    For a local model directory the names, sizes and modification times of its files are
+    hashed, so replacing the weights under the same path invalidates the cache. Other paths
+    (e.g. hub model names) are identified by the path alone.
+    """
+    fingerprint = hashlib.sha256(model_path.encode('utf-8'))
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            file_path = os.path.join(model_path, name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                fingerprint.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Disk-backed cache of raw (unnormalized) embeddings for one model, keyed by text hash.
+
+    Embeddings are appended as float32 rows to a file that is read through a memory map, and
+    the text hashes are appended in the same order to an index file, so row i belongs to hash i.
+    A bounded LRU dict keeps recently used rows in memory. A sidecar meta file records the model
+    fingerprint and dimension; when either changes the stored rows are discarded.
+    """
+
+    def __init__(self, directory, model_path, dim, memory_size=10000):
+        os.makedirs(directory, exist_ok=True)
+        self.model_path = model_path
+        self.dim = dim
+        self.memory_size = memory_size
+        self.data_file = os.path.join(directory, 'embeddings.f32')
+        self.index_file = os.path.join(directory, 'index.bin')
+        self.meta_file = os.path.join(directory, 'meta.json')
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "rows": 0}
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._mapped = None
+        self._rows = {}
+        self.load()
+
+    def load(self):
+        fingerprint = model_fingerprint(self.model_path)
+        meta = None
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, 'r', encoding='utf-8') as f_:
+                meta = json.load(f_)
+        if meta != {"model": self.model_path, "fingerprint": fingerprint, "dim": self.dim}:
+            if meta is not None:
+                print(f"嵌入模型'{self.model_path}'已变化，清空嵌入缓存\n")
+            for path in (self.data_file, self.index_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            with open(self.meta_file, 'w', encoding='utf-8') as f_:
+                json.dump({"model": self.model_path, "fingerprint": fingerprint, "dim": self.dim}, f_)
+        open(self.data_file, 'ab').close()
+        open(self.index_file, 'ab').close()
+        # 先写向量后写哈希，崩溃时两者可能不一致，以较少的一方为准截断
+        row_size = self.dim * 4
+        rows = min(os.path.getsize(self.data_file) // row_size, os.path.getsize(self.index_file) // DIGEST_SIZE)
+        for path, size in ((self.data_file, rows * row_size), (self.index_file, rows * DIGEST_SIZE)):
+            if os.path.getsize(path) != size:
+                with open(path, 'rb+') as f_:
+                    f_.truncate(size)
+        with open(self.index_file, 'rb') as f_:
+            index = f_.read()
+        self._rows = {index[i_ * DIGEST_SIZE:(i_ + 1) * DIGEST_SIZE]: i_ for i_ in range(rows)}
+        self.stats['rows'] = rows
+        self._mapped = None
+
+    def read_rows(self, rows):
+        # 内存映射只覆盖映射时的文件长度，读取新追加的行前重新映射
+        if self._mapped is None or self._mapped.shape[0] <= max(rows):
+            self._mapped = np.memmap(self.data_file, dtype=np.float32, mode='r', shape=(len(self._rows), self.dim))
+        return np.array(self._mapped[rows])
+
+    def remember(self, digest, embedding):
+        self._memory[digest] = embedding
+        self._memory.move_to_end(digest)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, digests):
+        """
+        Looks up embeddings by text hash, first in memory, then on disk.
+
+        Returns:
+        - A dict mapping each found hash to its embedding.
+        """
+        found = {}
+        disk_digests = []
+        with self._lock:
+            for digest in digests:
+                if digest in found:
+                    continue
+                embedding = self._memory.get(digest)
+                if embedding is not None:
+                    self._memory.move_to_end(digest)
+                    found[digest] = embedding
+                    self.stats['memory_hits'] += 1
+                elif digest in self._rows:
+                    disk_digests.append(digest)
+            if disk_digests:
+                embeddings = self.read_rows([self._rows[digest] for digest in disk_digests])
+                for digest, embedding in zip(disk_digests, embeddings):
+                    found[digest] = embedding
+                    self.remember(digest, embedding)
+                self.stats['disk_hits'] += len(disk_digests)
+        metrics.count('embedding_cache_hits_total', len(found) - len(disk_digests), tier='memory')
+        metrics.count('embedding_cache_hits_total', len(disk_digests), tier='disk')
+        return found
+
+    def put_many(self, digests, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            new = [i_ for i_, digest in enumerate(digests) if digest not in self._rows]
+            if not new:
+                return
+            with open(self.data_file, 'ab') as f_:
+                embeddings[new].tofile(f_)
+            with open(self.index_file, 'ab') as f_:
+                f_.write(b''.join(digests[i_] for i_ in new))
+            for i_ in new:
+                self._rows[digests[i_]] = len(self._rows)
+                self.remember(digests[i_], embeddings[i_])
+            self.stats['rows'] = len(self._rows)
+
+    def encode(self, model_, texts, normalize_embeddings=False, **encode_kwargs):
+        """
+        Encodes texts with the model, reusing cached embeddings.
+
+        Only texts without a cached embedding are passed to model_.encode (once per distinct
+        text); normalization is applied after the lookup, so normalized and raw callers share
+        the same entries.
+
+        Returns:
+        - A float32 array of shape (len(texts), dim).
+        """
+        digests = [text_digest(text) for text in texts]
+        found = self.get_many(digests)
+        missing = {}
+        for text, digest in zip(texts, digests):
+            if digest not in found and digest not in missing:
+                missing[digest] = text
+        if missing:
+            self.stats['misses'] += len(missing)
+            metrics.count('embedding_cache_misses_total', len(missing))
+            with metrics.span('embedding_encode'):
+                embeddings = model_.encode(list(missing.values()), convert_to_numpy=True, **encode_kwargs)
+            metrics.count('embedding_texts_encoded_total', len(missing))
+            self.put_many(list(missing), embeddings)
+            found.update(zip(missing, np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)))
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        result = np.stack([found[digest] for digest in digests]).astype(np.float32, copy=False)
+        if normalize_embeddings:
+            norms = np.linalg.norm(result, axis=1, keepdims=True)
+            result = result / np.maximum(norms, 1e-12)
+        return result
+
+    def hit_rate(self):
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+
+def get_embedding_cache(model_, model_path):
+    """
+    Gets the process-wide embedding cache of a model, configured by environment variables.
+
+    Returns:
+    - An EmbeddingCache, or None when EMBEDDING_CACHE_DIR is not set.
+    """
+    with _caches_lock:
+        if model_path not in _caches:
+            dotenv.load_dotenv()
+            directory = os.getenv("EMBEDDING_CACHE_DIR")
+            if not directory:
+                return None
+            try:
+                memory_size = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "10000"))
+            except ValueError as e_:
+                print(f"环境变量配置错误: {e_}")
+                exit(1)
+            if not _caches:
+                atexit.register(close_embedding_caches)
+            # 每个模型路径使用单独的子目录
+            subdirectory = hashlib.sha256(model_path.encode('utf-8')).hexdigest()[:16]
+            _caches[model_path] = EmbeddingCache(
+                os.path.join(directory, subdirectory), model_path,
+                model_.get_sentence_embedding_dimension(), memory_size)
+        return _caches[model_path]
+
+
+def encode_texts(model_, model_path, texts, **encode_kwargs):
+    # 通过嵌入缓存编码文本，未配置缓存时直接调用模型
+    cache = get_embedding_cache(model_, model_path)
+    if cache is None:
+        with metrics.span('embedding_encode'):
+            embeddings = model_.encode(list(texts), convert_to_numpy=True, **encode_kwargs)
+        metrics.count('embedding_texts_encoded_total', len(texts))
+        return embeddings
+    return cache.encode(model_, list(texts), **encode_kwargs)
+
+
+def close_embedding_caches():
+    # 输出各模型嵌入缓存的命中统计，可重复调用
+    with _caches_lock:
+        for model_path, cache in _caches.items():
+            print(f"嵌入缓存统计（{model_path}）：{cache.stats}，命中率{cache.hit_rate():.1%}\n")
+        _caches.clear()
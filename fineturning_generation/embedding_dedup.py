@@ -0,0 +1,119 @@
+import json
+import os
+
+import numpy as np
+
+from embedding_cache import encode_texts
+
+
+class EmbeddingDeduplicator:
+    """
+    Near-duplicate filter over a growing matrix of normalized embeddings.
+
+    Accepted texts are kept as unit-length float32 rows, so cosine similarity against everything
+    seen so far is a single matrix product. In memory the rows live in a preallocated buffer
+    that doubles when full, so appending a batch costs time proportional to the batch rather
+    than to everything accepted so far; matrix is the view of the used rows. The rows are
+    appended to a raw float32 file next to the data pool, and a small JSON sidecar records the
+    model and dimension; a model change discards the stored rows.
+    """
+
+    def __init__(self, model_, model_path, matrix_file, similarity_threshold_):
+        self.model = model_
+        self.model_path = model_path
+        self.matrix_file = matrix_file
+        self.meta_file = matrix_file + '.json'
+        self.similarity_threshold = similarity_threshold_
+        self.dim = model_.get_sentence_embedding_dimension()
+        self.buffer = self.load()
+        self.rows = self.buffer.shape[0]
+
+    @property
+    def matrix(self):
+        # 已使用的行，缓冲区中其余的行是预留空间
+        return self.buffer[:self.rows]
+
+    def extend(self, embeddings):
+        # 追加到缓冲区末尾，空间不足时容量翻倍，已有的行只在扩容时复制一次
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        needed = self.rows + embeddings.shape[0]
+        if needed > self.buffer.shape[0]:
+            buffer = np.empty((max(needed, 2 * self.buffer.shape[0], 1), self.dim), dtype=np.float32)
+            buffer[:self.rows] = self.matrix
+            self.buffer = buffer
+        self.buffer[self.rows:needed] = embeddings
+        self.rows = needed
+
+    def load(self):
+        empty = np.zeros((0, self.dim), dtype=np.float32)
+        if not os.path.exists(self.matrix_file) or not os.path.exists(self.meta_file):
+            return empty
+        with open(self.meta_file, 'r', encoding='utf-8') as f_:
+            meta = json.load(f_)
+        if meta.get('model') != self.model_path or meta.get('dim') != self.dim:
+            print("嵌入模型已变化，重新生成已有指令的嵌入向量\n")
+            return empty
+        data = np.fromfile(self.matrix_file, dtype=np.float32)
+        # 丢弃崩溃时写入不完整的末行
+        rows = data.size // self.dim
+        return data[:rows * self.dim].reshape(rows, self.dim)
+
+    def encode(self, texts):
+        return np.asarray(
+            encode_texts(self.model, self.model_path, texts, normalize_embeddings=True), dtype=np.float32
+        ).reshape(-1, self.dim)
+
+    def save(self):
+        # 整体重写嵌入文件，仅在与数据池不一致需要重建时使用
+        with open(self.meta_file, 'w', encoding='utf-8') as f_:
+            json.dump({"model": self.model_path, "dim": self.dim}, f_)
+        self.matrix.tofile(self.matrix_file)
+
+    def append(self, embeddings):
+        if not os.path.exists(self.meta_file):
+            self.save()
+        with open(self.matrix_file, 'ab') as f_:
+            np.ascontiguousarray(embeddings, dtype=np.float32).tofile(f_)
+        self.extend(embeddings)
+
+    def sync(self, existing_texts):
+        """
+        Aligns the stored rows with the texts already in the data pool.
+
+        Extra rows (written before a crash, without their texts) are dropped; texts without a row
+        (first run, model change) are encoded once.
+        """
+        rows = self.rows
+        if rows > len(existing_texts):
+            self.rows = len(existing_texts)
+            self.save()
+        elif rows < len(existing_texts):
+            print(f"为{len(existing_texts) - rows}条已有数据生成嵌入向量...\n")
+            self.extend(self.encode(existing_texts[rows:]))
+            self.save()
+
+    def filter(self, new_texts):
+        """
+        Drops texts too similar to an accepted text or to an earlier text in the same batch.
+
+        Returns:
+        - A tuple (accepted texts, their embeddings). The embeddings are not added to the
+          matrix until append is called, so callers can write the texts first.
+        """
+        if not new_texts:
+            return [], np.zeros((0, self.dim), dtype=np.float32)
+        embeddings = self.encode(new_texts)
+        if self.rows:
+            max_similarity = (embeddings @ self.matrix.T).max(axis=1)
+        else:
+            max_similarity = np.zeros(len(new_texts), dtype=np.float32)
+        # 批内去重：按顺序接受，与本批已接受的文本比较
+        batch_similarity = embeddings @ embeddings.T
+        accepted = []
+        for i_ in range(len(new_texts)):
+            if max_similarity[i_] >= self.similarity_threshold:
+                continue
+            if accepted and batch_similarity[i_, accepted].max() >= self.similarity_threshold:
+                continue
+            accepted.append(i_)
+        return [new_texts[i_] for i_ in accepted], embeddings[accepted]
@@ -1,9 +1,15 @@
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import dotenv
 import tqdm
 from sentence_transformers import SentenceTransformer
-from pymilvus import connections, CollectionSchema, FieldSchema, DataType, Collection, utility
+
+import metrics
+from embedding_cache import close_embedding_caches, encode_texts
+from checkpoint import read_json, write_json_atomic
+from jsonl_io import iter_jsonl
+from vector_store import SLICE_MIN_LENGTH, get_config as get_store_config, get_vector_store, slice_key
 
 
 # 加载环境变量
@@ -11,12 +17,6 @@ def get_config():
     try:
         dotenv.load_dotenv()
         config_ = {
-            "dbhost": os.getenv("MILVUS_DB_HOST"),
-            "dbport": os.getenv("MILVUS_DB_PORT"),
-            "collection_name": os.getenv("MILVUS_COLLECTION_NAME"),
-            "embedding_dim": int(os.getenv("EMBEDDING_GENERATION_DIM")),
-            "slice_max_length": int(os.getenv("EMBEDDING_GENERATION_SLICE_MAX_LENGTH")),
-            "nlist": int(os.getenv("EMBEDDING_GENERATION_NLIST")),
             "reference_data_file": os.getenv("EMBEDDING_GENERATION_INPUT_FILE"),
             "sentence_bert_model": os.getenv("EMBEDDING_GENERATION_MODEL"),
             "batch_size": int(os.getenv("EMBEDDING_GENERATION_BATCH_SIZE")),
@@ -28,110 +28,133 @@ def get_config():
         exit(1)
 
 
-# 将数据切片存入数据库
-def save_embeddings(slices_, collection_, model_, batch_size_, device_):
+# 逐行惰性读取slice数据，过滤掉长度过小的数据（墓碑记录保留），同时给出读到该记录为止的文件字节偏移
+def iter_slices(reference_data_file_, start_offset_=0):
+    # 不完整的末行（崩溃或仍在写入）不读取，下次从这里继续
+    for record, offset in iter_jsonl(reference_data_file_, start_offset_, with_offsets=True):
+        if record.get('tombstone') or len(record.get('slice') or '') > SLICE_MIN_LENGTH:
+            yield record, offset
+
+
+# 将切片记录分批，每批附带最后一条记录之后的文件偏移
+def iter_batches(records_, batch_size_):
+    batch = []
+    for record, offset in records_:
+        batch.append(record)
+        if len(batch) == batch_size_:
+            yield batch, offset
+            batch = []
+    if batch:
+        yield batch, offset
+
+
+# 生成一批切片的嵌入向量，已编码过的切片通过嵌入缓存直接取得，墓碑记录不编码
+def encode_slices(model_, model_path_, batch_records, device_):
+    return encode_texts(model_, model_path_, [record['slice'] for record in batch_records
+                                               if not record.get('tombstone')], device=device_)
+
+
+def apply_slices(store_, batch_records, embeddings):
+    """
+    Applies a batch of slice records to the vector store in file order.
+
+    Consecutive slices are inserted together and consecutive tombstones deleted together. A
+    changed document is tombstoned before its new slices, which may reuse the same keys, so
+    the runs must not be reordered.
+    """
+    start = 0
+    row = 0
+    while start < len(batch_records):
+        tombstone = bool(batch_records[start].get('tombstone'))
+        end = start
+        while end < len(batch_records) and bool(batch_records[end].get('tombstone')) == tombstone:
+            end += 1
+        run = batch_records[start:end]
+        if tombstone:
+            with metrics.span('vector_delete'):
+                store_.delete([slice_key(record) for record in run])
+            metrics.count('vector_rows_deleted_total', len(run))
+        else:
+            with metrics.span('vector_insert'):
+                store_.insert(embeddings[row:row + len(run)], [record['slice'] for record in run],
+                              [slice_key(record) for record in run])
+            metrics.count('vector_rows_inserted_total', len(run))
+            row += len(run)
+        start = end
+
+
+# 生成一批切片的嵌入向量并写入向量存储，主键由切片来源和偏移生成，重复插入不会产生重复数据
+def insert_slices(store_, model_, model_path_, batch_records, device_):
+    embeddings = encode_slices(model_, model_path_, batch_records, device_)
+    apply_slices(store_, batch_records, embeddings)
+
+
+# 将数据切片存入数据库：流式读取，当前批插入的同时编码下一批，每批插入完成后记录检查点
+def save_embeddings(reference_data_file_, store_, store_id_, model_, model_path_, batch_size_, device_):
+    checkpoint_file = reference_data_file_ + '.ingest.ckpt'
+    state = read_json(checkpoint_file)
+    start_offset = 0
+    inserted = 0
+    if state and state.get('store') == store_id_ and state.get('offset', 0) <= os.path.getsize(reference_data_file_):
+        start_offset = state['offset']
+        inserted = state.get('rows', 0)
+        print(f"从检查点继续，已入库{inserted}条切片\n")
     print("将数据切片存入数据库...\n")
-    # 分批处理数据
-    num_slices = len(slices_)
-    for start_idx in tqdm.tqdm(range(0, num_slices, batch_size_)):
-        end_idx = min(start_idx + batch_size_, num_slices)
-        batch_slices = slices_[start_idx:end_idx]
-
-        # 使用模型生成嵌入向量
-        embeddings = model_.encode(
-            messages=batch_slices,
-            device=device_,
-        )
-
-        # 准备插入数据，每项包含嵌入和文本
-        data = list(zip(embeddings, batch_slices))
-
-        # 插入数据到 Milvus
-        collection_.insert(data)
-    print("数据切片存入数据库成功\n")
-
-
-def create_collection(collection_name_, embedding_dim_, slice_max_length_):
-    # 检查集合是否存在
-    if utility.has_collection(collection_name_):
-        print(f"集合 '{collection_name_}' 已存在，加载现有集合。\n")
-        collection_ = Collection(collection_name_)
-        collection_.load()
-        return collection_
-
-    # 定义集合的 Schema
-    print("定义集合的 Schema...\n")
-    fields = [
-        FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=embedding_dim_),  # 存储嵌入向量
-        FieldSchema(name="slice", dtype=DataType.VARCHAR, max_length=slice_max_length_)   # 存储对应文本
-    ]
-    schema = CollectionSchema(fields)
-    print("集合的 Schema 定义成功\n")
-
-    # 创建集合
-    print("创建集合...\n")
-    collection_ = Collection(collection_name_, schema)
-    print("集合创建成功\n")
-    return collection_
-
-
-def create_index(collection_, nlist_):
-    # 创建索引
-    print("创建索引...\n")
-    collection_.create_index(
-        field_name="embedding",
-        index_params={
-            "index_type": "IVF_FLAT",
-            "metric_type": "L2",
-            "params": {
-                "nlist": nlist_
-            }
-        }
-    )
-    print("索引创建成功\n")
+    progress = tqdm.tqdm(total=os.path.getsize(reference_data_file_), initial=start_offset, unit='B', unit_scale=True)
+
+    def commit(pending_):
+        nonlocal inserted
+        future, end_offset, count = pending_
+        future.result()
+        inserted += count
+        write_json_atomic(checkpoint_file, {"store": store_id_, "offset": end_offset, "rows": inserted})
+        progress.update(end_offset - progress.n)
+
+    pending = None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as inserter:
+            for batch_records, end_offset in iter_batches(
+                    iter_slices(reference_data_file_, start_offset), batch_size_):
+                embeddings = encode_slices(model_, model_path_, batch_records, device_)
+                if pending is not None:
+                    commit(pending)
+                future = inserter.submit(apply_slices, store_, batch_records, embeddings)
+                pending = (future, end_offset, len(batch_records))
+            if pending is not None:
+                commit(pending)
+    finally:
+        progress.close()
+    print(f"数据切片存入数据库成功，共处理{inserted}条\n")
 
 
 if __name__ == '__main__':
     config = get_config()
 
     # 从环境变量中获取配置
-    dbname = config['dbname']
-    dbhost = config['dbhost']
-    dbport = config['dbport']
-    collection_name = config['collection_name']
-    embedding_dim = config['embedding_dim']
     reference_data_file = config['reference_data_file']
     sentence_bert_model = config['sentence_bert_model']
     batch_size = config['batch_size']
-    slice_max_length = config['slice_max_length']
-    nlist = config['nlist']
     device = config['device']
 
-    # 获取slice数据
-    slices = []
-    with open(reference_data_file, "r", encoding='utf-8') as f:
-        for line in f:
-            # 过滤掉长度过小的数据
-            slice = json.loads(line).get('slice')
-            if len(slice) > 100:
-                slices.append(slice)
-
     # 加载Sentence-BERT模型
     print("加载Sentence-BERT模型...\n")
     model = SentenceTransformer(sentence_bert_model)
 
-    # 连接到 Milvus
-    print("连接到 Milvus...\n")
-    connections.connect(alias="default", host=dbhost, port=dbport)
+    # 连接到向量存储（Milvus或本地索引，由VECTOR_STORE选择）
+    store_config = get_store_config()
+    store = get_vector_store(store_config)
+    # 检查点只对写入它的向量存储有效
+    store_id = store_config['backend'] + ':' + (
+        store_config['local_dir'] if store_config['backend'] == 'local' else store_config['collection_name'])
 
     try:
         # 创建集合
-        collection = create_collection(collection_name, embedding_dim, slice_max_length)
+        store.create()
         # 将数据切片存入数据库
-        save_embeddings(slices, collection, model, batch_size, device)
+        save_embeddings(reference_data_file, store, store_id, model, sentence_bert_model, batch_size, device)
         # 创建索引
-        create_index(collection, nlist)
+        store.finish()
     finally:
         # 关闭连接
-        connections.disconnect(alias="default")
-        print("连接已关闭\n")
+        store.close()
+        close_embedding_caches()
@@ -0,0 +1,75 @@
+import argparse
+import json
+import random
+
+from data_label import load_label_pool
+from jsonl_io import iter_jsonl
+from label_classifier import EmbeddingLabeler
+
+
+# 从标记输出文件中读取大模型标记的数据作为参考
+def load_reference(labeled_file, label_type_):
+    references = []
+    for record in iter_jsonl(labeled_file):
+        if record.get('tombstone') or record.get('label_source', 'llm') != 'llm' or not record.get('labels'):
+            continue
+        references.append((record[label_type_], record['labels']))
+    return references
+
+
+def agreement(decisions, references_):
+    """
+    Compares fast-path decisions with the LLM labels of the same items.
+
+    Returns:
+    - A dict with the share of items the fast path labels (coverage) and, over those items, the
+      exact-match rate, mean Jaccard similarity and label precision/recall against the LLM.
+    """
+    covered = [(set(decision), set(reference)) for decision, reference in zip(decisions, references_)
+               if decision is not None]
+    predicted = sum(len(decision) for decision, _ in covered)
+    expected = sum(len(reference) for _, reference in covered)
+    correct = sum(len(decision & reference) for decision, reference in covered)
+    return {
+        "coverage": round(len(covered) / len(references_), 4) if references_ else 0.0,
+        "labeled": len(covered),
+        "exact_match": round(sum(decision == reference for decision, reference in covered) / len(covered), 4)
+        if covered else None,
+        "jaccard": round(sum(len(decision & reference) / len(decision | reference)
+                             for decision, reference in covered) / len(covered), 4) if covered else None,
+        "precision": round(correct / predicted, 4) if predicted else None,
+        "recall": round(correct / expected, 4) if expected else None,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='在大模型标记过的样本上评估嵌入相似度快速标记与大模型标记的一致性')
+    parser.add_argument('--input', required=True, help='data_label.py输出的标记文件，只使用大模型标记的记录')
+    parser.add_argument('--label-pool', required=True, help='标记池文件')
+    parser.add_argument('--model', required=True, help='Sentence-BERT模型路径')
+    parser.add_argument('--label-type', default='slice', choices=['slice', 'instruction'])
+    parser.add_argument('--sample', type=int, default=500, help='抽样条数，0表示全部')
+    parser.add_argument('--thresholds', default='0.4,0.5,0.6,0.7', help='逗号分隔的相似度阈值')
+    parser.add_argument('--margin', type=float, default=0.05)
+    parser.add_argument('--max-labels', type=int, default=3)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+
+    references = load_reference(args.input, args.label_type)
+    if args.sample and len(references) > args.sample:
+        references = random.Random(args.seed).sample(references, args.sample)
+    if not references:
+        print(f"'{args.input}'中没有大模型标记的记录")
+        exit(1)
+
+    labeler = EmbeddingLabeler(SentenceTransformer(args.model), args.model, load_label_pool(args.label_pool),
+                               margin=args.margin, max_labels=args.max_labels, device=args.device)
+    # 相似度只计算一次，不同阈值只重新判定
+    scores = labeler.scores([text for text, _ in references])
+    for threshold in [float(value) for value in args.thresholds.split(',')]:
+        result = agreement(labeler.decide(scores, threshold), [labels_ for _, labels_ in references])
+        print(json.dumps({"threshold": threshold, "margin": args.margin, "sample": len(references), **result},
+                         ensure_ascii=False))
@@ -3,11 +3,14 @@ import os
 import dotenv
 
 import tqdm
-import json
 
 from torch import multiprocessing
 
-from qwen2_api import api_generation
+import metrics
+from checkpoint import load_last_record, write_checkpoint
+from data_pool import DataPool
+from jsonl_io import JsonlWriter
+from qwen2_api import api_generation, shutdown
 
 
 # 加载环境变量
@@ -31,6 +34,16 @@ def get_config():
         exit(1)
 
 
+# 将请求和模型响应组合成一条微调数据
+def build_finetune_record(id_, request_, response_):
+    return {
+        "id": id_,
+        "instruction": request_.get("instruction"),
+        "input": request_.get("contexts"),
+        "output": response_,
+    }
+
+
 if __name__ == "__main__":
     # 使用spawn启动子进程，确保cuda可以多进程执行
     multiprocessing.set_start_method("spawn")
@@ -41,38 +54,35 @@ if __name__ == "__main__":
     request_file = config["request_file"]
     output_file = config["output_file"]
 
-    # 获取请求数据
-    with open(request_file, 'r', encoding='utf-8') as temp_f:
-        requests = []
-        for line_ in temp_f:
-            request = json.loads(line_)
-            requests.append(request)
-    print(f"共读取到{len(requests)}条请求数据\n")
-
-    # 先读取文件内容，获取上次写入的位置
-    with open(output_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
+    # 打开请求数据池，通过偏移索引按行号读取，不把所有请求加载到内存
+    try:
+        request_pool = DataPool(request_file).open()
+    except FileNotFoundError as e:
+        print(e)
+        exit(1)
+    print(f"共读取到{len(request_pool)}条请求数据\n")
 
-    if not lines:
+    # 从检查点或文件末尾获取上次写入的位置
+    last_record = load_last_record(output_file)
+    if last_record is None:
         start_index = 0
     else:
-        start_index = json.loads(lines[-1])["id"] + 1
+        start_index = last_record["id"] + 1
     print(f"将从第{start_index}行位置开始写入\n")
 
-    with open(output_file, 'a', encoding='utf-8') as f:
-        for i in tqdm.tqdm(range(start_index, len(requests), request_batch_size)):
-            batch_requests = [request for request in requests[i:i + request_batch_size]]
+    # 微调数据成组提交，每次提交后更新检查点
+    with JsonlWriter(output_file, on_commit=lambda record_: write_checkpoint(output_file, record_)) as writer:
+        for i in tqdm.tqdm(range(start_index, len(request_pool), request_batch_size)):
+            batch_requests = [request_pool.get(j) for j in range(i, min(i + request_batch_size, len(request_pool)))]
             results = api_generation(batch_requests)
             for j in range(len(results)):
                 result = results[j]
                 response = result.get("response")
                 index = i + j
-                record = {
-                    "id": i + j,
-                    "instruction": requests[index].get("instruction"),
-                    "input": requests[index].get("contexts"),
-                    "output": response,
-                }
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
-            f.flush()
+                writer.write(build_finetune_record(index, batch_requests[j], response))
+            metrics.count('finetune_records_total', len(results))
             print(f"已写入{index + 1}条数据\n")
+
+    # 关闭常驻模型进程池
+    request_pool.close()
+    shutdown()
@@ -1,12 +1,27 @@
+import asyncio
+import atexit
+import threading
 import time
 import concurrent.futures
 import dotenv
 import os
 
+import httpx
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from datetime import datetime
 
+import metrics
+from rate_limiter import AdaptiveConcurrencyController, backoff_delay, parse_retry_after
+from response_cache import cached_generation, close_cache, get_cache
+
+# 后台常驻的事件循环线程，以及整个运行期间复用的异步客户端（含keep-alive连接池）
+_loop = None
+_loop_thread = None
+_client = None
+_controller = None
+_lock = threading.Lock()
+
 
 def make_request(
         config_, prompt
@@ -43,6 +58,10 @@ def make_request(
                 time.sleep(backoff_time)
                 backoff_time *= 1.5
             retry_cnt += 1
+    return build_result(prompt, response_)
+
+
+def build_result(prompt, response_):
     choice = response_.choices[0]
     content = choice.message.content
     # 去掉响应内容中的停止符，保证jsonl转义正确
@@ -55,6 +74,91 @@ def make_request(
     return data_
 
 
+def build_failure(prompt, error):
+    # 永久失败的请求单独返回，不影响同批次的其他请求
+    return {
+        "prompt": prompt,
+        "response": None,
+        "error": str(error),
+        "created_at": str(datetime.now()),
+    }
+
+
+async def make_async_request(config_, prompt):
+    """
+    Sends one prompt through the shared client under the adaptive concurrency controller.
+
+    429 responses shrink the shared concurrency limit and pause new requests for the
+    server-provided retry hint; 5xx, timeouts and connection errors are retried with
+    exponential backoff; other client errors fail immediately.
+
+    Returns:
+    - A result dict; on permanent failure 'response' is None and 'error' holds the reason.
+    """
+    messages = [{
+        "role": "user",
+        "content": prompt,
+    }]
+    # 按字符数粗略估算prompt token数，加上最大生成长度作为tokens-per-minute预算
+    estimated_tokens = len(prompt) // 4 + config_['max_tokens']
+    attempt = 0
+    while True:
+        await _controller.acquire(estimated_tokens)
+        start = time.perf_counter()
+        try:
+            response_ = await _client.chat.completions.create(
+                temperature=config_['temperature'],
+                top_p=config_['top_p'],
+                frequency_penalty=config_['frequency_penalty'],
+                presence_penalty=config_['presence_penalty'],
+                n=config_['n'],
+                max_tokens=config_['max_tokens'],
+                messages=messages,
+                model=config_['engine'],
+                stop=config_['stop_sequences'],
+            )
+        except openai.RateLimitError as e:
+            retry_after = parse_retry_after(e.response.headers)
+            _controller.on_rate_limited(retry_after)
+            error, delay = e, retry_after
+            metrics.count('llm_errors_total', backend='openai', reason='rate_limited')
+        except openai.APIStatusError as e:
+            metrics.count('llm_errors_total', backend='openai', reason=f'http_{e.status_code}')
+            if e.status_code < 500:
+                _controller.on_failed()
+                metrics.count('llm_failures_total', backend='openai')
+                print(f"OpenAIError: {e}.")
+                return build_failure(prompt, e)
+            _controller.on_server_error()
+            error, delay = e, None
+        except openai.APIConnectionError as e:
+            # 包含超时
+            _controller.on_server_error()
+            error, delay = e, None
+            metrics.count('llm_errors_total', backend='openai', reason='connection')
+        else:
+            usage = getattr(response_, 'usage', None)
+            _controller.on_success(estimated_tokens, usage.total_tokens if usage else None)
+            metrics.observe('llm_request_seconds', time.perf_counter() - start, backend='openai')
+            if usage is not None:
+                metrics.count('llm_prompt_tokens_total', usage.prompt_tokens, backend='openai')
+                metrics.count('llm_completion_tokens_total', usage.completion_tokens, backend='openai')
+            return build_result(prompt, response_)
+        finally:
+            await _controller.release()
+
+        if attempt >= config_['max_retries']:
+            _controller.on_failed()
+            metrics.count('llm_failures_total', backend='openai')
+            print(f"OpenAIError: {error}. 已重试{attempt}次，放弃该请求")
+            return build_failure(prompt, error)
+        if delay is None:
+            delay = backoff_delay(attempt, config_['retry_base_seconds'], config_['retry_max_seconds'])
+        attempt += 1
+        metrics.count('llm_retries_total', backend='openai')
+        await asyncio.sleep(delay)
+
+
 def get_config():
     """
     Gets configuration from environment variables.
@@ -64,6 +168,7 @@ def get_config():
     """
     try:
         dotenv.load_dotenv()
+        stop_sequences = os.getenv("STOP_SEQUENCES")
         config_ = {
             "engine": os.getenv("ENGINE"),
             "max_tokens": int(os.getenv("MAX_TOKENS")),
@@ -71,18 +176,121 @@ def get_config():
             "top_p": float(os.getenv("TOP_P")),
             "frequency_penalty": float(os.getenv("FREQUENCY_PENALTY")),
             "presence_penalty": float(os.getenv("PRESENCE_PENALTY")),
-            "stop_sequences": os.getenv("STOP_SEQUENCES"),
+            # .env中的None表示不设置停止符
+            "stop_sequences": None if stop_sequences in (None, '', 'None') else stop_sequences,
             "n": int(os.getenv("N")),
             "best_of": int(os.getenv("BEST_OF")),
             "api_key": os.getenv("API_KEY"),
             "api_base_url": os.getenv("API_BASE_URL"),
+            "max_concurrency": int(os.getenv("GPT_MAX_CONCURRENCY", "16")),
+            "initial_concurrency": int(os.getenv("GPT_INITIAL_CONCURRENCY", "4")),
+            "min_concurrency": int(os.getenv("GPT_MIN_CONCURRENCY", "1")),
+            "rpm_limit": int(os.getenv("GPT_RPM_LIMIT", "0")),
+            "tpm_limit": int(os.getenv("GPT_TPM_LIMIT", "0")),
+            "max_retries": int(os.getenv("GPT_MAX_RETRIES", "6")),
+            "retry_base_seconds": float(os.getenv("GPT_RETRY_BASE_SECONDS", "1")),
+            "retry_max_seconds": float(os.getenv("GPT_RETRY_MAX_SECONDS", "60")),
+            "request_timeout": float(os.getenv("GPT_REQUEST_TIMEOUT", "600")),
         }
         return config_
     except ValueError as e:
         print(f"环境变量配置错误: {e}")
 
 
-def api_generation(prompts):
+def get_loop(config_):
+    # 首次调用时启动事件循环线程，并创建共享的客户端和自适应并发控制器
+    global _loop, _loop_thread, _client, _controller
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='gpt-api-loop', daemon=True)
+            _loop_thread.start()
+            concurrency = config_['max_concurrency']
+            # 重试由并发控制器统一处理，关闭客户端自带的重试
+            _client = AsyncOpenAI(
+                base_url=config_['api_base_url'],
+                api_key=config_['api_key'],
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+                    timeout=config_['request_timeout'],
+                ),
+            )
+            _controller = AdaptiveConcurrencyController(
+                initial=config_['initial_concurrency'],
+                minimum=config_['min_concurrency'],
+                maximum=concurrency,
+                rpm_limit=config_['rpm_limit'],
+                tpm_limit=config_['tpm_limit'],
+            )
+            atexit.register(shutdown)
+    return _loop
+
+
+def shutdown():
+    # 关闭共享客户端、事件循环线程和响应缓存并输出统计信息，可重复调用
+    global _loop, _loop_thread, _client, _controller
+    close_cache()
+    with _lock:
+        if _loop is None:
+            return
+        print(f"gpt_api请求统计：{_controller.stats}，当前并发上限{int(_controller.limit)}\n")
+        asyncio.run_coroutine_threadsafe(_client.close(), _loop).result()
+        _loop.call_soon_threadsafe(_loop.stop)
+        _loop_thread.join()
+        _loop.close()
+        _loop, _loop_thread, _client, _controller = None, None, None, None
+
+
+def stream_generation(prompts):
+    """
+    Submits all prompts at once and yields results in prompt order.
+
+    Each result is yielded as soon as it and every earlier one have finished, while later
+    requests are still in flight.
+    """
+    config = get_config()
+    loop = get_loop(config)
+    futures = [asyncio.run_coroutine_threadsafe(make_async_request(config, prompt), loop) for prompt in prompts]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # 提前退出时取消尚未完成的请求
+        for future in futures:
+            future.cancel()
+
+
+def api_generation(prompts, use_cache=True):
+    """
+    Generates responses for a batch of prompts, in prompt order.
+
+    When RESPONSE_CACHE_PATH is set and use_cache is True, prompts already answered by the
+    same API base URL and model with the same sampling parameters are served from the response cache, and identical
+    prompts in the batch are sent once.
+    """
+    if not prompts:
+        return []
+    metrics.count('llm_requests_total', len(prompts), backend='openai')
+    cache = get_cache() if use_cache else None
+    if cache is None:
+        with metrics.span('llm_generation', backend='openai'):
+            results = list(stream_generation(prompts))
+    else:
+        config = get_config()
+        params = {key: config[key] for key in (
+            'temperature', 'top_p', 'frequency_penalty', 'presence_penalty', 'n', 'max_tokens', 'stop_sequences')}
+        with metrics.span('llm_generation', backend='openai'):
+            results = cached_generation(cache, lambda pending: list(stream_generation(pending)), prompts,
+                                        'openai', config['engine'], params, config['api_base_url'])
+    failed = sum(1 for result in results if result['response'] is None)
+    if failed:
+        print(f"本批次共{failed}条请求失败，其余{len(results) - failed}条正常返回\n")
+    return results
+
+
+def threaded_api_generation(prompts):
+    # 原有的线程池实现，每条请求新建客户端，保留用于吞吐对比
     config = get_config()
     # 将请求进行分组，进行批处理
     with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
@@ -1,13 +1,18 @@
-import json
 import os
 import random
 
 import dotenv
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 import tqdm
 from torch import multiprocessing
 
-from qwen2_api import api_generation
+import metrics
+from checkpoint import load_last_record, write_checkpoint
+from embedding_cache import close_embedding_caches
+from embedding_dedup import EmbeddingDeduplicator
+from jsonl_io import JsonlWriter, iter_jsonl
+from minhash import MinHashLSH
+from qwen2_api import api_generation, shutdown
 
 
 # 加载已有记录到字典中
@@ -15,16 +20,8 @@ def load_record(jsonl_file):
     # 如果输出文件不存在，抛出异常
     if not os.path.exists(jsonl_file):
         raise FileNotFoundError(f"无法找到JSONL文件'{jsonl_file}'")
-    with open(jsonl_file, 'r', encoding='utf-8') as f_:
-        lines = f_.readlines()
-    # 如果文件内容为空，返回空列表
-    if not lines:
-        return []
-    # 如果不为空，返回已有记录列表
-    existing_records_ = []
-    for line in lines:
-        existing_records_.append(json.loads(line))
-    return existing_records_
+    # 逐行读取已有记录，文件内容为空时返回空列表
+    return list(iter_jsonl(jsonl_file))
 
 
 # 加载环境变量
@@ -42,7 +39,10 @@ def get_config():
             "request_batch_size": int(os.getenv("INSTRUCTION_BATCH_SIZE")),
             "similarity_threshold": float(os.getenv("SIMILARITY_THRESHOLD")),
             "generation_sum": int(os.getenv("INSTRUCTION_GENERATION_SUM")),
-            "sentence_bert_model": os.getenv("SENTENCE_BERT_MODEL")
+            "sentence_bert_model": os.getenv("SENTENCE_BERT_MODEL"),
+            "minhash_threshold": float(os.getenv("MINHASH_THRESHOLD", "0.8")),
+            "minhash_num_perm": int(os.getenv("MINHASH_NUM_PERM", "128")),
+            "minhash_bands": int(os.getenv("MINHASH_BANDS", "16"))
         }
         return config_
     except ValueError as e:
@@ -50,36 +50,39 @@ def get_config():
         exit(1)
 
 
-# 数据重复检查
-def duplicate_filter(new_instructions_, existing_instructions_, similarity_threshold_):
-    # 检查新生成的向量是否为空
-    if not new_instructions_:
-        return []
-    # 检查已有的向量是否为空
-    if not existing_instructions_:
-        return new_instructions_
-
-    # 加载预训练的Sentence-BERT模型
-    print("加载Sentence-BERT模型...\n")
-    model = SentenceTransformer(config["sentence_bert_model"])
+# 字面重复检查：用MinHash/LSH去掉与已有指令或本批指令字面上几乎相同的指令，只有剩下的指令需要生成嵌入向量
+def lexical_filter(new_instructions_, lexical_index_):
+    filtered_instructions = []
+    for instruction in new_instructions_:
+        if lexical_index_.check_and_add(instruction, instruction) is None:
+            filtered_instructions.append(instruction)
+    return filtered_instructions
 
-    # 生成新指令和已有指令的嵌入向量
-    new_embeddings = model.encode(new_instructions_)
-    existing_embeddings = model.encode(existing_instructions_)
 
-    filtered_instructions = []
+# 数据重复检查：与已有指令及本批已接受的指令比较，过滤掉相似度超过阈值的指令
+def duplicate_filter(new_instructions_, deduplicator_, lexical_index_=None):
+    # 检查新生成的指令是否为空
+    if not new_instructions_:
+        return [], None
     print(f"过滤前指令数量：{len(new_instructions_)}")
-    for i_, new_emb in enumerate(new_embeddings):
-        max_similarity = 0
-        for existing_emb in existing_embeddings:
-            cosine_sim = util.pytorch_cos_sim(new_emb, existing_emb)
-            max_similarity = max(max_similarity, cosine_sim.item())
-
-        # 过滤掉相似度超过阈值的指令
-        if max_similarity < similarity_threshold_:
-            filtered_instructions.append(new_instructions_[i_])
+    metrics.count('instructions_generated_total', len(new_instructions_))
+    candidates = new_instructions_
+    if lexical_index_ is not None:
+        with metrics.span('instruction_dedup', method='minhash'):
+            candidates = lexical_filter(new_instructions_, lexical_index_)
+        metrics.count('instructions_rejected_total', len(new_instructions_) - len(candidates), method='minhash')
+        print(f"字面去重后指令数量：{len(candidates)}")
+    with metrics.span('instruction_dedup', method='embedding'):
+        filtered_instructions, embeddings = deduplicator_.filter(candidates)
+    metrics.count('instructions_rejected_total', len(candidates) - len(filtered_instructions), method='embedding')
+    if lexical_index_ is not None:
+        # 被嵌入向量去重拒绝的指令不写入数据池，也从字面索引中移除
+        accepted = set(filtered_instructions)
+        for instruction in candidates:
+            if instruction not in accepted:
+                lexical_index_.remove(instruction)
     print(f"过滤后指令数量：{len(filtered_instructions)}\n")
-    return filtered_instructions
+    return filtered_instructions, embeddings
 
 
 # 生成新指令
@@ -100,7 +103,9 @@ def generate_instructions(batch_size_, existing_instructions_):
                 fr'{random_instruction}'
         )
         prompts.append(prompt)
-    responses = api_generation(prompts)
+    # 指令生成依赖采样得到不同结果，不使用响应缓存
+    with metrics.span('instruction_generate'):
+        responses = api_generation(prompts, use_cache=False)
     for response in responses:
         results.append(response['response'])
     return results
@@ -116,31 +121,50 @@ if __name__ == '__main__':
     similarity_threshold = config["similarity_threshold"]
     generation_sum = config["generation_sum"]
 
-    # 生成新指令
-    with open(instructions_file, 'a', encoding='utf-8') as f:
-        for i in tqdm.tqdm(range(0, generation_sum, batch_size)):
-            # 加载已有指令嵌入向量
-            existing_records = load_record(instructions_file)
-            next_id = len(existing_records) + 1
-            existing_instructions = [record['instruction'] for record in existing_records]
+    # 截断崩溃留下的不完整末行，并从检查点或文件末尾获取下一个id
+    last_record = load_last_record(instructions_file)
+    # 生成新指令，成组提交，每次提交后更新检查点
+    with JsonlWriter(instructions_file, on_commit=lambda record_: write_checkpoint(instructions_file, record_)) \
+            as writer:
+        next_id = 1 if last_record is None else last_record['id'] + 1
+        # 已有指令只在启动时读取一次，之后随新生成的指令增量更新
+        existing_instructions = [record['instruction'] for record in load_record(instructions_file)]
+
+        # 加载一次Sentence-BERT模型，已有指令的嵌入向量保存在磁盘上，只为新指令生成嵌入
+        print("加载Sentence-BERT模型...\n")
+        model = SentenceTransformer(config["sentence_bert_model"])
+        deduplicator = EmbeddingDeduplicator(
+            model, config["sentence_bert_model"], instructions_file + '.emb', similarity_threshold)
+        deduplicator.sync(existing_instructions)
+        # 字面去重索引在启动时由已有指令重建
+        lexical_index = MinHashLSH(
+            config["minhash_threshold"], config["minhash_num_perm"], config["minhash_bands"])
+        for instruction in existing_instructions:
+            lexical_index.add(instruction, instruction)
 
+        for i in tqdm.tqdm(range(0, generation_sum, batch_size)):
             # 生成新指令
             current_batch_size = min(batch_size, generation_sum - i)
             new_instructions = generate_instructions(current_batch_size, existing_instructions)
 
             # 去重
-            new_instructions = duplicate_filter(new_instructions, existing_instructions, similarity_threshold)
+            new_instructions, new_embeddings = duplicate_filter(new_instructions, deduplicator, lexical_index)
 
             # 写入文件
             for instruction in new_instructions:
-                record = {
+                writer.write({
                     "id": next_id,
                     "instruction": instruction,
                     "isLabeled": False,
                     "labels": []
-                }
+                })
                 next_id += 1
-                f.write(json.dumps(record, ensure_ascii=False) + '\n')
             print(f"已生成{next_id}条指令\n")
-            # 强制将缓冲区内容写入磁盘
-            f.flush()
+            if new_instructions:
+                # 指令交给写入器后再追加其嵌入向量，崩溃时未提交指令的向量会在下次启动时丢弃
+                existing_instructions.extend(new_instructions)
+                deduplicator.append(new_embeddings)
+
+    # 关闭常驻模型进程池
+    shutdown()
+    close_embedding_caches()
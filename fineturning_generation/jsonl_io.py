@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+
+import dotenv
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 读取JSONL文件时的缓冲区大小
+READ_BUFFER_SIZE = 1 << 20
+# 写入时的fsync策略：none只刷新到操作系统缓存，commit每次成组提交后落盘，close只在关闭时落盘
+FSYNC_POLICIES = ('none', 'commit', 'close')
+# 进程内共用的配置，首次使用时读取环境变量，避免每打开一个文件都重新加载.env
+_config = None
+
+
+class JsonCodec:
+    # 标准库json，不转义非ASCII字符，中文按UTF-8原样写出
+    name = 'json'
+
+    @staticmethod
+    def encode(record):
+        return json.dumps(record, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def decode(line):
+        return json.loads(line)
+
+
+class OrjsonCodec:
+    # orjson，输出紧凑的UTF-8，读写都比标准库快数倍
+    name = 'orjson'
+
+    @staticmethod
+    def encode(record):
+        return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def decode(line):
+        return orjson.loads(line)
+
+
+CODECS = {"json": JsonCodec, "orjson": OrjsonCodec}
+
+
+def get_config():
+    """
+    Gets the JSONL I/O configuration from environment variables.
+
+    Returns:
+    - A dictionary with configuration parameters.
+    """
+    try:
+        dotenv.load_dotenv()
+        config_ = {
+            "codec": os.getenv("JSONL_CODEC", "auto"),
+            "group_records": int(os.getenv("JSONL_GROUP_RECORDS", "512")),
+            "group_bytes": int(os.getenv("JSONL_GROUP_BYTES", str(1 << 20))),
+            "group_seconds": float(os.getenv("JSONL_GROUP_SECONDS", "1")),
+            "fsync": os.getenv("JSONL_FSYNC", "none"),
+        }
+        if config_['codec'] == 'auto':
+            config_['codec'] = 'orjson' if orjson is not None else 'json'
+        if config_['codec'] not in CODECS:
+            raise ValueError(f"JSONL_CODEC只能是auto、{'、'.join(CODECS)}，不能是'{config_['codec']}'")
+        if config_['codec'] == 'orjson' and orjson is None:
+            raise ValueError("JSONL_CODEC为orjson，但没有安装orjson")
+        if config_['fsync'] not in FSYNC_POLICIES:
+            raise ValueError(f"JSONL_FSYNC只能是{'、'.join(FSYNC_POLICIES)}，不能是'{config_['fsync']}'")
+        return config_
+    except ValueError as e_:
+        print(f"环境变量配置错误: {e_}")
+        exit(1)
+
+
+def get_shared_config():
+    global _config
+    if _config is None:
+        _config = get_config()
+    return _config
+
+
+def get_codec(name=None):
+    # name为None时返回JSONL_CODEC选择的编解码器
+    return CODECS[get_shared_config()['codec'] if name is None else name]
+
+
+def encode(record):
+    return get_codec().encode(record)
+
+
+def decode(line):
+    return get_codec().decode(line)
+
+
+def iter_jsonl(path, start_offset=0, with_offsets=False, codec=None):
+    """
+    Lazily reads the records of a JSONL file, one line at a time.
+
+    Blank lines are skipped, and a final line without a newline (a crash or a writer still
+    appending) is not read, so a later read from the returned offset picks it up complete.
+
+    Returns:
+    - An iterator of records, or of (record, offset after the record) with with_offsets.
+    """
+    decode_ = get_codec(codec).decode
+    with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f_:
+        f_.seek(start_offset)
+        offset = start_offset
+        for line in f_:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            if with_offsets:
+                yield decode_(line), offset
+            else:
+                yield decode_(line)
+
+
+class JsonlWriter:
+    """
+    Appends records to a JSONL file in group commits.
+
+    Encoded lines are buffered and written with one write and flush when group_records records
+    or group_bytes bytes are buffered after a write_many, when group_seconds have passed
+    (checked by a daemon thread, so a slow stage does not hold finished records back), on
+    commit() and on close(). A batch given to write_many is never split across two commits, so
+    a crash leaves only whole batches on disk.
+    With fsync 'commit' every group is synced to disk, with 'close' only the end of the file.
+    on_commit is called with the last committed record after each group is on disk (or in the
+    OS cache), which is where a script records its checkpoint: a crash loses at most the
+    uncommitted group and the checkpoint never points past the file.
+    """
+
+    def __init__(self, path, mode='a', group_records=None, group_bytes=None, group_seconds=None, fsync=None,
+                 on_commit=None, codec=None):
+        config_ = get_shared_config()
+        self.path = path
+        self.group_records = config_['group_records'] if group_records is None else group_records
+        self.group_bytes = config_['group_bytes'] if group_bytes is None else group_bytes
+        self.group_seconds = config_['group_seconds'] if group_seconds is None else group_seconds
+        self.fsync = config_['fsync'] if fsync is None else fsync
+        self.on_commit = on_commit
+        self.encode = get_codec(codec).encode
+        self._file = open(path, mode + 'b')
+        self._lines = []
+        self._bytes = 0
+        self._last_record = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.group_seconds > 0:
+            self._flusher = threading.Thread(target=self.flush_loop, name='jsonl-commit', daemon=True)
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write(self, record):
+        self.write_many([record])
+
+    def write_many(self, records):
+        # 在锁外编码；整批记录一起加入缓冲区后才检查提交阈值，同一批不会拆成两次提交
+        records = list(records)
+        lines = [self.encode(record) + b'\n' for record in records]
+        if not lines:
+            return
+        with self._lock:
+            self._lines.extend(lines)
+            self._bytes += sum(len(line) for line in lines)
+            self._last_record = records[-1]
+            if len(self._lines) >= self.group_records or self._bytes >= self.group_bytes:
+                self.commit()
+
+    def commit(self):
+        # 把缓冲的记录一次写出并刷新，按策略落盘后调用on_commit
+        with self._lock:
+            if not self._lines:
+                return
+            with metrics.span('jsonl_commit', file=os.path.basename(self.path)):
+                self._file.write(b''.join(self._lines))
+                self._file.flush()
+                if self.fsync == 'commit':
+                    os.fsync(self._file.fileno())
+            metrics.count('jsonl_records_written_total', len(self._lines), file=os.path.basename(self.path))
+            last_record = self._last_record
+            self._lines = []
+            self._bytes = 0
+            if self.on_commit is not None:
+                self.on_commit(last_record)
+
+    def flush_loop(self):
+        while not self._stop.wait(self.group_seconds):
+            try:
+                self.commit()
+            except OSError as e_:
+                print(f"写入文件'{self.path}'失败: {e_}")
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            self.commit()
+            if self.fsync in ('commit', 'close'):
+                os.fsync(self._file.fileno())
+            self._file.close()
@@ -0,0 +1,67 @@
+import numpy as np
+
+from embedding_cache import encode_texts
+
+
+class EmbeddingLabeler:
+    """
+    Assigns labels by embedding similarity, leaving ambiguous items to the LLM.
+
+    The label set is embedded once as unit-length rows, so scoring a batch of items is a single
+    matrix product. An item is labeled directly when at least one label scores at or above the
+    threshold and no other label falls in the margin just below it; those labels, best first and
+    at most max_labels of them, are assigned. Every other item is ambiguous.
+    """
+
+    def __init__(self, model_, model_path, labels_, threshold=0.6, margin=0.05, max_labels=3, device=None):
+        self.model = model_
+        self.model_path = model_path
+        self.labels = list(labels_)
+        self.threshold = threshold
+        self.margin = margin
+        self.max_labels = max_labels
+        self.device = device
+        self.label_matrix = self.encode(self.labels)
+        self.stats = {"embedding": 0, "llm": 0}
+
+    def encode(self, texts):
+        return encode_texts(self.model, self.model_path, texts, normalize_embeddings=True, device=self.device)
+
+    def scores(self, texts):
+        """
+        Scores items against every label.
+
+        Returns:
+        - A float32 array of shape (len(texts), len(labels)) with cosine similarities.
+        """
+        if not texts:
+            return np.zeros((0, len(self.labels)), dtype=np.float32)
+        return self.encode(texts) @ self.label_matrix.T
+
+    def decide(self, scores_, threshold=None, margin=None):
+        """
+        Turns label scores into decisions; the thresholds default to the configured ones.
+
+        Returns:
+        - A list with the assigned labels of each item, or None for an ambiguous item.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        margin = self.margin if margin is None else margin
+        accepted = scores_ >= threshold
+        borderline = (scores_ >= threshold - margin) & ~accepted
+        confident = accepted.any(axis=1) & ~borderline.any(axis=1)
+        order = np.argsort(-scores_, axis=1)[:, :self.max_labels]
+        decisions = []
+        for i_ in range(scores_.shape[0]):
+            if not confident[i_]:
+                decisions.append(None)
+                continue
+            decisions.append([self.labels[j_] for j_ in order[i_] if accepted[i_, j_]])
+        return decisions
+
+    def classify(self, texts):
+        decisions = self.decide(self.scores(texts))
+        labeled = sum(decision is not None for decision in decisions)
+        self.stats['embedding'] += labeled
+        self.stats['llm'] += len(decisions) - labeled
+        return decisions
@@ -0,0 +1,83 @@
+# 标记列表的开头、标记之间的分隔和结尾，与data_label.py中parse_labels解析的格式一致
+LIST_OPEN = "['"
+LIST_SEPARATOR = "', '"
+LIST_CLOSE = "']"
+
+
+def new_node():
+    # children：下一个token到子节点；reach：经过该节点的(标记, 结尾方式)到剩余token数；done：在该节点结束的序列
+    return {"children": {}, "reach": {}, "done": None}
+
+
+class LabelListConstraint:
+    """
+    Token-level grammar for a list of distinct labels from a fixed set, e.g. ['A', 'B'].
+
+    The opening "['" is forced token by token. After it every label is followed either by
+    "', '" (another label comes) or by "']" (the list closes); these label-plus-ending
+    sequences are tokenized once and stored in a trie. The allowed next tokens are found by
+    replaying the tokens generated so far through the trie, so the constraint keeps no state
+    between steps. A label is not repeated, and a branch is only allowed while the list can
+    still be closed within the generation budget. After the list closes only EOS is allowed.
+    """
+
+    def __init__(self, encode, labels_, eos_token_id):
+        self.eos_token_id = eos_token_id
+        self.open_ids = encode(LIST_OPEN)
+        self.root = new_node()
+        self.labels = list(dict.fromkeys(labels_))
+        close_lengths = []
+        for label_ in self.labels:
+            self.add(encode(label_ + LIST_SEPARATOR), label_, 'more')
+            close_ids = encode(label_ + LIST_CLOSE)
+            self.add(close_ids, label_, 'close')
+            close_lengths.append(len(close_ids))
+        self.min_close = min(close_lengths) if close_lengths else 0
+
+    def add(self, ids, label_, kind):
+        node = self.root
+        node['reach'][(label_, kind)] = len(ids)
+        for depth, token_id in enumerate(ids, 1):
+            node = node['children'].setdefault(token_id, new_node())
+            node['reach'][(label_, kind)] = len(ids) - depth
+        if node['done'] is None:
+            node['done'] = (label_, kind)
+
+    def viable(self, node, used, remaining):
+        # 该节点之后是否还有一条未用过的标记序列能在剩余预算内完成，并且整个列表仍能闭合
+        for (label_, kind), length in node['reach'].items():
+            if label_ in used:
+                continue
+            if kind == 'close' and length <= remaining:
+                return True
+            if kind == 'more' and len(used) + 1 < len(self.labels) and length + self.min_close <= remaining:
+                return True
+        return False
+
+    def allowed_tokens(self, generated_ids, max_new_tokens):
+        """
+        Finds the tokens that may follow the generated ones.
+
+        Returns:
+        - A list of token ids; only EOS once the list is closed or cannot be continued.
+        """
+        if len(generated_ids) < len(self.open_ids):
+            return [self.open_ids[len(generated_ids)]]
+        used = set()
+        node = self.root
+        for token_id in generated_ids[len(self.open_ids):]:
+            if node is None:
+                return [self.eos_token_id]
+            node = node['children'].get(token_id)
+            if node is None:
+                return [self.eos_token_id]
+            if node['done'] is not None:
+                label_, kind = node['done']
+                used.add(label_)
+                node = self.root if kind == 'more' else None
+        if node is None:
+            return [self.eos_token_id]
+        # 选择下一个token本身占用一个token的预算
+        remaining = max_new_tokens - len(generated_ids) - 1
+        allowed = [token_id for token_id, child in node['children'].items() if self.viable(child, used, remaining)]
+        return allowed or [self.eos_token_id]
@@ -0,0 +1,233 @@
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import dotenv
+
+# 耗时直方图的桶上界（秒），覆盖从单次检索到一批大模型生成的范围
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# 所有指标名称的前缀
+METRIC_PREFIX = 'fineturning_'
+# 未启用时所有span共用的空上下文
+_NOOP_SPAN = nullcontext()
+# 进程内的指标记录器，首次使用时按环境变量创建，未启用时为None
+_metrics = None
+_initialized = False
+_init_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Gets the metrics configuration from environment variables.
+
+    Returns:
+    - A dictionary with configuration parameters.
+    """
+    try:
+        dotenv.load_dotenv()
+        config_ = {
+            "trace_file": os.getenv("METRICS_TRACE_FILE") or None,
+            "prometheus_file": os.getenv("METRICS_PROMETHEUS_FILE") or None,
+            "flush_seconds": float(os.getenv("METRICS_FLUSH_SECONDS", "15")),
+        }
+        return config_
+    except ValueError as e_:
+        print(f"环境变量配置错误: {e_}")
+        exit(1)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+class Span:
+    """
+    Times a block of code; on exit the duration goes to the <name>_seconds histogram and, when a
+    trace file is configured, a line with the start time, duration, process, thread, labels and
+    the exception type if the block raised.
+    """
+
+    __slots__ = ('metrics', 'name', 'labels', 'start', 'wall_start')
+
+    def __init__(self, metrics_, name, labels):
+        self.metrics = metrics_
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.name + '_seconds', seconds, self.labels)
+        record = {"span": self.name, "start": round(self.wall_start, 6), "seconds": round(seconds, 6),
+                  "pid": os.getpid(), "thread": threading.current_thread().name, **self.labels}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self.metrics.trace(record)
+        return False
+
+
+class Metrics:
+    """
+    In-process counters and latency histograms with a JSONL trace and a Prometheus text file.
+
+    Span records are appended to the trace file as they finish. The Prometheus file is rewritten
+    atomically every flush_seconds by a daemon thread and once more on close, so a node exporter
+    textfile collector (or a person with cat) always sees a complete snapshot. Worker processes
+    only append to the trace: their spans and counters would otherwise overwrite the snapshot of
+    the main process.
+    """
+
+    def __init__(self, trace_file=None, prometheus_file=None, flush_seconds=15.0):
+        self.prometheus_file = prometheus_file
+        self.flush_seconds = flush_seconds
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._trace = open(trace_file, 'a', encoding='utf-8') if trace_file else None
+        self._stop = threading.Event()
+        self._flusher = None
+        if prometheus_file and flush_seconds > 0:
+            self._flusher = threading.Thread(target=self.flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def count(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i_, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i_] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def trace(self, record):
+        if self._trace is None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._trace.write(line)
+            self._trace.flush()
+
+    def render(self):
+        # 按Prometheus文本格式输出所有计数器和直方图
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count_))
+                                for key, (buckets, total, count_) in self.histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = METRIC_PREFIX + name
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} counter')
+                typed.add(metric)
+            lines.append(f'{metric}{format_labels(labels)} {value}')
+        for (name, labels), (buckets, total, count_) in histograms:
+            metric = METRIC_PREFIX + name
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} histogram')
+                typed.add(metric)
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{metric}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{metric}_bucket{format_labels(labels + (("le", "+Inf"),))} {count_}')
+            lines.append(f'{metric}_sum{format_labels(labels)} {total}')
+            lines.append(f'{metric}_count{format_labels(labels)} {count_}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self):
+        if not self.prometheus_file:
+            return
+        temp_path = f'{self.prometheus_file}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f_:
+            f_.write(self.render())
+        os.replace(temp_path, self.prometheus_file)
+
+    def flush_loop(self):
+        while not self._stop.wait(self.flush_seconds):
+            try:
+                self.write_prometheus()
+            except OSError as e_:
+                print(f"写入指标文件失败: {e_}")
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.write_prometheus()
+        if self._trace is not None:
+            with self._lock:
+                self._trace.close()
+                self._trace = None
+
+
+def get_metrics():
+    """
+    Gets the process-wide metrics recorder configured by environment variables.
+
+    Returns:
+    - A Metrics instance, or None when neither METRICS_TRACE_FILE nor METRICS_PROMETHEUS_FILE
+      is set and instrumentation is a no-op.
+    """
+    global _metrics, _initialized
+    if _initialized:
+        return _metrics
+    with _init_lock:
+        if not _initialized:
+            config_ = get_config()
+            # 子进程只写追踪文件，Prometheus文件由主进程写出
+            prometheus_file = config_['prometheus_file'] if multiprocessing.parent_process() is None else None
+            if config_['trace_file'] or prometheus_file:
+                _metrics = Metrics(config_['trace_file'], prometheus_file, config_['flush_seconds'])
+                atexit.register(close_metrics)
+            _initialized = True
+    return _metrics
+
+
+def span(name, **labels):
+    # 记录一段代码的耗时，未启用时返回共用的空上下文
+    metrics_ = _metrics if _initialized else get_metrics()
+    if metrics_ is None:
+        return _NOOP_SPAN
+    return Span(metrics_, name, labels)
+
+
+def count(name, value=1, **labels):
+    metrics_ = _metrics if _initialized else get_metrics()
+    if metrics_ is not None and value:
+        metrics_.count(name, value, labels)
+
+
+def observe(name, value, **labels):
+    metrics_ = _metrics if _initialized else get_metrics()
+    if metrics_ is not None:
+        metrics_.observe(name, value, labels)
+
+
+def close_metrics():
+    # 写出最终的Prometheus快照并关闭追踪文件，可重复调用
+    global _metrics
+    with _init_lock:
+        if _metrics is not None:
+            _metrics.close()
+            _metrics = None
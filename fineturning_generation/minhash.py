@@ -0,0 +1,118 @@
+import re
+
+import numpy as np
+
+# n-gram滚动哈希的乘数
+SHINGLE_BASE = np.uint64(1000003)
+
+
+def normalize_text(text):
+    # 忽略大小写、标点和空白差异
+    text = text.lower()
+    text = re.sub(r'[^\w]+', ' ', text)
+    return ' '.join(text.split())
+
+
+class MinHashLSH:
+    """
+    MinHash signatures over character n-grams with an LSH banding index.
+
+    Character n-grams work for both Chinese and English text. A text is a duplicate when some
+    indexed text shares at least one band with it and their estimated Jaccard similarity
+    (fraction of equal signature values) reaches threshold. With num_perm=128 and bands=16
+    candidates start to appear around 0.7 similarity, so a 0.8 threshold is rarely missed.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, bands=16, ngram=5, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm必须能被bands整除")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        # multiply-shift哈希族：(a * h + b)按2^64取模后取高32位，a为奇数
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, key):
+        return key in self.signatures
+
+    def shingle_hashes(self, text):
+        # 以Unicode码点计算字符n-gram的滚动哈希，整个文本一次向量化完成
+        codes = np.frombuffer(normalize_text(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        ngram = min(self.ngram, max(len(codes), 1))
+        count = max(len(codes) - ngram + 1, 1)
+        hashes = np.zeros(count, dtype=np.uint64)
+        for offset in range(min(ngram, len(codes))):
+            hashes = hashes * SHINGLE_BASE + codes[offset:offset + count]
+        return np.unique(hashes)
+
+    def signature(self, text):
+        hashes = self.shingle_hashes(text)
+        # 每个哈希函数取所有n-gram哈希的最小值
+        return ((np.outer(hashes, self.a) + self.b) >> np.uint64(32)).min(axis=0)
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def query(self, text=None, signature=None):
+        """
+        Finds indexed keys whose estimated Jaccard similarity with the text reaches threshold.
+
+        Returns:
+        - A list of (key, estimated similarity) pairs, most similar first.
+        """
+        if signature is None:
+            signature = self.signature(text)
+        candidates = set()
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(bucket.get(band_key, ()))
+        matches = []
+        for key in candidates:
+            similarity = float(np.mean(self.signatures[key] == signature))
+            if similarity >= self.threshold:
+                matches.append((key, similarity))
+        matches.sort(key=lambda match: -match[1])
+        return matches
+
+    def add(self, key, text=None, signature=None):
+        if signature is None:
+            signature = self.signature(text)
+        if key in self.signatures:
+            self.remove(key)
+        self.signatures[key] = signature
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            bucket.setdefault(band_key, []).append(key)
+
+    def remove(self, key):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            keys = bucket.get(band_key)
+            if keys is None:
+                continue
+            keys.remove(key)
+            if not keys:
+                del bucket[band_key]
+
+    def check_and_add(self, key, text):
+        """
+        Adds the text unless it duplicates an indexed one.
+
+        Returns:
+        - The key of the most similar indexed text if it is a duplicate, otherwise None.
+        """
+        signature = self.signature(text)
+        matches = self.query(signature=signature)
+        if matches:
+            return matches[0][0]
+        self.add(key, signature=signature)
+        return None
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI-compatible chat completions endpoint for local testing and benchmarks.
+
+    The response content echoes the last user message, so callers can check that results
+    come back in request order. Connections are kept alive (HTTP/1.1). With max_in_flight set,
+    requests beyond that many concurrent calls get a 429 with a Retry-After header, which
+    simulates a provider quota.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+
+    def log_message(self, format_, *args):
+        # 压测时不输出访问日志
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            limited = 0 < self.server.max_in_flight <= self.server.in_flight
+            if limited:
+                self.server.stats['rate_limited'] += 1
+            else:
+                self.server.in_flight += 1
+        if limited:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                           headers={"retry-after": str(self.server.retry_after)})
+            return
+        try:
+            time.sleep(self.server.latency)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+        prompt = request['messages'][-1]['content']
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(prompt) // 4)
+        self.send_json(200, {
+            "id": f"chatcmpl-stub-{self.server.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'stub'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"echo: {prompt}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+
+def start_stub_server(latency=0.05, max_in_flight=0, retry_after=1, host='127.0.0.1', port=0):
+    """
+    Starts the stub server in a daemon thread.
+
+    Returns:
+    - The server; its base url is server.base_url and counters are in server.stats.
+      Call server.shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.max_in_flight = max_in_flight
+    server.retry_after = retry_after
+    server.in_flight = 0
+    server.lock = threading.Lock()
+    server.stats = {"connections": 0, "requests": 0, "rate_limited": 0}
+    server.base_url = f"http://{host}:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,474 @@
+import glob
+import json
+import os
+import queue
+import threading
+import time
+
+import dotenv
+from torch import multiprocessing
+
+import metrics
+from checkpoint import load_last_record
+from jsonl_io import JsonlWriter, iter_jsonl
+
+# 队列中的结束标记，上游所有数据处理完后发出
+END = object()
+
+
+class PipelineStopped(Exception):
+    # 其他阶段出错后，用于让当前线程尽快退出
+    pass
+
+
+class JsonlTee:
+    """
+    Appends stage outputs to an intermediate JSONL pool.
+
+    Keeps the pipeline output compatible with running each stage script on its own. Records
+    are group-committed by a JsonlWriter; the records of one batch stay together in the file.
+    before_write is called with each batch under the tee's lock right before it is written, so
+    anything it assigns (such as ids) follows the order of the records in the file even when
+    several workers write to the same tee.
+    """
+
+    def __init__(self, path, before_write=None):
+        self.path = path
+        self.before_write = before_write
+        self._writer = JsonlWriter(path)
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        if not records:
+            return
+        with self._lock:
+            if self.before_write is not None:
+                self.before_write(records)
+            self._writer.write_many(records)
+
+    def close(self):
+        self._writer.close()
+
+
+class Stage:
+    """
+    One pipeline step.
+
+    process is called with a list of up to batch_size items and returns the items to pass
+    downstream. workers threads run it concurrently; with a single worker the output order
+    follows the input order. A stage can wait for an event before its first batch, write its
+    outputs to a JsonlTee, and run on_finish once after its last batch.
+    """
+
+    def __init__(self, name, process, batch_size=1, workers=1, tee=None, wait_for=None, on_finish=None):
+        self.name = name
+        self.process = process
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.tee = tee
+        self.wait_for = wait_for
+        self.on_finish = on_finish
+
+
+class Pipeline:
+    """
+    Runs sources and stages on threads joined by bounded queues.
+
+    A full queue blocks its producer, so a slow stage slows down everything upstream of it
+    instead of letting intermediate results pile up in memory. A stage starts a batch as soon as
+    batch_size items are queued or batch_wait_seconds have passed since its first item arrived.
+    """
+
+    def __init__(self, queue_size=1000, batch_wait_seconds=1.0):
+        self.queue_size = queue_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.threads = []
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def put(self, queue_, item):
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+            try:
+                queue_.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, queue_, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+            wait = 0.1
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return queue_.get_nowait()
+                wait = min(wait, remaining)
+            try:
+                return queue_.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+    def spawn(self, name, target):
+        def run():
+            try:
+                target()
+            except PipelineStopped:
+                pass
+            except BaseException as e_:
+                with self._lock:
+                    self.errors.append((name, e_))
+                self.stop_event.set()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def new_stats(self, name):
+        stats = {"items_in": 0, "items_out": 0, "batches": 0, "busy_seconds": 0.0}
+        self.stats[name] = stats
+        return stats
+
+    def source(self, name, iterable, tee=None):
+        output = queue.Queue(self.queue_size)
+        stats = self.new_stats(name)
+
+        def feed():
+            buffer = []
+            for item in iterable:
+                self.put(output, item)
+                stats['items_out'] += 1
+                if tee is not None:
+                    buffer.append(item)
+                    if len(buffer) >= 100:
+                        tee.write(buffer)
+                        buffer = []
+            if tee is not None:
+                tee.write(buffer)
+            self.put(output, END)
+
+        self.spawn(name, feed)
+        return output
+
+    def stage(self, stage, input_queue):
+        output = queue.Queue(self.queue_size)
+        stats = self.new_stats(stage.name)
+        remaining = [stage.workers]
+
+        def work():
+            if stage.wait_for is not None:
+                while not stage.wait_for.wait(0.1):
+                    if self.stop_event.is_set():
+                        raise PipelineStopped()
+            finished = False
+            while not finished:
+                item = self.get(input_queue)
+                if item is END:
+                    break
+                # 凑满一批或等待超时后开始处理，避免上游较慢时下游长时间空闲
+                batch = [item]
+                deadline = time.monotonic() + self.batch_wait_seconds
+                while len(batch) < stage.batch_size:
+                    try:
+                        item = self.get(input_queue, max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is END:
+                        finished = True
+                        break
+                    batch.append(item)
+
+                start = time.perf_counter()
+                with metrics.span('pipeline_batch', stage=stage.name):
+                    outputs = stage.process(batch) or []
+                metrics.count('pipeline_items_total', len(batch), stage=stage.name)
+                with self._lock:
+                    stats['items_in'] += len(batch)
+                    stats['items_out'] += len(outputs)
+                    stats['batches'] += 1
+                    stats['busy_seconds'] += time.perf_counter() - start
+                if stage.tee is not None:
+                    stage.tee.write(outputs)
+                for out in outputs:
+                    self.put(output, out)
+
+            # 将结束标记放回输入队列，通知同阶段的其他线程
+            self.put(input_queue, END)
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                if stage.on_finish is not None:
+                    stage.on_finish()
+                self.put(output, END)
+
+        for i_ in range(stage.workers):
+            self.spawn(f"{stage.name}-{i_}", work)
+        return output
+
+    def drain(self, name, input_queue):
+        # 丢弃末端阶段的输出，只等待结束标记
+        def consume():
+            while self.get(input_queue) is not END:
+                pass
+
+        self.spawn(name, consume)
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            for thread in self.threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stop_event.set()
+            raise
+        self.print_stats(time.perf_counter() - start)
+        if self.errors:
+            name, error = self.errors[0]
+            raise RuntimeError(f"流水线阶段'{name}'出错: {error}") from error
+
+    def print_stats(self, wall_seconds):
+        print(f"流水线运行结束，总耗时{wall_seconds:.1f}秒")
+        for name, stats in self.stats.items():
+            busy = stats['busy_seconds']
+            rate = stats['items_in'] / busy if busy else 0.0
+            print(f"  {name}: 输入{stats['items_in']}条，输出{stats['items_out']}条，"
+                  f"{stats['batches']}个批次，处理耗时{busy:.1f}秒，{rate:.1f}条/秒")
+
+
+# 加载环境变量
+def get_config():
+    """
+    Gets configuration from environment variables.
+
+    Stage settings are shared with the individual scripts; only the pipeline settings are new.
+
+    Returns:
+    - A dictionary with configuration parameters.
+    """
+    try:
+        dotenv.load_dotenv()
+        config_ = {
+            "queue_size": int(os.getenv("PIPELINE_QUEUE_SIZE", "1000")),
+            "batch_wait_seconds": float(os.getenv("PIPELINE_BATCH_WAIT_SECONDS", "1")),
+            "write_intermediate": os.getenv("PIPELINE_WRITE_INTERMEDIATE", "1") == "1",
+            "run_slice_chain": os.getenv("PIPELINE_SLICE_CHAIN", "1") == "1",
+            "run_instruction_chain": os.getenv("PIPELINE_INSTRUCTION_CHAIN", "1") == "1",
+            "label_instructions": os.getenv("PIPELINE_LABEL_INSTRUCTIONS", "1") == "1",
+            "dedup_slices": os.getenv("PIPELINE_SLICE_DEDUP", "1") == "1",
+            # 指令来源为指令生成脚本的输出文件
+            "instructions_file": os.getenv("INSTRUCTIONS_FILE"),
+            "workers": {
+                stage_: int(os.getenv(f"PIPELINE_{stage_.upper()}_WORKERS", "1"))
+                for stage_ in ("label", "embed", "retrieve", "finetune")
+            },
+        }
+        return config_
+    except ValueError as e_:
+        print(f"环境变量配置错误: {e_}")
+        exit(1)
+
+
+# 检查输出文件，流水线从头运行，不向已有数据的文件追加
+def check_output_files(paths):
+    for path in paths:
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            print(f"输出文件'{path}'已有数据，流水线模式不支持续跑，请先清空或更换输出文件")
+            exit(1)
+
+
+def run_pipeline(config_):
+    # 延迟导入各阶段模块，避免只查看配置时加载重量级依赖
+    import data_label
+    import docx_text
+    import embedding_generation
+    import fineturning_generation
+    import request_generation
+    import slice_dedup
+    import slice_generation
+    from sentence_transformers import SentenceTransformer
+    from vector_store import SLICE_MIN_LENGTH, get_vector_store
+    from embedding_cache import close_embedding_caches
+    from qwen2_api import api_generation, shutdown
+
+    slice_config = slice_generation.get_config()
+    label_config = data_label.get_config()
+    embedding_config = embedding_generation.get_config()
+    request_config = request_generation.get_config()
+    finetune_config = fineturning_generation.get_config()
+    workers = config_['workers']
+    write_intermediate = config_['write_intermediate']
+
+    outputs = [finetune_config['output_file']]
+    if write_intermediate:
+        if config_['run_slice_chain']:
+            outputs += [slice_config['output_file'], embedding_config['reference_data_file']]
+        if config_['run_instruction_chain']:
+            outputs.append(request_config['request_data_file'])
+            if config_['label_instructions']:
+                outputs.append(request_config['instruction_data_file'])
+    check_output_files(outputs)
+
+    labels = data_label.load_label_pool(label_config['label_pool'])
+    prompt_prefix = data_label.build_prompt_prefix(labels)
+
+    # 相同路径的Sentence-BERT模型只加载一次
+    models = {}
+
+    def get_model(path):
+        if path not in models:
+            print(f"加载Sentence-BERT模型{path}...\n")
+            models[path] = SentenceTransformer(path)
+        return models[path]
+
+    packing = data_label.get_packing(label_config, labels)
+    decoding = data_label.get_decoding(label_config, labels)
+    classifier = None
+    if label_config['fast_path_model']:
+        classifier = data_label.get_classifier(label_config, labels, get_model(label_config['fast_path_model']))
+
+    def tee(path):
+        return JsonlTee(path) if write_intermediate else None
+
+    store = get_vector_store()
+    pipeline = Pipeline(config_['queue_size'], config_['batch_wait_seconds'])
+    tees = []
+    retrieval_ready = threading.Event()
+
+    if config_['run_slice_chain']:
+        # 切片 -> 标记 -> 嵌入入库，入库完成后创建索引并加载集合
+        docx_files = sorted(glob.glob(os.path.join(slice_config['input_file_folder'], '*.docx')))
+        slice_tee = tee(slice_config['output_file'])
+        docx_config = docx_text.get_config()
+        slices = pipeline.source('slice', slice_generation.iter_slice_records(
+            docx_files, slice_generation.get_slicer(slice_config),
+            text_cache_=docx_text.get_text_cache(docx_config), workers_=docx_config['workers']), slice_tee)
+        if config_['dedup_slices']:
+            # 流式去重只能丢弃重复切片，merge模式需要单独运行slice_dedup.py
+            dedup_config = slice_dedup.get_config()
+            slice_deduplicator = slice_dedup.SliceDeduplicator(
+                dedup_config['threshold'], dedup_config['num_perm'], dedup_config['bands'])
+            slices = pipeline.stage(Stage('dedup_slice', slice_deduplicator.filter, batch_size=100), slices)
+
+        label_tee = tee(embedding_config['reference_data_file'])
+        labeled_slices = pipeline.stage(Stage(
+            'label_slice',
+            lambda batch: data_label.label_batch(batch, 'slice', prompt_prefix, packing, classifier, decoding),
+            batch_size=label_config['request_batch_size'],
+            workers=workers['label'],
+            tee=label_tee,
+        ), slices)
+
+        embedding_model = get_model(embedding_config['sentence_bert_model'])
+        store.create()
+
+        def embed(batch):
+            batch_records = [record for record in batch
+                             if len(record['slice']) > SLICE_MIN_LENGTH]
+            if batch_records:
+                embedding_generation.insert_slices(
+                    store, embedding_model, embedding_config['sentence_bert_model'], batch_records,
+                    embedding_config['device'])
+            return []
+
+        def finish_embedding():
+            store.finish()
+            retrieval_ready.set()
+
+        embedded = pipeline.stage(Stage(
+            'embed', embed,
+            batch_size=embedding_config['batch_size'],
+            workers=workers['embed'],
+            on_finish=finish_embedding,
+        ), labeled_slices)
+        pipeline.drain('embed_sink', embedded)
+        tees += [slice_tee, label_tee]
+    else:
+        store.open()
+        retrieval_ready.set()
+
+    if config_['run_instruction_chain']:
+        # 指令 -> 标记 -> 检索组合请求 -> 生成微调数据；检索需等待切片入库和索引完成
+        instructions = pipeline.source('instruction', iter_jsonl(config_['instructions_file']))
+        if config_['label_instructions']:
+            instruction_tee = tee(request_config['instruction_data_file'])
+            instructions = pipeline.stage(Stage(
+                'label_instruction',
+                lambda batch: data_label.label_batch(batch, 'instruction', prompt_prefix, packing, classifier, decoding),
+                batch_size=label_config['request_batch_size'],
+                workers=workers['label'],
+                tee=instruction_tee,
+            ), instructions)
+            tees.append(instruction_tee)
+
+        request_model = get_model(request_config['sentence_bert_model'])
+        request_tee = tee(request_config['request_data_file'])
+        requests = pipeline.stage(Stage(
+            'retrieve',
+            lambda batch: request_generation.build_requests(
+                request_model, request_config['sentence_bert_model'], store,
+                [record['instruction'] for record in batch],
+                request_config['nprobe'], request_config['limit'], request_config['device'],
+                request_config['max_retries']),
+            batch_size=request_config['batch_size'],
+            workers=workers['retrieve'],
+            tee=request_tee,
+            wait_for=retrieval_ready,
+        ), instructions)
+        tees.append(request_tee)
+
+        # 与fineturning_generation.py相同，从输出文件最后一条记录的id之后继续编号
+        last_record = load_last_record(finetune_config['output_file'])
+        next_id = [0 if last_record is None else last_record['id'] + 1]
+
+        def finetune(batch):
+            results = api_generation(batch)
+            return [
+                fineturning_generation.build_finetune_record(None, request_, result.get('response'))
+                for request_, result in zip(batch, results)
+            ]
+
+        def assign_ids(records):
+            # 在写入文件的同一把锁内编号，多个工作线程时输出文件中的id仍然连续递增
+            for record in records:
+                record['id'] = next_id[0]
+                next_id[0] += 1
+
+        finetune_tee = JsonlTee(finetune_config['output_file'], before_write=assign_ids)
+        finetuned = pipeline.stage(Stage(
+            'finetune', finetune,
+            batch_size=finetune_config['request_batch_size'],
+            workers=workers['finetune'],
+            tee=finetune_tee,
+        ), requests)
+        pipeline.drain('finetune_sink', finetuned)
+        tees.append(finetune_tee)
+
+    try:
+        pipeline.run()
+    finally:
+        for tee_ in tees:
+            if tee_ is not None:
+                tee_.close()
+        data_label.print_pack_stats()
+        if classifier is not None:
+            print(f"标记来源统计：{classifier.stats}\n")
+        shutdown()
+        close_embedding_caches()
+        if config_['run_slice_chain'] and config_['dedup_slices']:
+            print(f"切片去重统计：{json.dumps(slice_deduplicator.stats, ensure_ascii=False)}\n")
+        store.close()
+
+
+if __name__ == '__main__':
+    # 使用spawn启动子进程，确保cuda可以多进程执行
+    multiprocessing.set_start_method("spawn")
+
+    config = get_config()
+    run_pipeline(config)
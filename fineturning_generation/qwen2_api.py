@@ -1,39 +1,296 @@
+import atexit
 import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
 from dotenv import load_dotenv
 from torch import multiprocessing
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, LogitsProcessor, LogitsProcessorList
 from datetime import datetime
 
+import metrics
+from label_constraint import LabelListConstraint
+from response_cache import cached_generation, close_cache, get_cache
+
+# 子进程内常驻的模型和分词器，由进程池初始化函数加载一次，之后所有请求复用
+_model = None
+_tokenizer = None
+_device = None
+_load_seconds = 0.0
+# 子进程内缓存的公共前缀KV，键为前缀token id元组，跨批次复用
+_prefix_cache = OrderedDict()
+# 子进程内按标记集合缓存的约束解码语法，键为标记元组
+_label_constraints = {}
+
+# 主进程内常驻的进程池，跨多次api_generation调用复用，运行结束时由shutdown关闭
+_pool = None
+_pool_lock = threading.Lock()
+# 运行统计：各子进程的模型加载耗时，以及每个生成批次的耗时和补齐情况
+_stats = {"load_seconds": {}, "batches": []}
+
+
+def init_worker(config_):
+    global _model, _tokenizer, _device, _load_seconds
+    start = time.perf_counter()
+    _device = config_['device']
+    _model = AutoModelForCausalLM.from_pretrained(config_['model_path'], torch_dtype="auto").to(_device)
+    _tokenizer = AutoTokenizer.from_pretrained(config_['model_path'])
+    # 批量生成时需要左侧补齐，保证新生成的token紧接在prompt之后
+    _tokenizer.padding_side = 'left'
+    if _tokenizer.pad_token is None:
+        _tokenizer.pad_token = _tokenizer.eos_token
+    _load_seconds = time.perf_counter() - start
+    print(f"进程{os.getpid()}模型加载完成，耗时{_load_seconds:.2f}秒\n")
 
-def make_request(config_, request, device):
-    model = AutoModelForCausalLM.from_pretrained(config_['model_path'], torch_dtype="auto").to(device)
-    tokenizer = AutoTokenizer.from_pretrained(config_['model_path'])
+
+def build_messages(request):
+    # 请求既可以是纯文本prompt，也可以是带有contexts的字典
+    if isinstance(request, str):
+        return request, [{"role": "user", "content": request}]
     instruction_ = request.get('instruction')
-    contexts_ = request.get('contexts')
+    contexts_ = request.get('contexts') or []
     messages = []
     for context_ in contexts_:
         message = {"role": "system", "content": context_}
         messages.append(message)
     message = {"role": "user", "content": instruction_}
     messages.append(message)
+    return instruction_, messages
 
-    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    model_inputs = tokenizer([text], return_tensors="pt").to(device)
 
-    generated_ids = model.generate(model_inputs.input_ids, max_new_tokens=config_['max_new_tokens'])
-    generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in
-                     zip(model_inputs.input_ids, generated_ids)]
-    response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    data_ = {"prompt": instruction_, "response": response, "created_at": str(datetime.now())}
-    return data_
+def encode_requests(requests):
+    # 使用聊天模板构建输入文本，并分词得到各请求的token id（不补齐）
+    prompts = []
+    texts = []
+    for request in requests:
+        instruction_, messages = build_messages(request)
+        prompts.append(instruction_)
+        texts.append(_tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+    return prompts, texts, _tokenizer(texts)['input_ids']
 
 
-def worker(config, prompts, device):
-    results = []
-    for prompt in prompts:
-        result = make_request(config, prompt, device)
-        results.append(result)
-    return results
+def common_prefix_length(input_ids_):
+    # 所有请求token序列的最长公共前缀长度
+    shortest = min(input_ids_, key=len)
+    length = 0
+    for position, token_id in enumerate(shortest):
+        if any(ids[position] != token_id for ids in input_ids_):
+            break
+        length = position + 1
+    return length
+
+
+def shared_prefix_length(config_, texts, input_ids_, prefix=None):
+    """
+    Decides how many leading tokens of a batch are served from the prefix KV cache.
+
+    A prefix already in the cache is reused when every request starts with it. Otherwise an
+    explicit prefix (a string every prompt starts with) is located in the rendered chat text,
+    or, without one, the longest common token prefix of the batch is used. At least one token
+    per request is always left for generate to prefill.
+
+    Returns:
+    - The number of cached prefix tokens, 0 if the batch does not use the prefix cache.
+    """
+    min_tokens = config_['prefix_cache_min_tokens']
+    if min_tokens <= 0:
+        return 0
+    max_length = min(len(ids) for ids in input_ids_) - 1
+
+    for cached_ids in _prefix_cache:
+        if len(cached_ids) <= max_length and all(tuple(ids[:len(cached_ids)]) == cached_ids for ids in input_ids_):
+            return len(cached_ids)
+
+    if prefix is not None:
+        end = texts[0].find(prefix)
+        if end < 0:
+            return 0
+        # 前缀末尾的token可能与后缀合并分词，去掉最后一个token，再与实际公共前缀取较小值
+        head_length = len(_tokenizer(texts[0][:end + len(prefix)])['input_ids']) - 1
+        length = min(head_length, common_prefix_length(input_ids_))
+    elif len(input_ids_) > 1:
+        length = common_prefix_length(input_ids_)
+    else:
+        return 0
+    length = min(length, max_length)
+    return length if length >= min_tokens else 0
+
+
+def get_prefix_cache(config_, prefix_ids):
+    # 计算一次前缀的KV并缓存，之后共享该前缀的请求只需预填充后缀
+    key = tuple(prefix_ids)
+    if key in _prefix_cache:
+        _prefix_cache.move_to_end(key)
+        return _prefix_cache[key]
+    with torch.no_grad():
+        outputs = _model(torch.tensor([prefix_ids], device=_device), use_cache=True)
+    past_key_values = outputs.past_key_values
+    if isinstance(past_key_values, DynamicCache):
+        past_key_values = past_key_values.to_legacy_cache()
+    _prefix_cache[key] = past_key_values
+    while len(_prefix_cache) > config_['prefix_cache_size']:
+        _prefix_cache.popitem(last=False)
+    return past_key_values
+
+
+def bucket_by_length(lengths, max_new_tokens, max_batch_tokens):
+    """
+    Groups requests into buckets of similar prompt length.
+
+    Requests are sorted by prompt length and packed greedily; a bucket is closed when
+    (longest prompt + max_new_tokens) * bucket size would exceed max_batch_tokens.
+    A single request larger than the budget still gets a bucket of its own.
+
+    Returns:
+    - A list of buckets, each a list of indices into lengths.
+    """
+    order = sorted(range(len(lengths)), key=lambda i_: lengths[i_])
+    buckets = []
+    current = []
+    for idx in order:
+        # 升序遍历，当前请求即为桶内最长的请求
+        padded_length = lengths[idx] + max_new_tokens
+        if current and padded_length * (len(current) + 1) > max_batch_tokens:
+            buckets.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+class LabelLogitsProcessor(LogitsProcessor):
+    """
+    Restricts decoding to a list of labels from the allowed set (see LabelListConstraint).
+
+    Tokens outside the grammar get a score of -inf. The generated part of each row starts at
+    prompt_length, the padded prompt width of the bucket.
+    """
+
+    def __init__(self, constraint, prompt_length, max_new_tokens):
+        self.constraint = constraint
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+
+    def __call__(self, input_ids, scores):
+        mask = torch.full_like(scores, float('-inf'))
+        for row in range(input_ids.shape[0]):
+            allowed = self.constraint.allowed_tokens(input_ids[row, self.prompt_length:].tolist(), self.max_new_tokens)
+            mask[row, allowed] = 0
+        return scores + mask
+
+
+class FirstTokenTimer(LogitsProcessor):
+    # 第一次被调用时预填充刚好结束，记录该时刻以区分预填充和解码耗时
+    def __init__(self):
+        self.first_token_at = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return scores
+
+
+def get_label_constraint(allowed_labels):
+    key = tuple(allowed_labels)
+    if key not in _label_constraints:
+        _label_constraints[key] = LabelListConstraint(
+            lambda text: _tokenizer.encode(text, add_special_tokens=False), allowed_labels, _tokenizer.eos_token_id)
+    return _label_constraints[key]
+
+
+def generate_bucket(input_ids_, max_new_tokens, prefix_cache=None, prefix_length=0, constraint=None):
+    """
+    Runs one generate call for a bucket and decodes only the newly generated tokens.
+
+    With a constraint the output is restricted to a label list and ends when the list closes.
+    Without a prefix cache the bucket is left padded. With one, every row is laid out as
+    [prefix][padding][suffix]: the prefix sits at the same positions in all rows so its KV can
+    be shared, the padding is masked out and position ids stay contiguous across it.
+
+    Returns:
+    - A tuple (response strings in bucket order, prefill seconds, generated token count).
+    """
+    if prefix_cache is None:
+        batch = _tokenizer.pad({"input_ids": input_ids_}, padding=True, return_tensors="pt").to(_device)
+        input_ids_tensor = batch.input_ids
+        attention_mask = batch.attention_mask
+        past_key_values = None
+    else:
+        longest = max(len(ids) for ids in input_ids_) - prefix_length
+        rows = []
+        masks = []
+        for ids in input_ids_:
+            suffix = ids[prefix_length:]
+            padding = longest - len(suffix)
+            rows.append(ids[:prefix_length] + [_tokenizer.pad_token_id] * padding + suffix)
+            masks.append([1] * prefix_length + [0] * padding + [1] * len(suffix))
+        input_ids_tensor = torch.tensor(rows, device=_device)
+        attention_mask = torch.tensor(masks, device=_device)
+        # generate会原地扩展缓存，每个桶使用按批大小复制的一份
+        batch_size = len(rows)
+        past_key_values = DynamicCache.from_legacy_cache(tuple(
+            (key.expand(batch_size, -1, -1, -1).contiguous(), value.expand(batch_size, -1, -1, -1).contiguous())
+            for key, value in prefix_cache
+        ))
+    timer = FirstTokenTimer()
+    logits_processor = LogitsProcessorList([timer])
+    if constraint is not None:
+        logits_processor.append(LabelLogitsProcessor(constraint, input_ids_tensor.shape[1], max_new_tokens))
+    start = time.perf_counter()
+    generated_ids = _model.generate(
+        input_ids_tensor,
+        attention_mask=attention_mask,
+        past_key_values=past_key_values,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=_tokenizer.pad_token_id,
+        logits_processor=logits_processor,
+    )
+    generated_ids = generated_ids[:, input_ids_tensor.shape[1]:]
+    prefill_seconds = (timer.first_token_at or time.perf_counter()) - start
+    completion_tokens = int((generated_ids != _tokenizer.pad_token_id).sum())
+    return _tokenizer.batch_decode(generated_ids, skip_special_tokens=True), prefill_seconds, completion_tokens
+
+
+def generate_batch(config_, requests, prefix=None, allowed_labels=None):
+    prompts, texts, input_ids = encode_requests(requests)
+    constraint = get_label_constraint(allowed_labels) if allowed_labels else None
+    lengths = [len(ids) for ids in input_ids]
+    buckets = bucket_by_length(lengths, config_['max_new_tokens'], config_['max_batch_tokens'])
+
+    # 所有请求共享的前缀只预填充一次
+    prefix_length = shared_prefix_length(config_, texts, input_ids, prefix)
+    prefix_cache = get_prefix_cache(config_, input_ids[0][:prefix_length]) if prefix_length else None
+
+    # 按桶生成，再按原始顺序放回
+    results = [None] * len(requests)
+    bucket_stats = []
+    for bucket in buckets:
+        start = time.perf_counter()
+        responses, prefill_seconds, completion_tokens = generate_bucket(
+            [input_ids[idx] for idx in bucket], config_['max_new_tokens'], prefix_cache, prefix_length, constraint)
+        created_at = str(datetime.now())
+        for idx, response in zip(bucket, responses):
+            results[idx] = {"prompt": prompts[idx], "response": response, "created_at": created_at}
+        longest = max(lengths[idx] for idx in bucket)
+        bucket_stats.append({
+            "size": len(bucket),
+            "seconds": time.perf_counter() - start,
+            "prefill_seconds": prefill_seconds,
+            "prompt_tokens": sum(lengths[idx] for idx in bucket),
+            "completion_tokens": completion_tokens,
+            "padded_tokens": longest * len(bucket),
+            "cached_tokens": prefix_length * len(bucket),
+        })
+    return results, bucket_stats
+
+
+def worker(config, requests, prefix=None, allowed_labels=None):
+    # 在常驻子进程中批量执行一组请求，同时返回各批次耗时，便于区分模型加载耗时和生成耗时
+    results, bucket_stats = generate_batch(config, requests, prefix, allowed_labels)
+    return results, bucket_stats, os.getpid(), _load_seconds
 
 
 def get_config():
@@ -51,6 +308,9 @@ def get_config():
             "max_new_tokens": int(os.getenv("MAX_NEW_TOKENS")),
             "device": os.getenv("DEVICE"),
             "max_workers": int(os.getenv("MAX_WORKERS")),
+            "max_batch_tokens": int(os.getenv("MAX_BATCH_TOKENS", "16384")),
+            "prefix_cache_min_tokens": int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "64")),
+            "prefix_cache_size": int(os.getenv("PREFIX_CACHE_SIZE", "4")),
         }
         return config_
     except ValueError as e_:
@@ -58,14 +318,108 @@ def get_config():
         exit(1)
 
 
-def api_generation(requests):
-    config = get_config()
-    device = config.get('device')
-    num_processes = config.get('max_workers')  # 进程数
+def get_pool(config_):
+    # 首次调用时创建进程池，每个子进程只加载一次模型；流水线中多个线程可能同时调用
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(
+                processes=config_['max_workers'],
+                initializer=init_worker,
+                initargs=(config_,),
+            )
+            atexit.register(shutdown)
+        return _pool
+
+
+def print_stats():
+    load_seconds = _stats['load_seconds']
+    batches = _stats['batches']
+    if load_seconds:
+        total_load = sum(load_seconds.values())
+        print(f"模型加载：{len(load_seconds)}个进程，共耗时{total_load:.2f}秒")
+    if batches:
+        count = sum(batch['size'] for batch in batches)
+        seconds = sum(batch['seconds'] for batch in batches)
+        padded_tokens = sum(batch['padded_tokens'] for batch in batches)
+        padding_ratio = 1 - sum(batch['prompt_tokens'] for batch in batches) / max(padded_tokens, 1)
+        latencies = sorted(batch['seconds'] for batch in batches)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        cached_tokens = sum(batch['cached_tokens'] for batch in batches)
+        print(f"生成耗时：共{count}条请求，{len(batches)}个批次，平均批大小{count / len(batches):.1f}，"
+              f"每条平均{seconds / count:.2f}秒，批次P95 {p95:.2f}秒，补齐占比{padding_ratio:.1%}，"
+              f"前缀缓存复用{cached_tokens}个token\n")
+
+
+def shutdown():
+    # 关闭常驻进程池和响应缓存并输出统计信息，可重复调用
+    global _pool
+    close_cache()
+    if _pool is None:
+        return
+    _pool.close()
+    _pool.join()
+    _pool = None
+    print_stats()
+
+
+def pool_generation(config_, requests, prefix=None, allowed_labels=None):
+    pool = get_pool(config_)
+    num_processes = config_['max_workers']  # 进程数
+
+    # 按连续区间切分请求，每个子进程内部再按长度分桶批量生成，拼接后保持原始顺序
+    chunk_size = max(1, -(-len(requests) // num_processes))
+    chunked_requests = [requests[i:i + chunk_size] for i in range(0, len(requests), chunk_size)]
 
-    chunked_requests = [requests[i::num_processes] for i in range(num_processes)]
+    results = []
+    with metrics.span('llm_generation', backend='qwen2'):
+        chunk_outputs = pool.starmap(worker, [(config_, chunk, prefix, allowed_labels) for chunk in chunked_requests])
+    for chunk_results, bucket_stats, pid, load_seconds in chunk_outputs:
+        results.extend(chunk_results)
+        _stats['batches'].extend(bucket_stats)
+        if pid not in _stats['load_seconds']:
+            metrics.observe('model_load_seconds', load_seconds, backend='qwen2')
+        _stats['load_seconds'][pid] = load_seconds
+        # 子进程内各批次的耗时和token数随结果返回，在主进程中记录
+        for batch in bucket_stats:
+            metrics.observe('llm_batch_seconds', batch['seconds'], backend='qwen2')
+            metrics.observe('llm_prefill_seconds', batch['prefill_seconds'], backend='qwen2')
+            metrics.observe('llm_decode_seconds', batch['seconds'] - batch['prefill_seconds'], backend='qwen2')
+            metrics.count('llm_prompt_tokens_total', batch['prompt_tokens'], backend='qwen2')
+            metrics.count('llm_completion_tokens_total', batch['completion_tokens'], backend='qwen2')
+            metrics.count('llm_cached_prefix_tokens_total', batch['cached_tokens'], backend='qwen2')
+    return results
+
+
+def api_generation(requests, prefix=None, use_cache=True, max_new_tokens=None, allowed_labels=None):
+    """
+    Generates responses for a batch of requests on the resident worker pool.
 
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        results = pool.starmap(worker, [(config, request, device) for request in chunked_requests])
+    Args:
+    - requests: prompt strings or dicts with 'instruction' and optional 'contexts'.
+    - prefix: optional text every prompt starts with; its KV cache is computed once per
+      worker and reused. Without it a shared token prefix is detected automatically.
+    - use_cache: serve repeated requests from the response cache when RESPONSE_CACHE_PATH is
+      set. Callers that need a fresh sample for every call pass False.
+    - max_new_tokens: generation budget of this call, MAX_NEW_TOKENS by default.
+    - allowed_labels: when given, decoding is constrained to a list of distinct labels from
+      this set, e.g. ['A', 'B'], and stops as soon as the list closes.
 
-    return [item for sublist in results for item in sublist]
+    Returns:
+    - A list of result dicts in request order.
+    """
+    if not requests:
+        return []
+    metrics.count('llm_requests_total', len(requests), backend='qwen2')
+    config = get_config()
+    if max_new_tokens is not None:
+        config['max_new_tokens'] = max_new_tokens
+    allowed_labels = list(allowed_labels) if allowed_labels else None
+    cache = get_cache() if use_cache else None
+    if cache is None:
+        return pool_generation(config, requests, prefix, allowed_labels)
+    params = {"max_new_tokens": config['max_new_tokens']}
+    if allowed_labels:
+        params['allowed_labels'] = allowed_labels
+    return cached_generation(cache, lambda pending: pool_generation(config, pending, prefix, allowed_labels),
+                             requests, 'qwen2', config['model_path'], params)
@@ -0,0 +1,161 @@
+import asyncio
+import email.utils
+import random
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate.
+
+    Used for requests-per-minute and tokens-per-minute budgets. A request larger than the
+    bucket capacity waits for a full bucket and then takes all of it.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount):
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            while True:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def refund(self, amount):
+        # 实际用量小于预估时归还差额
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + max(0.0, float(amount)))
+
+
+class AdaptiveConcurrencyController:
+    """
+    Concurrency limit shared by all in-flight requests (additive increase, multiplicative decrease).
+
+    The limit grows by one after a full window of successful calls and is multiplied by
+    decrease_factor on a rate-limit response; 429s arriving within decrease_cooldown seconds of
+    the last decrease belong to the same burst and do not shrink it again. A server-provided retry hint pauses all new
+    requests until it expires. Optional requests-per-minute and tokens-per-minute token buckets
+    are applied on top of the concurrency limit.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=64, decrease_factor=0.5, decrease_cooldown=1.0,
+                 rpm_limit=0, tpm_limit=0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.decreased_at = 0.0
+        self.request_bucket = TokenBucket(rpm_limit) if rpm_limit else None
+        self.token_bucket = TokenBucket(tpm_limit) if tpm_limit else None
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.stats = {"success": 0, "rate_limited": 0, "server_error": 0, "failed": 0, "max_limit": int(self.limit)}
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, estimated_tokens=0):
+        async with self._condition:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    # 服务端要求等待期间，不发出任何新请求
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    break
+                await self._condition.wait()
+            self.in_flight += 1
+        try:
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None and estimated_tokens:
+                await self.token_bucket.acquire(estimated_tokens)
+        except BaseException:
+            await self.release()
+            raise
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, estimated_tokens=0, used_tokens=None):
+        self.stats['success'] += 1
+        self.successes += 1
+        if self.successes >= int(self.limit):
+            self.successes = 0
+            self.limit = min(self.maximum, self.limit + 1)
+            self.stats['max_limit'] = max(self.stats['max_limit'], int(self.limit))
+        if self.token_bucket is not None and used_tokens is not None:
+            self.token_bucket.refund(estimated_tokens - used_tokens)
+
+    def on_rate_limited(self, retry_after=None):
+        self.stats['rate_limited'] += 1
+        self.successes = 0
+        now = time.monotonic()
+        if now - self.decreased_at >= self.decrease_cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            self.decreased_at = now
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    def on_server_error(self):
+        # 5xx一般不代表超出配额，只退避重试，不降低并发
+        self.stats['server_error'] += 1
+
+    def on_failed(self):
+        self.stats['failed'] += 1
+
+
+def parse_retry_after(headers):
+    """
+    Reads the retry hint of a rate-limited response.
+
+    Supports retry-after-ms, and retry-after given either in seconds or as an HTTP date.
+
+    Returns:
+    - The number of seconds to wait, or None if the response carries no hint.
+    """
+    if headers is None:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def backoff_delay(attempt, base, maximum):
+    # 指数退避加随机抖动，避免所有请求同时重试
+    delay = min(maximum, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
@@ -1,11 +1,18 @@
-import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dotenv
 from sentence_transformers import SentenceTransformer
-from pymilvus import connections, Collection
 import tqdm
 
+import metrics
+from data_pool import DataPool, iter_pool_batches
+from embedding_cache import close_embedding_caches, encode_texts
+from jsonl_io import JsonlWriter
+from rate_limiter import backoff_delay
+from vector_store import get_vector_store
+
 
 def get_config():
     """
@@ -17,9 +24,6 @@ def get_config():
     try:
         dotenv.load_dotenv()
         config_ = {
-            "dbhost": os.getenv("MILVUS_DB_HOST"),
-            "dbport": os.getenv("MILVUS_DB_PORT"),
-            "collection_name": os.getenv("MILVUS_COLLECTION_NAME"),
             "instruction_data_file": os.getenv("REQUEST_GENERATION_INPUT_FILE"),
             "request_data_file": os.getenv("REQUEST_GENERATION_OUTPUT_FILE"),
             "sentence_bert_model": os.getenv("REQUEST_GENERATION_MODEL"),
@@ -27,6 +31,7 @@ def get_config():
             "nprobe": int(os.getenv("REQUEST_GENERATION_NPROBE")),
             "limit": int(os.getenv("REQUEST_GENERATION_LIMIT")),
             "device": os.getenv("REQUEST_GENERATION_DEVICE"),
+            "max_retries": int(os.getenv("REQUEST_GENERATION_MAX_RETRIES", "3")),
         }
         return config_
     except ValueError as e_:
@@ -34,29 +39,72 @@ def get_config():
         exit(1)
 
 
-def search_embeddings(nprobe_, collection_, instruction_embeddings_, limit_):
-    search_params = {
-        "metric_type": "L2",  # 可以根据创建索引时的设置调整，如 "IP"
-        "params": {"nprobe": nprobe_}
+# 使用提示工程扩展指令，并与检索到的切片组合成请求
+def build_request(inst, slices):
+    instruction = (
+        f"Please provide a comprehensive explanation of [{inst}]."
+        f"Use the information I given in the context if it is relevant,"
+        f"or provide a well-informed response based on general knowledge."
+    )
+    return {
+        "instruction": instruction,
+        "contexts": slices,
     }
 
-    results_ = collection_.search(
-        instruction_embeddings_,
-        "embedding",
-        search_params,
-        limit=limit_
-    )
 
-    return results_
+# 带重试的检索，重试耗尽后抛出最后一次的异常
+def search_with_retry(store_, embeddings_, nprobe_, limit_, max_retries_):
+    for attempt in range(max_retries_ + 1):
+        try:
+            with metrics.span('vector_search'):
+                return store_.search(embeddings_, limit_, nprobe_)
+        except Exception as e_:
+            metrics.count('vector_search_errors_total')
+            if attempt == max_retries_:
+                raise
+            metrics.count('vector_search_retries_total')
+            delay = backoff_delay(attempt, 1, 30)
+            print(f"检索出错，{delay:.1f}秒后重试: {e_}")
+            time.sleep(delay)
+
+
+# 检索一批指令的相关切片并构建请求：整批一次检索，失败时逐条重试，只丢弃仍然失败的指令
+def search_requests(store_, batch_instructions_, batch_embeddings_, nprobe_, limit_, max_retries_=0):
+    """
+    Retrieves slices for a batch of instructions and builds their requests.
+
+    Returns:
+    - A tuple (requests, failed instructions). Requests keep the order of the instructions.
+    """
+    try:
+        results = search_with_retry(store_, batch_embeddings_, nprobe_, limit_, max_retries_)
+        return [build_request(inst, [hit['slice'] for hit in hits])
+                for inst, hits in zip(batch_instructions_, results)], []
+    except Exception as e_:
+        print(f"整批检索失败，逐条重试: {e_}")
+    batch_requests = []
+    failed = []
+    for inst, embedding in zip(batch_instructions_, batch_embeddings_):
+        try:
+            hits = search_with_retry(store_, [embedding], nprobe_, limit_, max_retries_)[0]
+            batch_requests.append(build_request(inst, [hit['slice'] for hit in hits]))
+        except Exception as e_:
+            print(f"指令检索失败，已跳过: {inst}: {e_}")
+            failed.append(inst)
+    return batch_requests, failed
+
+
+# 为一批指令生成嵌入向量，检索相关切片并构建请求
+def build_requests(model_, model_path_, store_, batch_instructions_, nprobe_, limit_, device_, max_retries_=0):
+    # 通过嵌入缓存批量生成嵌入，只为新增的指令计算
+    batch_embeddings = encode_texts(model_, model_path_, batch_instructions_, device=device_)
+    return search_requests(store_, batch_instructions_, batch_embeddings, nprobe_, limit_, max_retries_)[0]
 
 
 if __name__ == '__main__':
     # 加载环境变量
     config = get_config()
     # 从环境变量中获取配置
-    dbhost = config['dbhost']
-    dbport = config['dbport']
-    collection_name = config['collection_name']
     instruction_data_file = config['instruction_data_file']
     request_data_file = config['request_data_file']
     sentence_ber_model = config['sentence_bert_model']
@@ -65,66 +113,48 @@ if __name__ == '__main__':
     limit = config['limit']
     device = config['device']
 
-    # 获取instruction数据
-    instructions = []
-    with open(instruction_data_file, "r", encoding='utf-8') as f:
-        for line in f:
-            instructions.append(json.loads(line)['instruction'])
+    # 打开instruction数据池，按文件顺序逐批读取指令，不把所有指令加载到内存
+    try:
+        instruction_pool = DataPool(instruction_data_file).open()
+    except FileNotFoundError as e:
+        print(e)
+        exit(1)
 
     # 加载sentence-bert模型
     print("加载Sentence-BERT模型...\n")
     model = SentenceTransformer(sentence_ber_model)
 
-    # 连接到 Milvus
-    print("连接到 Milvus...\n")
-    connections.connect(alias="default", host=dbhost, port=dbport)
-
-    # 获取集合
-    print("获取集合...\n")
-    collection = Collection(name=collection_name)
-    print("开始加载集合\n")
-    collection.load()
-    print("集合加载成功\n")
+    # 连接到向量存储（Milvus或本地索引，由VECTOR_STORE选择）并加载
+    store = get_vector_store()
+    store.open()
 
-    # 对每个指令生成嵌入向量，并执行搜索
-    with open(request_data_file, 'a', encoding='utf-8') as f:
+    # 对每个指令生成嵌入向量，并执行搜索：后台线程为下一批生成嵌入，同时当前批检索并写入文件
+    batches = iter_pool_batches((record['instruction'] for record in instruction_pool.iter_records()), batch_size)
+    batch_count = -(-len(instruction_pool) // batch_size)
+    failed_instructions = []
+    with JsonlWriter(request_data_file) as writer, ThreadPoolExecutor(max_workers=1) as encoder:
         print("开始生成组合...\n")
-        for i in tqdm.tqdm(range(0, len(instructions), batch_size)):
-            batch_instructions = [instruction for instruction in instructions[i:i + batch_size]]
-            batch_requests = []
-            try:
-                # 批量生成嵌入
-                batch_embeddings = model.encode(
-                    sentences=batch_instructions,
-                    device=device,
-                )
-                # 批量执行嵌入搜索
-                batch_combinations = []
-                for inst, embedding in zip(batch_instructions, batch_embeddings):
-                    slices = []
-                    # 对单个嵌入执行搜索
-                    results = search_embeddings(nprobe, collection, embedding, limit)
-                    # 提取搜索结果的slice
-                    if results:
-                        for hits in results:
-                            for hit in hits:
-                                slices.append(hit.entity.get("slice"))
-                    # 使用提示工程扩展指令
-                    instruction = (
-                        f"Please provide a comprehensive explanation of [{inst}]."
-                        f"Use the information I given in the context if it is relevant,"
-                        f"or provide a well-informed response based on general knowledge."
-                    )
-                    request = {
-                        "instruction": instruction,
-                        "contexts": slices,
-                    }
-                    batch_requests.append(request)
-                # 将组合结果写入文件
-                for req in batch_requests:
-                    f.write(json.dumps(req) + '\n')
-                f.flush()
-            except Exception as e:
-                print(f"生成组合或搜索时出错: {e}")
+
+        def encode_batch(batch_):
+            return encode_texts(model, sentence_ber_model, batch_, device=device)
+
+        next_batch = next(batches, None)
+        next_embeddings = encoder.submit(encode_batch, next_batch) if next_batch else None
+        for _ in tqdm.tqdm(range(batch_count)):
+            batch, batch_embeddings = next_batch, next_embeddings.result()
+            next_batch = next(batches, None)
+            if next_batch:
+                next_embeddings = encoder.submit(encode_batch, next_batch)
+            batch_requests, failed = search_requests(
+                store, batch, batch_embeddings, nprobe, limit, config['max_retries'])
+            failed_instructions.extend(failed)
+            metrics.count('requests_built_total', len(batch_requests))
+            metrics.count('requests_failed_total', len(failed))
+            # 将组合结果写入文件
+            writer.write_many(batch_requests)
+    if failed_instructions:
+        print(f"{len(failed_instructions)}条指令检索失败，未生成组合\n")
     # 关闭连接
-    connections.disconnect(alias="default")
+    instruction_pool.close()
+    store.close()
+    close_embedding_caches()
@@ -0,0 +1,179 @@
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import dotenv
+
+import metrics
+
+# 进程内共享的响应缓存，由get_cache按环境变量配置创建
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM results keyed by a content hash.
+
+    Entries older than max_age_days are dropped, and beyond max_entries the least recently
+    used entries are evicted; 0 disables either limit. Hit, miss, dedup and eviction counts
+    are kept in stats.
+    """
+
+    def __init__(self, path, max_entries=0, max_age_days=0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 86400
+        self.stats = {"hits": 0, "misses": 0, "deduplicated": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._connection.commit()
+        self.evict()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite单条语句的参数数量有限，分段查询
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT key, result, created_at FROM responses WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, result, created_at in rows:
+                    if self.max_age_seconds and now - created_at > self.max_age_seconds:
+                        continue
+                    found[key] = json.loads(result)
+            if found:
+                self._connection.executemany(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._connection.commit()
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO responses (key, result, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(result, ensure_ascii=False), now, now) for key, result in items],
+            )
+            self._connection.commit()
+
+    def evict(self):
+        with self._lock:
+            evicted = 0
+            if self.max_age_seconds:
+                cursor = self._connection.execute(
+                    "DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+                )
+                evicted += cursor.rowcount
+            if self.max_entries:
+                cursor = self._connection.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                evicted += cursor.rowcount
+            self._connection.commit()
+            self.stats['evicted'] += evicted
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._connection.close()
+
+
+def make_key(backend, model, request, params, base_url=None):
+    # 以后端、服务地址、模型、请求内容和采样参数的哈希作为缓存键，不同服务上的同名模型不共用缓存
+    key = {"backend": backend, "model": model, "request": request, "params": params}
+    if base_url is not None:
+        key['base_url'] = base_url
+    payload = json.dumps(key, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cached_generation(cache, generate, requests, backend, model, params, base_url=None):
+    """
+    Serves a batch from the cache and generates only the misses.
+
+    Identical requests in the batch are generated once. Only successful results (response not
+    None) are stored.
+
+    Returns:
+    - A list of result dicts in request order.
+    """
+    keys = [make_key(backend, model, request, params, base_url) for request in requests]
+    results_by_key = cache.get_many(set(keys))
+
+    # 批内去重：相同键的请求只生成一次
+    pending = {}
+    for key, request in zip(keys, requests):
+        if key in results_by_key:
+            cache.stats['hits'] += 1
+        elif key in pending:
+            cache.stats['deduplicated'] += 1
+        else:
+            cache.stats['misses'] += 1
+            pending[key] = request
+
+    hits = sum(1 for key in keys if key in results_by_key)
+    metrics.count('response_cache_hits_total', hits, backend=backend)
+    metrics.count('response_cache_misses_total', len(pending), backend=backend)
+    metrics.count('response_cache_deduplicated_total', len(keys) - hits - len(pending), backend=backend)
+    if pending:
+        generated = generate(list(pending.values()))
+        cache.put_many([(key, result) for key, result in zip(pending, generated) if result.get('response') is not None])
+        results_by_key.update(zip(pending, generated))
+    return [dict(results_by_key[key]) for key in keys]
+
+
+def get_cache():
+    """
+    Gets the process-wide response cache configured by environment variables.
+
+    Returns:
+    - A ResponseCache, or None when RESPONSE_CACHE_PATH is not set.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            dotenv.load_dotenv()
+            path = os.getenv("RESPONSE_CACHE_PATH")
+            if not path:
+                return None
+            try:
+                max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "0"))
+                max_age_days = float(os.getenv("RESPONSE_CACHE_MAX_AGE_DAYS", "0"))
+            except ValueError as e_:
+                print(f"环境变量配置错误: {e_}")
+                exit(1)
+            _cache = ResponseCache(path, max_entries, max_age_days)
+            atexit.register(close_cache)
+        return _cache
+
+
+def close_cache():
+    # 关闭响应缓存并输出命中统计，可重复调用
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            return
+        _cache.close()
+        print(f"响应缓存统计：{_cache.stats}\n")
+        _cache = None
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+
+import dotenv
+import tqdm
+
+from jsonl_io import JsonlWriter, iter_jsonl
+from minhash import MinHashLSH, normalize_text
+from vector_store import SLICE_MIN_LENGTH
+
+
+# 加载环境变量
+def get_config():
+    """
+    Gets configuration from environment variables.
+
+    Returns:
+    - A dictionary with configuration parameters.
+    """
+    try:
+        dotenv.load_dotenv()
+        config_ = {
+            "input_file": os.getenv("SLICE_DEDUP_INPUT_FILE"),
+            "output_file": os.getenv("SLICE_DEDUP_OUTPUT_FILE"),
+            "mode": os.getenv("SLICE_DEDUP_MODE", "drop").lower(),
+            "threshold": float(os.getenv("SLICE_DEDUP_THRESHOLD", "0.9")),
+            "num_perm": int(os.getenv("MINHASH_NUM_PERM", "128")),
+            "bands": int(os.getenv("MINHASH_BANDS", "16")),
+        }
+        if config_['mode'] not in ('drop', 'merge'):
+            raise ValueError(f"未知的去重模式'{config_['mode']}'，可选drop或merge")
+        return config_
+    except ValueError as e_:
+        print(f"环境变量配置错误: {e_}")
+        exit(1)
+
+
+class SliceDeduplicator:
+    """
+    Finds slices whose text repeats an earlier slice, exactly or nearly.
+
+    Exact duplicates are found by hashing the slice text; near duplicates (boilerplate with
+    small differences in whitespace, punctuation or a few words) by MinHash/LSH over the
+    normalized text. Overlapping windows of the same document share only part of their text
+    and stay well below the threshold, so they are kept. Each duplicate is attributed to the
+    first slice it repeats. A slice deleted by a tombstone is removed again, so a later slice
+    with the same text (the unchanged part of a re-sliced document) is kept instead of being
+    attributed to a slice that no longer exists.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=128, bands=16):
+        self.exact = {}
+        self.exact_digests = {}
+        self.lexical_index = MinHashLSH(threshold, num_perm, bands)
+        self.stats = {"slices": 0, "exact_duplicates": 0, "near_duplicates": 0, "kept": 0,
+                      "saved_label_calls": 0, "saved_label_chars": 0, "saved_embedding_rows": 0}
+
+    def check(self, record):
+        """
+        Registers a slice record and checks it against the slices seen before.
+
+        Returns:
+        - The id of the slice it duplicates, or None if it is kept.
+        """
+        text = record.get('slice') or ''
+        self.stats['slices'] += 1
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        canonical_id = self.exact.get(digest)
+        if canonical_id is not None:
+            self.stats['exact_duplicates'] += 1
+        elif normalize_text(text):
+            canonical_id = self.lexical_index.check_and_add(record['id'], text)
+            if canonical_id is not None:
+                self.stats['near_duplicates'] += 1
+        if canonical_id is None:
+            self.exact[digest] = record['id']
+            self.exact_digests[record['id']] = digest
+            self.stats['kept'] += 1
+            return None
+        # 重复切片不再需要大模型标记，也不再生成嵌入入库
+        self.stats['saved_label_calls'] += 1
+        self.stats['saved_label_chars'] += len(text)
+        if len(text) > SLICE_MIN_LENGTH:
+            self.stats['saved_embedding_rows'] += 1
+        return canonical_id
+
+    def remove(self, id_):
+        # 墓碑删除的切片不再作为原始切片，之后相同内容的切片不会被当作它的重复
+        digest = self.exact_digests.pop(id_, None)
+        if digest is not None and self.exact.get(digest) == id_:
+            del self.exact[digest]
+        self.lexical_index.remove(id_)
+
+    def filter(self, records_):
+        # 流水线使用：只保留不重复的切片，墓碑记录原样保留并先从原始切片中移除被删除的切片
+        kept = []
+        for record in records_:
+            if record.get('tombstone'):
+                self.remove(record['id'])
+                kept.append(record)
+            elif self.check(record) is None:
+                kept.append(record)
+        return kept
+
+
+def dedup_slices(input_file_, output_file_, mode_, deduplicator_):
+    """
+    Writes the slices of input_file_ without duplicates to output_file_.
+
+    In drop mode duplicates are discarded. In merge mode the kept slice gets a 'duplicates'
+    list with the id, source and offset of every slice that repeats it, which needs a second
+    pass over the input since a duplicate may appear long after the slice it repeats.
+    """
+    duplicates = {}
+    deleted_ids = set()
+    print("查找重复切片...\n")
+    for record in tqdm.tqdm(iter_jsonl(input_file_)):
+        if record.get('tombstone'):
+            deleted_ids.add(record['id'])
+            deduplicator_.remove(record['id'])
+            continue
+        canonical_id = deduplicator_.check(record)
+        if canonical_id is not None:
+            duplicates.setdefault(canonical_id, []).append(
+                {"id": record['id'], "source": record.get('source'), "offset": record.get('offset')})
+    duplicate_ids = {duplicate['id'] for group in duplicates.values() for duplicate in group}
+    with JsonlWriter(output_file_, 'w', group_seconds=0) as writer:
+        for record in iter_jsonl(input_file_):
+            # 墓碑记录与被删除切片的id相同，总是原样写出
+            if not record.get('tombstone') and record['id'] in duplicate_ids:
+                continue
+            if mode_ == 'merge' and not record.get('tombstone') and record['id'] in duplicates:
+                record['duplicates'] = [duplicate for duplicate in duplicates[record['id']]
+                                        if duplicate['id'] not in deleted_ids]
+            writer.write(record)
+
+
+if __name__ == '__main__':
+    config = get_config()
+    deduplicator = SliceDeduplicator(config['threshold'], config['num_perm'], config['bands'])
+    dedup_slices(config['input_file'], config['output_file'], config['mode'], deduplicator)
+    print(f"切片去重统计：{json.dumps(deduplicator.stats, ensure_ascii=False)}\n")
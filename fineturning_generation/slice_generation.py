@@ -1,17 +1,20 @@
 import glob
-import json
 import os
+import re
+import time
 
 import dotenv
-from docx import Document
 from dotenv import load_dotenv
 
+import metrics
+from checkpoint import load_last_record, write_checkpoint
+from corpus_manifest import CorpusManifest
+from docx_text import get_config as get_docx_config, get_text_cache, iter_docx_texts, load_docx_text
+from jsonl_io import JsonlWriter
 
-# 读取docx文件，提取长文本
-def read_docx(file_path_):
-    doc = Document(file_path_)
-    full_text = ''.join([para.text for para in doc.paragraphs])
-    return full_text
+
+# 句子结束位置：中英文句末标点、英文句号后跟空白，以及换行
+SENTENCE_END = re.compile(r'[。！？；!?;]+|\.(?=\s)|\n')
 
 
 # 对给定长文本进行切片
@@ -25,25 +28,113 @@ def slice_text(full_text, length, offset):
     return slices
 
 
+# 按句子切分文本，返回每个句子的(起始, 结束)字符位置，句子之间首尾相接
+def split_sentences(full_text):
+    spans = []
+    start = 0
+    for match in SENTENCE_END.finditer(full_text):
+        spans.append((start, match.end()))
+        start = match.end()
+    if start < len(full_text):
+        spans.append((start, len(full_text)))
+    return spans
+
+
+# 将文本切分为不超过max_tokens个token的单元：一般为一个句子，超长的句子按token偏移继续切分
+def token_units(full_text, tokenizer_, max_tokens_):
+    spans = split_sentences(full_text)
+    if not spans:
+        return []
+    # 所有句子一次批量分词，由offset mapping得到token在句子中的字符位置
+    encodings = tokenizer_(
+        [full_text[start:end] for start, end in spans], add_special_tokens=False, return_offsets_mapping=True)
+    units = []
+    for (start, end), offsets in zip(spans, encodings['offset_mapping']):
+        if len(offsets) <= max_tokens_:
+            units.append((start, end, len(offsets)))
+            continue
+        for first in range(0, len(offsets), max_tokens_):
+            piece_start = start if first == 0 else start + offsets[first][0]
+            piece_end = start + offsets[first + max_tokens_][0] if first + max_tokens_ < len(offsets) else end
+            units.append((piece_start, piece_end, min(max_tokens_, len(offsets) - first)))
+    return units
+
+
+# 按token数切片：每片不超过max_tokens个token，相邻切片重叠不超过overlap_tokens个token，切分点落在句子边界上
+def slice_text_by_tokens(full_text, tokenizer_, max_tokens_, overlap_tokens_):
+    """
+    Slices text into windows of at most max_tokens_ tokens that start and end on sentence boundaries.
+
+    Consecutive windows share trailing sentences of the previous window, up to overlap_tokens_
+    tokens. Sentences longer than max_tokens_ are cut at token boundaries.
+
+    Returns:
+    - A list of (text, character offset, token count) tuples. The token count is the sum of the
+      per-sentence counts, which may differ by a token or two from encoding the slice at once.
+    """
+    units = token_units(full_text, tokenizer_, max_tokens_)
+    slices = []
+    i_ = 0
+    while i_ < len(units):
+        j_ = i_
+        tokens = 0
+        while j_ < len(units) and tokens + units[j_][2] <= max_tokens_:
+            tokens += units[j_][2]
+            j_ += 1
+        start, end = units[i_][0], units[j_ - 1][1]
+        slices.append((full_text[start:end], start, tokens))
+        if j_ == len(units):
+            break
+        # 下一片从本片末尾的若干句子开始，重叠部分不超过overlap_tokens，
+        # 且需留出本片之后下一个单元的位置，保证下一片不会完全包含在本片之内
+        k_ = j_
+        overlap = 0
+        while (k_ - 1 > i_ and overlap + units[k_ - 1][2] <= overlap_tokens_
+               and overlap + units[k_ - 1][2] + units[j_][2] <= max_tokens_):
+            k_ -= 1
+            overlap += units[k_][2]
+        i_ = k_
+    return slices
+
+
+def get_slicer(config_):
+    """
+    Builds the slicing function selected by SLICE_GENERATION_MODE.
+
+    Returns:
+    - A function mapping a document text to a list of (text, offset, token count or None).
+    """
+    if config_['mode'] == 'token':
+        from transformers import AutoTokenizer
+
+        tokenizer_ = AutoTokenizer.from_pretrained(config_['tokenizer'], use_fast=True)
+        return lambda full_text: slice_text_by_tokens(
+            full_text, tokenizer_, config_['max_tokens'], config_['overlap_tokens'])
+    return lambda full_text: [
+        (text, offset, None) for text, offset in slice_text(full_text, config_['slice_length'], config_['slice_offset_unit'])
+    ]
+
+
 # 加载上次的处理记录，获取下一次处理的相关信息
-def load_record(jsonl_file):
+def load_record(jsonl_file, input_file_folder_, slicer_, text_cache_=None):
     # 如果输出文件不存在，抛出异常
     if not os.path.exists(jsonl_file):
         raise FileNotFoundError(f"无法找到JSONL文件'{jsonl_file}'")
-    with open(jsonl_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
+    # 从检查点或文件末尾读取最后一条记录，不读取整个文件
+    last_record = load_last_record(jsonl_file)
     # 如果文件内容为空,从第一个文件，偏移为0的位置开始, id从0开始
-    if not lines:
+    if last_record is None:
         return 0, 0, 0
+    if last_record.get('tombstone'):
+        print('切片池末尾为同步模式写入的墓碑记录，请使用同步模式（SLICE_GENERATION_SYNC=1）')
+        exit(1)
 
-    # 读取最后一行的记录
-    last_record = json.loads(lines[-1])
     last_id_ = last_record['id']
     last_file_path_ = last_record['source']
     last_offset_ = last_record['offset']
 
     # 加载文件列表
-    docx_files_ = glob.glob(os.path.join(input_file_folder, '*.docx'))
+    docx_files_ = glob.glob(os.path.join(input_file_folder_, '*.docx'))
     docx_files_.sort()
     # 确定下一个切片的id
     next_id_ = last_id_ + 1
@@ -55,15 +146,14 @@ def load_record(jsonl_file):
             last_file_index_ = i_
             break
 
-    # 获取当前文件字节大小
-    full_text_ = read_docx(docx_files_[last_file_index_])
-    file_length_ = len(full_text_)
+    # 获取当前文件文本，文本缓存命中时不重新解析docx
+    full_text_ = load_docx_text(docx_files_[last_file_index_], text_cache_)
 
-    # 确定下一次的文件偏移位置,上次的切片偏移开始位置+切片偏移 = 下一次切片偏移起始位置
-    next_offset_ = min(last_offset_ + slice_offset_unit, file_length_)
+    # 重新切分当前文件，下一个切片为偏移位置在上次切片之后的第一个切片
+    next_offsets = [offset for _, offset, _ in slicer_(full_text_) if offset > last_offset_]
 
     # 当前文件是否处理完
-    if file_length_ == next_offset_:
+    if not next_offsets:
         # 当前文件已经处理完，处理下一个文件
         if last_file_index_ == len(docx_files_) - 1:
             # 所有文件已经处理完
@@ -77,29 +167,128 @@ def load_record(jsonl_file):
     else:
         # 当前文件未处理完，继续处理当前文件
         next_file_index_ = last_file_index_
+        next_offset_ = next_offsets[0]
     return next_id_, next_file_index_, next_offset_
 
 
-def process_docx_file(file_path_, slice_length_, slice_offset_, output_file_, id_start_, start_offset_):
-    # 读取文档文本
-    full_text = read_docx(file_path_)
+def build_slice_record(id_, file_path_, text, offset, tokens=None):
+    record = {
+        "id": id_,
+        "source": file_path_,
+        "slice": text,
+        "offset": offset,
+        "isLabeled": False,
+        "labels": []
+    }
+    # 按token切片时记录token数，后续阶段据此控制prompt长度，无需重新分词
+    if tokens is not None:
+        record['tokens'] = tokens
+    return record
 
-    # 对文本进行切片，从start_offset开始
-    sliced_texts = slice_text(full_text[start_offset_:], slice_length_, slice_offset_)
 
-    # 将切片结果写入 JSONL 文件
-    with open(output_file_, 'a', encoding='utf-8') as f:
-        for i_, (text, offset) in enumerate(sliced_texts):
-            record = {
-                "id": id_start_ + i_,
-                "source": file_path_,
-                "slice": text,
-                "offset": start_offset_ + offset,
-                "isLabeled": False,
-                "labels": []
-            }
-            f.write(json.dumps(record) + '\n')
-    return id_start_ + len(sliced_texts)  # 返回下一个可用的id
+# 对一个文档的全文切片，只保留偏移位置不小于start_offset的切片，续跑时与整篇切分的结果一致
+def build_file_records(file_path_, full_text, slicer_, id_start_, start_offset_=0):
+    slices = [(text, offset, tokens) for text, offset, tokens in slicer_(full_text) if offset >= start_offset_]
+    return [
+        build_slice_record(id_start_ + i_, file_path_, text, offset, tokens)
+        for i_, (text, offset, tokens) in enumerate(slices)
+    ]
+
+
+# 逐个文件读取并切片，按需产生切片记录，不在内存中保留整个切片池；文档由进程池并行解析
+def iter_slice_records(docx_files_, slicer_, id_start_=0, start_offset_=0, text_cache_=None, workers_=1):
+    next_id_ = id_start_
+    for file_path_, full_text in iter_docx_texts(docx_files_, text_cache_, workers_):
+        records = build_file_records(file_path_, full_text, slicer_, next_id_, start_offset_)
+        yield from records
+        next_id_ += len(records)
+        start_offset_ = 0
+
+
+def process_docx_file(file_path_, full_text_, slicer_, output_file_, id_start_, start_offset_, manifest_=None):
+    # 从start_offset开始切片
+    with metrics.span('slice_document'):
+        records = build_file_records(file_path_, full_text_, slicer_, id_start_, start_offset_)
+    metrics.count('slices_total', len(records))
+
+    # 将切片结果写入 JSONL 文件，一个文档的切片作为一组提交
+    with JsonlWriter(output_file_, group_seconds=0) as writer:
+        writer.write_many(records)
+    # 文件写入完成后更新检查点和文档清单
+    if records:
+        write_checkpoint(output_file_, records[-1])
+    if manifest_ is not None:
+        manifest_.record_file(file_path_, records, append=start_offset_ > 0)
+        manifest_.save()
+    return id_start_ + len(records)  # 返回下一个可用的id
+
+
+def load_manifest(output_file_):
+    # 加载切片池的文档清单，旧版本生成的切片池没有清单时根据切片池重建
+    manifest_ = CorpusManifest.for_output(output_file_)
+    if not manifest_.exists and os.path.getsize(output_file_) > 0:
+        print("文档清单不存在，根据已有切片池重建...\n")
+        manifest_.rebuild(output_file_)
+        manifest_.save()
+    return manifest_
+
+
+def delta_path(output_file_):
+    root, ext = os.path.splitext(output_file_)
+    return f"{root}.delta-{time.strftime('%Y%m%d%H%M%S')}{ext}"
+
+
+# 同步模式：只切分新增或修改过的文档，为已删除或修改过的文档的旧切片写出墓碑
+def sync_slices(output_file_, docx_files_, slicer_, manifest_, text_cache_=None, workers_=1):
+    """
+    Brings the slice pool in line with the documents currently in the input folder.
+
+    Tombstones and new slices are appended to the pool and also written to a delta file, so
+    downstream stages can process only the changes. Tombstones precede the new slices of a
+    changed document, and ids continue from the manifest.
+
+    Returns:
+    - The path of the delta file, or None if nothing changed.
+    """
+    current = set(docx_files_)
+    deleted = [file_path_ for file_path_ in manifest_.files if file_path_ not in current]
+    changed = [file_path_ for file_path_ in docx_files_ if not manifest_.is_unchanged(file_path_)]
+    if not deleted and not changed:
+        manifest_.save()
+        print('文档没有变化，无需同步')
+        return None
+
+    delta_file = delta_path(output_file_)
+    stats = {"deleted_files": len(deleted), "new_or_changed_files": len(changed), "tombstones": 0, "slices": 0}
+    with JsonlWriter(output_file_, group_seconds=0) as pool, JsonlWriter(delta_file, 'w', group_seconds=0) as delta:
+        # 每个文档的记录作为一组提交，提交后才更新检查点和文档清单
+        def write_records(records):
+            pool.write_many(records)
+            delta.write_many(records)
+            pool.commit()
+            delta.commit()
+            if records:
+                write_checkpoint(output_file_, records[-1])
+
+        for file_path_ in deleted:
+            print(f'文档已删除: {file_path_}')
+            tombstones = manifest_.tombstones(file_path_)
+            write_records(tombstones)
+            manifest_.save()
+            stats['tombstones'] += len(tombstones)
+        for file_path_, full_text in iter_docx_texts(changed, text_cache_, workers_):
+            print(f'正在处理文件: {file_path_}')
+            tombstones = manifest_.tombstones(file_path_)
+            with metrics.span('slice_document'):
+                records = build_file_records(file_path_, full_text, slicer_, manifest_.next_id)
+            metrics.count('slices_total', len(records))
+            write_records(tombstones + records)
+            manifest_.record_file(file_path_, records)
+            manifest_.save()
+            stats['tombstones'] += len(tombstones)
+            stats['slices'] += len(records)
+    print(f"同步完成，增量文件'{delta_file}'：{stats}")
+    return delta_file
 
 
 def get_config():
@@ -116,7 +305,14 @@ def get_config():
             "output_file": os.getenv("SLICE_GENERATION_OUTPUT_FILE"),
             "slice_length": int(os.getenv("SLICE_GENERATION_LENGTH")),
             "slice_offset_unit": int(os.getenv("SLICE_GENERATION_OFFSET_UNIT")),
+            "mode": os.getenv("SLICE_GENERATION_MODE", "char").lower(),
+            "tokenizer": os.getenv("SLICE_GENERATION_TOKENIZER") or os.getenv("MODEL_PATH"),
+            "max_tokens": int(os.getenv("SLICE_GENERATION_MAX_TOKENS", "512")),
+            "overlap_tokens": int(os.getenv("SLICE_GENERATION_OVERLAP_TOKENS", "64")),
         }
+        config_['sync'] = os.getenv("SLICE_GENERATION_SYNC", "0") == "1"
+        if config_['mode'] not in ('char', 'token'):
+            raise ValueError(f"未知的切片模式'{config_['mode']}'，可选char或token")
         return config_
     except ValueError as e_:
         print(f"环境变量配置错误: {e_}")
@@ -128,23 +324,37 @@ if __name__ == '__main__':
     config = get_config()
     input_file_folder = config.get('input_file_folder')  # 参考文件路径
     output_file = config.get('output_file')  # 切片文件路径
-    slice_length = config.get('slice_length')  # 切片大小
-    slice_offset_unit = config.get('slice_offset_unit')  # 切片间隔
+    # 按字符数（SLICE_GENERATION_LENGTH/OFFSET_UNIT）或按token数（SLICE_GENERATION_MAX_TOKENS/OVERLAP_TOKENS）切片
+    slicer = get_slicer(config)
 
-    # 加载已处理的文件偏移记录和最高id
-    try:
-        next_id, next_file_index, next_file_offset = load_record(output_file)
-    except FileNotFoundError as e:
-        print(e)
+    # 文档文本缓存和并行解析的进程数
+    docx_config = get_docx_config()
+    text_cache = get_text_cache(docx_config)
+
+    # 检查输出文件
+    if not os.path.exists(output_file):
+        print(f"无法找到JSONL文件'{output_file}'")
         exit(1)
 
     # 获取文件夹中的所有DOCX文件
     docx_files = glob.glob(os.path.join(input_file_folder, '*.docx'))
     docx_files.sort()
 
-    # 根据上次的记录继续处理
-    for i in range(next_file_index, len(docx_files)):
-        file_path = docx_files[i]
-        print(f'正在处理文件: {file_path}')
-        next_id = process_docx_file(file_path, slice_length, slice_offset_unit, output_file, next_id, next_file_offset)
-        next_file_offset = 0
+    # 文档清单记录每个已处理文档的大小、修改时间、内容哈希和切片
+    manifest = load_manifest(output_file)
+
+    if config['sync']:
+        # 同步模式：只处理新增、修改和删除的文档，并写出增量文件供下游阶段使用
+        sync_slices(output_file, docx_files, slicer, manifest, text_cache, docx_config['workers'])
+    else:
+        # 加载已处理的文件偏移记录和最高id
+        next_id, next_file_index, next_file_offset = load_record(output_file, input_file_folder, slicer, text_cache)
+
+        # 根据上次的记录继续处理，后面的文档在进程池中解析，与当前文档的切片写入同时进行
+        for file_path, full_text in iter_docx_texts(docx_files[next_file_index:], text_cache, docx_config['workers']):
+            print(f'正在处理文件: {file_path}')
+            next_id = process_docx_file(
+                file_path, full_text, slicer, output_file, next_id, next_file_offset, manifest)
+            next_file_offset = 0
+    if text_cache is not None:
+        print(f"文档文本缓存统计：{text_cache.stats}")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 各脚本按模块名互相导入，测试从fineturning_generation目录导入模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,9 @@
+from data_label import build_label_record
+
+
+def test_label_record_keeps_token_count():
+    data = {"id": 3, "source": 'a.docx', "slice": "切片内容", "offset": 120, "tokens": 87,
+            "isLabeled": False, "labels": []}
+    assert build_label_record(data, 'slice', ['A'])['tokens'] == 87
+    del data['tokens']
+    assert 'tokens' not in build_label_record(data, 'slice', ['A'])
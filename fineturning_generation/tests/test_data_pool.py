@@ -0,0 +1,30 @@
+from data_pool import DataPool, convert_pool
+from jsonl_io import JsonlWriter
+
+
+def write_pool(path, records, mode='w'):
+    with JsonlWriter(path, mode, group_seconds=0) as writer:
+        writer.write_many(records)
+
+
+def test_append_reuses_index(tmp_path):
+    path = str(tmp_path / 'pool.jsonl')
+    write_pool(path, [{"id": i, "slice": f"切片{i}"} for i in range(5)])
+    assert convert_pool(path)['added'] == 5
+    write_pool(path, [{"id": i, "slice": f"切片{i}"} for i in range(5, 8)], 'a')
+    assert convert_pool(path) == {"records": 8, "with_id": 8, "added": 3}
+    with DataPool(path) as pool:
+        assert [record['id'] for record in pool.iter_by_id(3)] == [4, 5, 6, 7]
+
+
+def test_rewritten_pool_is_indexed_again(tmp_path):
+    path = str(tmp_path / 'pool.jsonl')
+    write_pool(path, [{"id": i, "slice": f"旧切片{i}"} for i in range(6)])
+    with DataPool(path) as pool:
+        assert pool.get_by_id(2)['slice'] == '旧切片2'
+    # 用'w'模式原地改写为长度相同、内容不同的数据池，旧索引不能继续使用
+    write_pool(path, [{"id": 5 - i, "slice": f"新切片{5 - i}"} for i in range(6)])
+    with DataPool(path) as pool:
+        assert pool.get(0)['id'] == 5
+        assert pool.get_by_id(2)['slice'] == '新切片2'
+        assert [record['id'] for record in pool.iter_by_id()] == list(range(6))
@@ -0,0 +1,46 @@
+import os
+
+from docx import Document
+
+from docx_text import DocxTextCache, iter_docx_texts, read_docx
+
+
+def write_docs(tmp_path, count):
+    files = []
+    for i in range(count):
+        document = Document()
+        document.add_paragraph(f"第{i}个文档的内容。" * 10)
+        files.append(str(tmp_path / f'{i}.docx'))
+        document.save(files[-1])
+    return files
+
+
+def test_cached_texts_are_read_when_yielded(tmp_path, monkeypatch):
+    files = write_docs(tmp_path, 4)
+    cache = DocxTextCache(str(tmp_path / 'cache'))
+    for file_path in files[:3]:
+        cache.put(file_path, read_docx(file_path))
+    reads = []
+    read_entry = DocxTextCache.read_entry
+    monkeypatch.setattr(DocxTextCache, 'read_entry', staticmethod(lambda path: reads.append(path) or read_entry(path)))
+
+    texts = iter_docx_texts(files, cache)
+    assert next(texts) == (files[0], read_docx(files[0]))
+    # 取出第一个文档时只读取了它自己的缓存文件
+    assert len(reads) == 1
+    assert list(texts) == [(file_path, read_docx(file_path)) for file_path in files[1:]]
+    assert len(reads) == 3
+    assert cache.stats == {"hits": 3, "misses": 1}
+
+
+def test_cache_entry_removed_after_lookup_is_parsed_again(tmp_path):
+    files = write_docs(tmp_path, 2)
+    cache = DocxTextCache(str(tmp_path / 'cache'))
+    for file_path in files:
+        cache.put(file_path, read_docx(file_path))
+
+    texts = iter_docx_texts(files, cache)
+    assert next(texts) == (files[0], read_docx(files[0]))
+    os.remove(cache.entry_path(files[1]))
+    assert list(texts) == [(files[1], read_docx(files[1]))]
+    assert os.path.exists(cache.entry_path(files[1]))
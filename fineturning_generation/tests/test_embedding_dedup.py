@@ -0,0 +1,50 @@
+import hashlib
+
+import numpy as np
+
+from embedding_dedup import EmbeddingDeduplicator
+
+DIM = 8
+
+
+class FakeEmbedder:
+    # 按文本哈希生成的单位向量，不同文本几乎正交
+
+    def get_sentence_embedding_dimension(self):
+        return DIM
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        embeddings = np.asarray([np.frombuffer(hashlib.sha256(text.encode('utf-8')).digest()[:DIM], dtype=np.uint8)
+                                 for text in texts], dtype=np.float32).reshape(-1, DIM) - 127.5
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+def make_deduplicator(tmp_path):
+    return EmbeddingDeduplicator(FakeEmbedder(), 'fake', str(tmp_path / 'embeddings.f32'), 0.99)
+
+
+def test_append_grows_buffer_geometrically(tmp_path, monkeypatch):
+    monkeypatch.setenv('EMBEDDING_CACHE_DIR', '')
+    deduplicator = make_deduplicator(tmp_path)
+    texts = [f"指令{i}" for i in range(5)]
+    deduplicator.sync(texts)
+    expected = [deduplicator.encode(texts)]
+    capacities = set()
+    for batch in range(40):
+        accepted, embeddings = deduplicator.filter([f"批次{batch}指令{i}" for i in range(3)] + texts[:1])
+        assert len(accepted) == 3
+        deduplicator.append(embeddings)
+        expected.append(embeddings)
+        capacities.add(deduplicator.buffer.shape[0])
+    expected = np.vstack(expected)
+    assert np.array_equal(deduplicator.matrix, expected)
+    # 125行只经过几次翻倍扩容
+    assert len(capacities) <= 5
+
+    reopened = make_deduplicator(tmp_path)
+    assert np.array_equal(reopened.matrix, expected)
+    reopened.sync(texts)
+    assert np.array_equal(reopened.matrix, expected[:len(texts)])
+    assert np.array_equal(make_deduplicator(tmp_path).matrix, expected[:len(texts)])
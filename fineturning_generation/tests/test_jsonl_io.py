@@ -0,0 +1,13 @@
+from jsonl_io import JsonlWriter, iter_jsonl
+
+
+def test_write_many_commits_a_batch_at_once(tmp_path):
+    path = str(tmp_path / 'out.jsonl')
+    commits = []
+    with JsonlWriter(path, 'w', group_records=4, group_bytes=1 << 20, group_seconds=0,
+                     on_commit=lambda record: commits.append((record['id'], len(list(iter_jsonl(path)))))) as writer:
+        writer.write_many({"id": i} for i in range(3))
+        writer.write_many({"id": i} for i in range(3, 10))
+        writer.write_many({"id": i} for i in range(10, 11))
+    # 达到阈值的一批整体提交，检查点不会指向一批的中间
+    assert commits == [(9, 10), (10, 11)]
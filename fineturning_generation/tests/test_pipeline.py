@@ -0,0 +1,29 @@
+import threading
+
+from jsonl_io import iter_jsonl
+from pipeline import JsonlTee
+
+
+def test_tee_numbers_records_in_file_order(tmp_path):
+    path = str(tmp_path / 'finetune.jsonl')
+    next_id = [0]
+
+    def assign_ids(records):
+        for record in records:
+            record['id'] = next_id[0]
+            next_id[0] += 1
+
+    def write(worker):
+        for batch in range(50):
+            tee.write([{"worker": worker, "batch": batch, "item": item} for item in range(3)])
+
+    tee = JsonlTee(path, before_write=assign_ids)
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tee.close()
+
+    # 多个线程同时写入时，文件中的id仍然从0开始连续递增
+    assert [record['id'] for record in iter_jsonl(path)] == list(range(8 * 50 * 3))
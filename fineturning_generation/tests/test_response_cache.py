@@ -0,0 +1,23 @@
+from response_cache import ResponseCache, cached_generation
+
+
+def test_cache_is_keyed_by_base_url(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'))
+    calls = []
+
+    def generate(base_url):
+        def run(prompts):
+            calls.append((base_url, list(prompts)))
+            return [{"response": f"{base_url}: {prompt}"} for prompt in prompts]
+        return run
+
+    params = {"temperature": 0}
+    first = cached_generation(cache, generate('http://a/v1'), ['p'], 'openai', 'model', params, 'http://a/v1')
+    second = cached_generation(cache, generate('http://b/v1'), ['p'], 'openai', 'model', params, 'http://b/v1')
+    again = cached_generation(cache, generate('http://a/v1'), ['p'], 'openai', 'model', params, 'http://a/v1')
+    cache.close()
+
+    # 同名模型在不同服务上的响应分开缓存，同一服务的重复请求命中缓存
+    assert [result['response'] for result in first + second + again] == [
+        'http://a/v1: p', 'http://b/v1: p', 'http://a/v1: p']
+    assert calls == [('http://a/v1', ['p']), ('http://b/v1', ['p'])]
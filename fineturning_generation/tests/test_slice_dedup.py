@@ -0,0 +1,44 @@
+from corpus_manifest import build_tombstone
+from jsonl_io import JsonlWriter, iter_jsonl
+from slice_dedup import SliceDeduplicator, dedup_slices
+
+
+def slice_record(id_, source, offset, text):
+    return {"id": id_, "source": source, "offset": offset, "slice": text}
+
+
+TEXT_A = "甲文档第一段的内容，" * 20
+TEXT_B = "甲文档第二段的内容，" * 20
+TEXT_C = "丙文档新写的内容，" * 20
+
+# 首次切片、文档修改后重新切片（先写旧切片的墓碑，再写新切片，第一段内容不变），以及另一文档中的重复切片
+RECORDS = [
+    slice_record(0, 'a.docx', 0, TEXT_A),
+    slice_record(1, 'a.docx', 200, TEXT_B),
+    build_tombstone(0, 'a.docx', 0),
+    build_tombstone(1, 'a.docx', 200),
+    slice_record(2, 'a.docx', 0, TEXT_A),
+    slice_record(3, 'a.docx', 200, TEXT_C),
+    slice_record(4, 'b.docx', 0, TEXT_A),
+]
+
+
+def test_dedup_keeps_resliced_text_and_tombstones(tmp_path):
+    input_file = str(tmp_path / 'slices.jsonl')
+    output_file = str(tmp_path / 'deduplicated.jsonl')
+    with JsonlWriter(input_file, 'w', group_seconds=0) as writer:
+        writer.write_many(RECORDS)
+    dedup_slices(input_file, output_file, 'merge', SliceDeduplicator())
+
+    records = list(iter_jsonl(output_file))
+    assert [(record['id'], bool(record.get('tombstone'))) for record in records] == [
+        (0, False), (1, False), (0, True), (1, True), (2, False), (3, False)]
+    assert records[4]['duplicates'] == [{"id": 4, "source": 'b.docx', "offset": 0}]
+
+
+def test_filter_keeps_resliced_text_and_tombstones():
+    deduplicator = SliceDeduplicator()
+    kept = deduplicator.filter(RECORDS[:3]) + deduplicator.filter(RECORDS[3:])
+    assert [(record['id'], bool(record.get('tombstone'))) for record in kept] == [
+        (0, False), (1, False), (0, True), (1, True), (2, False), (3, False)]
+    assert deduplicator.stats['exact_duplicates'] == 1
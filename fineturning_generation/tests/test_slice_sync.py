@@ -0,0 +1,170 @@
+import hashlib
+import os
+
+import numpy as np
+import pytest
+from docx import Document
+
+import data_label
+from corpus_manifest import CorpusManifest
+from data_pool import DataPool
+from embedding_generation import apply_slices, iter_batches, iter_slices
+from jsonl_io import iter_jsonl
+from slice_generation import get_slicer, sync_slices
+from vector_store import SLICE_MIN_LENGTH, LocalStore, slice_key
+
+DIM = 8
+
+
+def write_docx(path, paragraphs):
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def paragraphs(name, count):
+    return [f"{name}第{i}段：" + f"{name}的内容{i}，" * 20 for i in range(count)]
+
+
+def fake_generation(requests_, *args, **kwargs):
+    return [{"response": "['A']"} for _ in requests_]
+
+
+def fake_embeddings(texts):
+    return np.asarray([np.frombuffer(hashlib.sha256(text.encode('utf-8')).digest()[:DIM * 4], dtype=np.float32)
+                       for text in texts], dtype=np.float32)
+
+
+def label(input_file, labeled_file):
+    with DataPool(input_file) as pool:
+        data_label.label_file(pool, labeled_file, 'slice', 'prefix', 4, generation_=fake_generation)
+
+
+def embed(labeled_file, store_directory, start_offset):
+    # 与embedding_generation.py相同：从上次的文件偏移继续，按文件顺序写入向量存储
+    store = LocalStore(store_directory, DIM, 4, index_type='FLAT')
+    store.create()
+    offset = start_offset
+    for batch, offset in iter_batches(iter_slices(labeled_file, start_offset), 3):
+        texts = [record['slice'] for record in batch if not record.get('tombstone')]
+        apply_slices(store, batch, fake_embeddings(texts))
+    return offset
+
+
+def live_slices(pool_file):
+    # 切片池中未被墓碑删除、会存入向量存储的切片
+    records = {}
+    for record in iter_jsonl(pool_file):
+        if record.get('tombstone'):
+            records.pop(record['id'], None)
+        else:
+            records[record['id']] = record
+    return {slice_key(record): record['slice'] for record in records.values()
+            if len(record['slice']) > SLICE_MIN_LENGTH}
+
+
+def stored_slices(store_directory):
+    store = LocalStore(store_directory, DIM, 4, index_type='FLAT')
+    store.open()
+    return {key: store.get_slice(row) for key, row in store.keys.items()}
+
+
+@pytest.mark.parametrize('label_input', ['pool', 'delta'])
+def test_sync_after_labeling_deletes_old_rows(tmp_path, label_input):
+    documents = tmp_path / 'documents'
+    documents.mkdir()
+    changed_doc = str(documents / 'a.docx')
+    deleted_doc = str(documents / 'b.docx')
+    write_docx(changed_doc, paragraphs('甲', 6))
+    write_docx(deleted_doc, paragraphs('乙', 4))
+    pool_file = str(tmp_path / 'slices.jsonl')
+    labeled_file = str(tmp_path / 'labeled.jsonl')
+    store_directory = str(tmp_path / 'store')
+    open(pool_file, 'w').close()
+    open(labeled_file, 'w').close()
+    slicer = get_slicer({"mode": "char", "slice_length": 150, "slice_offset_unit": 150})
+
+    # 首次同步、标记并嵌入入库
+    manifest = CorpusManifest.for_output(pool_file)
+    first_delta = sync_slices(pool_file, [changed_doc, deleted_doc], slicer, manifest)
+    label(pool_file if label_input == 'pool' else first_delta, labeled_file)
+    offset = embed(labeled_file, store_directory, 0)
+    old_slices = live_slices(pool_file)
+    assert stored_slices(store_directory) == old_slices
+
+    # 修改一个文档的后半部分并删除另一个文档，再同步、标记和嵌入增量
+    write_docx(changed_doc, paragraphs('甲', 3) + paragraphs('丙', 3))
+    os.utime(changed_doc, (1, 1))
+    manifest = CorpusManifest.for_output(pool_file)
+    delta = sync_slices(pool_file, [changed_doc], slicer, manifest)
+    label(pool_file if label_input == 'pool' else delta, labeled_file)
+    embed(labeled_file, store_directory, offset)
+
+    new_slices = live_slices(pool_file)
+    stored = stored_slices(store_directory)
+    assert stored == new_slices
+    assert not any('乙' in text for text in stored.values())
+    assert any('丙' in text for text in stored.values())
+    # 修改前的旧切片（内容已不在文档中）都已删除
+    assert not set(old_slices.items()) - set(new_slices.items()) & set(stored.items())
+
+
+def test_resume_does_not_relabel_after_tombstones(tmp_path):
+    documents = tmp_path / 'documents'
+    documents.mkdir()
+    doc = str(documents / 'a.docx')
+    write_docx(doc, paragraphs('甲', 4))
+    pool_file = str(tmp_path / 'slices.jsonl')
+    labeled_file = str(tmp_path / 'labeled.jsonl')
+    open(pool_file, 'w').close()
+    open(labeled_file, 'w').close()
+    slicer = get_slicer({"mode": "char", "slice_length": 150, "slice_offset_unit": 150})
+
+    sync_slices(pool_file, [doc], slicer, CorpusManifest.for_output(pool_file))
+    label(pool_file, labeled_file)
+    sync_slices(pool_file, [], slicer, CorpusManifest.for_output(pool_file))
+    label(pool_file, labeled_file)
+    # 墓碑记录写在最后，再次运行时不会按墓碑的旧id重新标记，也不会重复写出墓碑
+    label(pool_file, labeled_file)
+
+    records = list(iter_jsonl(labeled_file))
+    tombstones = [record['id'] for record in records if record.get('tombstone')]
+    labeled = [record['id'] for record in records if not record.get('tombstone')]
+    assert sorted(tombstones) == sorted(labeled)
+    assert len(set(labeled)) == len(labeled)
+
+
+def test_resume_reads_checkpoint_instead_of_scanning(tmp_path, monkeypatch):
+    documents = tmp_path / 'documents'
+    documents.mkdir()
+    doc_a = str(documents / 'a.docx')
+    doc_b = str(documents / 'b.docx')
+    write_docx(doc_a, paragraphs('甲', 4))
+    write_docx(doc_b, paragraphs('乙', 4))
+    pool_file = str(tmp_path / 'slices.jsonl')
+    labeled_file = str(tmp_path / 'labeled.jsonl')
+    open(pool_file, 'w').close()
+    open(labeled_file, 'w').close()
+    slicer = get_slicer({"mode": "char", "slice_length": 150, "slice_offset_unit": 150})
+    sync_slices(pool_file, [doc_a, doc_b], slicer, CorpusManifest.for_output(pool_file))
+    label(pool_file, labeled_file)
+
+    # 检查点与输出文件一致时，重启只读取新追加的墓碑，不扫描输出文件和整个数据池
+    def full_scan(output_file_):
+        raise AssertionError('不应扫描整个输出文件')
+
+    monkeypatch.setattr(data_label, 'scan_labeled_output', full_scan)
+    sync_slices(pool_file, [doc_a], slicer, CorpusManifest.for_output(pool_file))
+    label(pool_file, labeled_file)
+    label(pool_file, labeled_file)
+    monkeypatch.undo()
+
+    # 检查点丢失时回退到完整扫描，结果相同
+    expected = list(iter_jsonl(labeled_file))
+    os.remove(labeled_file + '.ckpt')
+    label(pool_file, labeled_file)
+    assert list(iter_jsonl(labeled_file)) == expected
+    tombstones = [record['id'] for record in expected if record.get('tombstone')]
+    assert tombstones and len(set(tombstones)) == len(tombstones)
+    assert all('乙' in record['slice'] for record in expected if record['id'] in tombstones and 'slice' in record)
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+from vector_store import LocalStore, MilvusStore
+
+DIM = 4
+NLIST = 2
+# 与Milvus的对比测试需要一个可用的Milvus服务，使用单独的测试集合
+MILVUS_TEST_COLLECTION = 'fineturning_vector_store_parity_test'
+
+
+def local_store(tmp_path):
+    return LocalStore(str(tmp_path / 'store'), DIM, NLIST, index_type='IVF_FLAT')
+
+
+def milvus_store(tmp_path):
+    if not os.getenv('MILVUS_TEST_HOST'):
+        pytest.skip('设置MILVUS_TEST_HOST（和MILVUS_TEST_PORT）后才运行Milvus对比测试')
+    pytest.importorskip('pymilvus')
+    from pymilvus import utility
+
+    store = MilvusStore(os.getenv('MILVUS_TEST_HOST'), os.getenv('MILVUS_TEST_PORT', '19530'),
+                        MILVUS_TEST_COLLECTION, DIM, 256, NLIST)
+    if utility.has_collection(MILVUS_TEST_COLLECTION):
+        utility.drop_collection(MILVUS_TEST_COLLECTION)
+    return store
+
+
+def vector(*values):
+    return np.asarray(values, dtype=np.float32)
+
+
+# 依次插入、用新内容重新插入同一主键、删除、在一批内重复同一主键之后，应当保留的切片和向量
+LIVE = {"slice-1": vector(1, 0, 0, 0), "slice-2-new": vector(0, 0, 0, 1), "slice-4": vector(1, 1, 1, 1)}
+# 检索向量，与各切片的距离互不相同
+QUERIES = np.stack([vector(1, 0, 0, 0), vector(0, 1, 0, 0.2), vector(0.1, 0, 1, 0), vector(0, 0, 0, 1)])
+
+
+def run_sequence(store):
+    store.create()
+    store.insert(np.stack([vector(1, 0, 0, 0), vector(0, 1, 0, 0), vector(0, 0, 1, 0)]),
+                 ['slice-1', 'slice-2', 'slice-3'], [11, 12, 13])
+    store.insert(np.stack([vector(0, 0, 0, 1)]), ['slice-2-new'], [12])
+    store.delete([13])
+    store.insert(np.stack([vector(1, 1, 0, 0), vector(1, 1, 1, 1)]), ['slice-4-first', 'slice-4'], [14, 14])
+    store.finish()
+    results = store.search(QUERIES, 10, NLIST)
+    return [[hit['slice'] for hit in hits] for hits in results], [[hit['distance'] for hit in hits] for hits in results]
+
+
+def expected_results():
+    names = list(LIVE)
+    distances = ((QUERIES[:, None, :] - np.stack(list(LIVE.values()))[None, :, :]) ** 2).sum(axis=2)
+    order = np.argsort(distances, axis=1)
+    return [[names[i_] for i_ in row] for row in order], np.take_along_axis(distances, order, axis=1)
+
+
+@pytest.mark.parametrize('make_store', [local_store, milvus_store], ids=['local', 'milvus'])
+def test_insert_reinsert_delete(tmp_path, make_store):
+    store = make_store(tmp_path)
+    try:
+        slices, distances = run_sequence(store)
+    finally:
+        if isinstance(store, MilvusStore):
+            from pymilvus import utility
+
+            utility.drop_collection(MILVUS_TEST_COLLECTION)
+        store.close()
+    expected_slices, expected_distances = expected_results()
+    assert slices == expected_slices
+    assert np.allclose(distances, expected_distances, atol=1e-5)
+
+
+def test_local_upsert_survives_reopen(tmp_path):
+    store = local_store(tmp_path)
+    run_sequence(store)
+    store.close()
+    reopened = local_store(tmp_path)
+    reopened.open()
+    assert {key: reopened.get_slice(row) for key, row in reopened.keys.items()} == {
+        11: 'slice-1', 12: 'slice-2-new', 14: 'slice-4'}
+    reopened.close()
@@ -0,0 +1,445 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+import dotenv
+import numpy as np
+
+import jsonl_io
+
+# 精确检索时每次参与计算的向量行数，限制内存占用
+SEARCH_CHUNK_ROWS = 65536
+# 训练IVF聚类中心时每个中心的采样数量和迭代次数
+KMEANS_SAMPLES_PER_LIST = 32
+KMEANS_ITERATIONS = 10
+# 长度不超过该值的切片不存入数据库
+SLICE_MIN_LENGTH = 100
+
+
+def slice_key(record):
+    """
+    Derives a stable 63-bit primary key for a slice record from its source file and offset.
+
+    Records without a source (e.g. produced by older versions) fall back to their id.
+    """
+    if record.get('source') is not None and record.get('offset') is not None:
+        identity = f"{record['source']}:{record['offset']}"
+    else:
+        identity = f"id:{record['id']}"
+    digest = hashlib.blake2b(identity.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') & ((1 << 63) - 1)
+
+
+def get_config():
+    """
+    Gets the vector store configuration from environment variables.
+
+    Returns:
+    - A dictionary with configuration parameters.
+    """
+    try:
+        dotenv.load_dotenv()
+        config_ = {
+            "backend": os.getenv("VECTOR_STORE", "milvus").lower(),
+            "metric": os.getenv("VECTOR_STORE_METRIC", "L2").upper(),
+            "local_dir": os.getenv("VECTOR_STORE_LOCAL_DIR"),
+            "local_index": os.getenv("VECTOR_STORE_LOCAL_INDEX", "IVF_FLAT").upper(),
+            "dbhost": os.getenv("MILVUS_DB_HOST"),
+            "dbport": os.getenv("MILVUS_DB_PORT"),
+            "collection_name": os.getenv("MILVUS_COLLECTION_NAME"),
+            "embedding_dim": int(os.getenv("EMBEDDING_GENERATION_DIM")),
+            "slice_max_length": int(os.getenv("EMBEDDING_GENERATION_SLICE_MAX_LENGTH")),
+            "nlist": int(os.getenv("EMBEDDING_GENERATION_NLIST")),
+        }
+        if config_['backend'] not in ('milvus', 'local'):
+            raise ValueError(f"未知的向量存储类型'{config_['backend']}'，可选milvus或local")
+        if config_['metric'] not in ('L2', 'IP'):
+            raise ValueError(f"未知的距离度量'{config_['metric']}'，可选L2或IP")
+        return config_
+    except ValueError as e_:
+        print(f"环境变量配置错误: {e_}")
+        exit(1)
+
+
+class MilvusStore:
+    """
+    Slice vectors in a Milvus collection with an IVF_FLAT index.
+
+    create() opens or creates the collection for inserting, finish() builds the index and
+    loads the collection, open() loads an existing collection for searching. Rows are upserted
+    by their primary key, so inserting the same slices again replaces them instead of adding
+    duplicates; collections created before the key field existed fall back to plain inserts.
+    """
+
+    def __init__(self, dbhost, dbport, collection_name, dim, slice_max_length, nlist, metric='L2'):
+        from pymilvus import connections
+
+        self.collection_name = collection_name
+        self.dim = dim
+        self.slice_max_length = slice_max_length
+        self.nlist = nlist
+        self.metric = metric
+        self.collection = None
+        self.has_key = True
+        print("连接到 Milvus...\n")
+        connections.connect(alias="default", host=dbhost, port=dbport)
+
+    def create(self):
+        from pymilvus import CollectionSchema, FieldSchema, DataType, Collection, utility
+
+        # 检查集合是否存在
+        if utility.has_collection(self.collection_name):
+            print(f"集合 '{self.collection_name}' 已存在，加载现有集合。\n")
+            self.collection = Collection(self.collection_name)
+            self.collection.load()
+            self.has_key = any(field.name == "pk" for field in self.collection.schema.fields)
+            if not self.has_key:
+                print(f"集合 '{self.collection_name}' 没有主键字段，重复运行会插入重复数据，建议重建集合\n")
+            return
+
+        # 定义集合的 Schema
+        print("定义集合的 Schema...\n")
+        fields = [
+            FieldSchema(name="pk", dtype=DataType.INT64, is_primary=True, auto_id=False),  # 由切片来源和偏移生成的主键
+            FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=self.dim),  # 存储嵌入向量
+            FieldSchema(name="slice", dtype=DataType.VARCHAR, max_length=self.slice_max_length)  # 存储对应文本
+        ]
+        schema = CollectionSchema(fields)
+        print("集合的 Schema 定义成功\n")
+
+        # 创建集合
+        print("创建集合...\n")
+        self.collection = Collection(self.collection_name, schema)
+        print("集合创建成功\n")
+
+    def insert(self, embeddings, slices, keys):
+        # 按列准备插入数据：主键列、嵌入向量列和文本列，已存在的主键被覆盖
+        if self.has_key:
+            self.collection.upsert([list(keys), np.asarray(embeddings).tolist(), list(slices)])
+        else:
+            self.collection.insert([np.asarray(embeddings).tolist(), list(slices)])
+
+    def delete(self, keys):
+        # 按主键删除墓碑切片，没有主键字段的旧集合无法定位切片
+        keys = list(keys)
+        if not keys:
+            return
+        if not self.has_key:
+            print(f"集合 '{self.collection_name}' 没有主键字段，无法删除{len(keys)}个已删除文档的切片\n")
+            return
+        self.collection.delete(f"pk in {keys}")
+
+    def finish(self):
+        # 创建索引
+        print("创建索引...\n")
+        self.collection.flush()
+        self.collection.create_index(
+            field_name="embedding",
+            index_params={
+                "index_type": "IVF_FLAT",
+                "metric_type": self.metric,
+                "params": {
+                    "nlist": self.nlist
+                }
+            }
+        )
+        print("索引创建成功\n")
+        self.collection.load()
+
+    def open(self):
+        from pymilvus import Collection
+
+        print("获取集合...\n")
+        self.collection = Collection(name=self.collection_name)
+        print("开始加载集合\n")
+        self.collection.load()
+        print("集合加载成功\n")
+
+    def search(self, embeddings, limit, nprobe):
+        results = self.collection.search(
+            np.asarray(embeddings).tolist(),
+            "embedding",
+            {"metric_type": self.metric, "params": {"nprobe": nprobe}},
+            limit=limit,
+            output_fields=["slice"],
+        )
+        return [[{"slice": hit.entity.get("slice"), "distance": hit.distance} for hit in hits] for hits in results]
+
+    def close(self):
+        from pymilvus import connections
+
+        connections.disconnect(alias="default")
+        print("连接已关闭\n")
+
+
+class LocalStore:
+    """
+    Embedded vector store over a memory-mapped float32 file, with exact or IVF search.
+
+    Vectors are appended to vectors.f32, their slices, one JSON string per line, to slices.jsonl
+    and their primary keys to keys.i64. Inserting a key that is already stored replaces its row
+    (the old row is deleted and the new one appended), like the upsert of MilvusStore. Deleted
+    rows are listed in deleted.i64 and excluded from search. finish() trains nlist k-means centroids and writes the inverted lists to ivf.npz;
+    search then scans only the nprobe nearest lists, plus any rows appended after the index
+    was built. With index_type FLAT every row is scanned. Distances follow Milvus: squared L2
+    (smaller is closer) or inner product (larger is closer).
+    """
+
+    def __init__(self, directory, dim, nlist, metric='L2', index_type='IVF_FLAT'):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.nlist = nlist
+        self.metric = metric
+        self.index_type = index_type
+        self.vectors_file = os.path.join(directory, 'vectors.f32')
+        self.slices_file = os.path.join(directory, 'slices.jsonl')
+        self.keys_file = os.path.join(directory, 'keys.i64')
+        self.deleted_file = os.path.join(directory, 'deleted.i64')
+        self.meta_file = os.path.join(directory, 'meta.json')
+        self.ivf_file = os.path.join(directory, 'ivf.npz')
+        self._lock = threading.Lock()
+        self.vectors = None
+        self.slice_offsets = None
+        self._slices_map = None
+        self.centroids = None
+        self.list_offsets = None
+        self.list_rows = None
+        self.indexed_rows = 0
+        # 主键到行号的映射，只包含未删除的行
+        self.keys = {}
+        self.rows = 0
+        self.deleted_mask = np.zeros(0, dtype=bool)
+
+    def create(self):
+        meta = {"dim": self.dim, "metric": self.metric}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, 'r', encoding='utf-8') as f_:
+                if json.load(f_) != meta:
+                    raise ValueError(f"本地向量存储'{self.meta_file}'的维度或距离度量与配置不一致")
+        else:
+            with open(self.meta_file, 'w', encoding='utf-8') as f_:
+                json.dump(meta, f_)
+        self.rows = self.repair()
+        deleted = self.read_deleted_rows(self.rows)
+        self.keys = {key: row for row, key in enumerate(np.fromfile(self.keys_file, dtype=np.int64, count=self.rows).tolist())
+                     if row not in deleted}
+
+    def read_deleted_rows(self, rows):
+        open(self.deleted_file, 'ab').close()
+        deleted = np.fromfile(self.deleted_file, dtype=np.int64)
+        return set(deleted[deleted < rows].tolist())
+
+    def repair(self):
+        # 向量、切片和主键分三个文件追加，崩溃时以最少的一方为准截断
+        open(self.vectors_file, 'ab').close()
+        open(self.slices_file, 'ab').close()
+        open(self.keys_file, 'ab').close()
+        offsets = self.read_slice_offsets()
+        rows = min(os.path.getsize(self.vectors_file) // (self.dim * 4), len(offsets) - 1,
+                   os.path.getsize(self.keys_file) // 8)
+        with open(self.vectors_file, 'rb+') as f_:
+            f_.truncate(rows * self.dim * 4)
+        with open(self.keys_file, 'rb+') as f_:
+            f_.truncate(rows * 8)
+        with open(self.slices_file, 'rb+') as f_:
+            f_.truncate(offsets[rows])
+        return rows
+
+    def read_slice_offsets(self):
+        offsets = [0]
+        with open(self.slices_file, 'rb') as f_:
+            for line in f_:
+                if not line.endswith(b'\n'):
+                    break
+                offsets.append(offsets[-1] + len(line))
+        return np.asarray(offsets, dtype=np.int64)
+
+    def insert(self, embeddings, slices, keys):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            # 本批内重复的主键只保留最后一条；已存储的主键先删除旧行，崩溃时最多缺少新行，重新写入即可恢复
+            latest = {key: i_ for i_, key in enumerate(keys)}
+            new = sorted(latest.values())
+            if not new:
+                return
+            self.mark_deleted([self.keys.pop(keys[i_]) for i_ in new if keys[i_] in self.keys])
+            for j_, i_ in enumerate(new):
+                self.keys[keys[i_]] = self.rows + j_
+            lines = b''.join(jsonl_io.encode(slices[i_]) + b'\n' for i_ in new)
+            with open(self.vectors_file, 'ab') as f_:
+                embeddings[new].tofile(f_)
+            with open(self.slices_file, 'ab') as f_:
+                f_.write(lines)
+            with open(self.keys_file, 'ab') as f_:
+                np.asarray([keys[i_] for i_ in new], dtype=np.int64).tofile(f_)
+            self.rows += len(new)
+
+    def delete(self, keys):
+        # 删除主键对应的行：记录行号，检索时跳过，主键可以重新插入
+        with self._lock:
+            self.mark_deleted([self.keys.pop(key) for key in keys if key in self.keys])
+
+    def mark_deleted(self, rows):
+        if not rows:
+            return
+        with open(self.deleted_file, 'ab') as f_:
+            np.asarray(rows, dtype=np.int64).tofile(f_)
+        if len(self.deleted_mask):
+            self.deleted_mask[[row for row in rows if row < len(self.deleted_mask)]] = True
+
+    def finish(self):
+        self.open(load_index=False)
+        rows = self.vectors.shape[0]
+        if self.index_type == 'IVF_FLAT' and rows:
+            print("创建索引...\n")
+            self.build_index()
+            print("索引创建成功\n")
+        self.open()
+
+    def build_index(self):
+        rows = self.vectors.shape[0]
+        nlist = min(self.nlist, rows)
+        rng = np.random.RandomState(0)
+        sample_size = min(rows, nlist * KMEANS_SAMPLES_PER_LIST)
+        sample = np.array(self.vectors[np.sort(rng.choice(rows, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = self.nearest_centroids(sample, centroids, 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            # 空的聚类保留原中心
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        assignment = np.concatenate([
+            self.nearest_centroids(np.asarray(self.vectors[start:start + SEARCH_CHUNK_ROWS]), centroids, 1)[:, 0]
+            for start in range(0, rows, SEARCH_CHUNK_ROWS)
+        ])
+        list_rows = np.argsort(assignment, kind='stable').astype(np.int64)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+        np.savez(self.ivf_file, centroids=centroids, list_rows=list_rows, list_offsets=list_offsets,
+                 indexed_rows=np.int64(rows))
+
+    @staticmethod
+    def nearest_centroids(vectors, centroids, count):
+        # 聚类中心始终按L2距离划分
+        distances = (centroids ** 2).sum(axis=1)[None, :] - 2 * vectors @ centroids.T
+        if count == 1:
+            return distances.argmin(axis=1)[:, None]
+        if count >= centroids.shape[0]:
+            return np.argsort(distances, axis=1)
+        nearest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        return np.take_along_axis(nearest, order, axis=1)
+
+    def open(self, load_index=True):
+        self.create()
+        rows = self.repair()
+        self.vectors = np.memmap(self.vectors_file, dtype=np.float32, mode='r', shape=(rows, self.dim)) \
+            if rows else np.zeros((0, self.dim), dtype=np.float32)
+        self.slice_offsets = self.read_slice_offsets()
+        self.deleted_mask = np.zeros(rows, dtype=bool)
+        self.deleted_mask[list(self.read_deleted_rows(rows))] = True
+        with open(self.slices_file, 'rb') as f_:
+            self._slices_map = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ) if rows else None
+        self.centroids = None
+        self.indexed_rows = 0
+        if load_index and self.index_type == 'IVF_FLAT' and os.path.exists(self.ivf_file):
+            index = np.load(self.ivf_file)
+            if int(index['indexed_rows']) <= rows and index['centroids'].shape[1] == self.dim:
+                self.centroids = index['centroids']
+                self.list_rows = index['list_rows']
+                self.list_offsets = index['list_offsets']
+                self.indexed_rows = int(index['indexed_rows'])
+
+    def get_slice(self, row):
+        return jsonl_io.decode(self._slices_map[int(self.slice_offsets[row]):int(self.slice_offsets[row + 1])])
+
+    def distances(self, queries, vectors):
+        if self.metric == 'IP':
+            return queries @ vectors.T
+        return (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)[None, :]
+
+    def top_k(self, distances, rows, limit):
+        # 返回每个查询最近的limit个(行号, 距离)，IP度量越大越近
+        scores = -distances if self.metric == 'IP' else distances
+        limit = min(limit, scores.shape[1])
+        nearest = np.argpartition(scores, limit - 1, axis=1)[:, :limit]
+        order = np.argsort(np.take_along_axis(scores, nearest, axis=1), axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        # rows为一维时所有查询共用同一组候选行，为二维时每个查询各自的候选行
+        found_rows = rows[nearest] if rows.ndim == 1 else np.take_along_axis(rows, nearest, axis=1)
+        return found_rows, np.take_along_axis(distances, nearest, axis=1)
+
+    def merge(self, best, candidate, limit):
+        if best is None:
+            return candidate
+        rows = np.concatenate([best[0], candidate[0]], axis=1)
+        distances = np.concatenate([best[1], candidate[1]], axis=1)
+        return self.top_k(distances, rows, limit)
+
+    def search_rows(self, queries, rows, limit):
+        # 跳过已删除的行
+        rows = rows[~self.deleted_mask[rows]]
+        best = None
+        for start in range(0, len(rows), SEARCH_CHUNK_ROWS):
+            chunk = rows[start:start + SEARCH_CHUNK_ROWS]
+            vectors = np.asarray(self.vectors[chunk])
+            best = self.merge(best, self.top_k(self.distances(queries, vectors), chunk, limit), limit)
+        if best is None:
+            return ([np.zeros(0, dtype=np.int64)] * queries.shape[0],
+                    [np.zeros(0, dtype=np.float32)] * queries.shape[0])
+        return best
+
+    def search(self, embeddings, limit, nprobe):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        rows = self.vectors.shape[0]
+        if rows == 0 or limit <= 0:
+            return [[] for _ in range(queries.shape[0])]
+        if self.centroids is None:
+            best = self.search_rows(queries, np.arange(rows), limit)
+        else:
+            # IVF：每个查询只扫描最近的nprobe个倒排列表，以及建索引后追加的行
+            probes = self.nearest_centroids(queries, self.centroids, min(nprobe, self.centroids.shape[0]))
+            tail = np.arange(self.indexed_rows, rows)
+            rows_list, distances_list = [], []
+            for i_ in range(queries.shape[0]):
+                candidates = np.concatenate(
+                    [self.list_rows[self.list_offsets[list_]:self.list_offsets[list_ + 1]] for list_ in probes[i_]]
+                    + [tail])
+                found_rows, found_distances = self.search_rows(queries[i_:i_ + 1], np.sort(candidates), limit)
+                rows_list.append(found_rows[0])
+                distances_list.append(found_distances[0])
+            best = rows_list, distances_list
+        return [
+            [{"slice": self.get_slice(row), "distance": float(distance)} for row, distance in zip(rows_, distances_)]
+            for rows_, distances_ in zip(*best)
+        ]
+
+    def close(self):
+        if self._slices_map is not None:
+            self._slices_map.close()
+            self._slices_map = None
+        self.vectors = None
+
+
+def get_vector_store(config_=None):
+    """
+    Creates the vector store selected by VECTOR_STORE.
+
+    Returns:
+    - A MilvusStore or a LocalStore. Call create() before inserting or open() before searching.
+    """
+    if config_ is None:
+        config_ = get_config()
+    if config_['backend'] == 'local':
+        if not config_['local_dir']:
+            print("环境变量配置错误: 使用本地向量存储时需要配置VECTOR_STORE_LOCAL_DIR")
+            exit(1)
+        return LocalStore(
+            config_['local_dir'], config_['embedding_dim'], config_['nlist'], config_['metric'], config_['local_index'])
+    return MilvusStore(
+        config_['dbhost'], config_['dbport'], config_['collection_name'], config_['embedding_dim'],
+        config_['slice_max_length'], config_['nlist'], config_['metric'])